@@ -0,0 +1,226 @@
+import asyncio
+import json
+import time
+from collections import defaultdict
+from collections.abc import AsyncGenerator
+from contextvars import ContextVar
+from typing import Any
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Message, Update
+from aiohttp import web
+
+# Start time of the update being processed, used to measure time to first edit
+update_started_at: ContextVar[float | None] = ContextVar(
+    "update_started_at",
+    default=None,
+)
+
+
+class FakeTelegramSession(BaseSession):
+    """Bot session that records outbound calls instead of sending them.
+
+    Messages and edits return a fake `Message`, other methods return True.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        """Initialize the session.
+
+        Args:
+            latency (float): Simulated latency of a Telegram API call in seconds.
+
+        """
+        super().__init__()
+        self.latency = latency
+        self.calls: dict[str, int] = defaultdict(int)
+        self.durations: list[float] = []
+        self.first_edit_latencies: list[float] = []
+        self._message_id = 0
+        self._first_edit_seen: set[float] = set()
+
+    async def close(self) -> None:
+        """Close the session."""
+
+    async def stream_content(
+        self,
+        url: str,  # noqa: ARG002
+        headers: dict[str, Any] | None = None,  # noqa: ARG002
+        timeout: int = 30,  # noqa: ARG002, ASYNC109
+        chunk_size: int = 65536,  # noqa: ARG002
+        raise_for_status: bool = True,  # noqa: ARG002, FBT001, FBT002
+    ) -> AsyncGenerator[bytes]:
+        """Stream nothing, files are not used by the bot."""
+        yield b""
+
+    async def make_request(
+        self,
+        bot: Bot,
+        method: TelegramMethod,
+        timeout: int | None = None,  # noqa: ARG002, ASYNC109
+    ) -> Any:  # noqa: ANN401
+        """Record the call and return a fake result."""
+        started_at = time.perf_counter()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        name = type(method).__name__
+        self.calls[name] += 1
+        self.durations.append(time.perf_counter() - started_at)
+
+        update_start = update_started_at.get()
+        if (
+            name == "EditMessageText"
+            and update_start is not None
+            and update_start not in self._first_edit_seen
+        ):
+            self._first_edit_seen.add(update_start)
+            self.first_edit_latencies.append(time.perf_counter() - update_start)
+
+        if method.__returning__ is not Message and name != "EditMessageText":
+            return True
+        self._message_id += 1
+        return Message.model_validate(
+            {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {
+                    "id": getattr(method, "chat_id", None) or 0,
+                    "type": "private",
+                },
+                "text": getattr(method, "text", None),
+            },
+            context={"bot": bot},
+        )
+
+
+def make_text_update(update_id: int, chat_id: int, text: str, bot: Bot) -> Update:
+    """Build a synthetic update with a private text message.
+
+    Args:
+        update_id (int): The update ID.
+        chat_id (int): The chat and user ID.
+        text (str): The message text.
+        bot (Bot): The bot the update is for.
+
+    Returns:
+        Update: The update.
+
+    """
+    return Update.model_validate(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private", "first_name": "Bench"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                "text": text,
+            },
+        },
+        context={"bot": bot},
+    )
+
+
+class FakeOpenAIServer:
+    """OpenAI compatible chat completions server with configurable latency.
+
+    Responses consist of `response_tokens` words. The first one is sent after
+    `first_token_latency` seconds, every next one after `token_latency` seconds.
+    """
+
+    def __init__(
+        self,
+        first_token_latency: float,
+        token_latency: float,
+        response_tokens: int,
+    ) -> None:
+        """Initialize the server.
+
+        Args:
+            first_token_latency (float): Delay before the first token in seconds.
+            token_latency (float): Delay between two tokens in seconds.
+            response_tokens (int): Number of tokens of every response.
+
+        """
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.response_tokens = response_tokens
+        self.requests = 0
+        self._runner: web.AppRunner | None = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start the server.
+
+        Args:
+            host (str): Host to listen on.
+            port (int): Port to listen on, 0 for a random free port.
+
+        Returns:
+            str: Base URL of the API.
+
+        """
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self) -> None:
+        """Stop the server."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        """Handle a chat completion request."""
+        self.requests += 1
+        body: dict = await request.json()
+        words = [f"word{i}" for i in range(self.response_tokens)]
+        base = {
+            "id": "chatcmpl-bench",
+            "created": int(time.time()),
+            "model": body["model"],
+        }
+
+        await asyncio.sleep(self.first_token_latency)
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_latency * (self.response_tokens - 1))
+            return web.json_response(
+                {
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {
+                                "role": "assistant",
+                                "content": " ".join(words),
+                            },
+                        },
+                    ],
+                },
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            chunk = {
+                **base,
+                "object": "chat.completion.chunk",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": word if i == 0 else f" {word}"},
+                        "finish_reason": None,
+                    },
+                ],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
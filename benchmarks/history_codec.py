@@ -0,0 +1,171 @@
+"""Micro-benchmark of the chat history codecs.
+
+Compares the size of a full conversation in Redis and the CPU time to encode a
+message and to decode the history read on every turn, for the legacy JSON objects
+and every available format and compression.
+
+Usage:
+    uv run --extra history python -m benchmarks.history_codec
+"""
+
+import argparse
+import json
+import os
+import random
+import timeit
+from collections.abc import Callable
+
+from benchmarks.load_test import DEFAULT_ENVIRONMENT
+
+# Words of the synthetic messages, so they compress like natural text rather than
+# repeated strings
+VOCABULARY = (  # noqa: SIM905
+    "the a to of and in is it you that for on with as this be are can your or "
+    "have not will from by an if more use but all so one about what which when "
+    "message model answer question example code python function value list data "
+    "error time user chat history response token redis request bot mode"
+).split()
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=40,
+        help="messages in the conversation",
+    )
+    parser.add_argument(
+        "--user-chars",
+        type=int,
+        default=120,
+        help="average length of a user message",
+    )
+    parser.add_argument(
+        "--assistant-chars",
+        type=int,
+        default=900,
+        help="average length of an assistant message",
+    )
+    parser.add_argument(
+        "--min-bytes",
+        type=int,
+        default=512,
+        help="minimum size of a compressed entry",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=200,
+        help="timed decodings of the conversation",
+    )
+    return parser.parse_args()
+
+
+def make_text(rng: random.Random, chars: int) -> str:
+    """Generate a text of about the given length."""
+    words: list[str] = []
+    length = 0
+    target = rng.randint(chars // 2, chars * 3 // 2)
+    while length < target:
+        word = rng.choice(VOCABULARY)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def make_conversation(args: argparse.Namespace) -> list[dict]:
+    """Generate a conversation alternating user and assistant messages."""
+    rng = random.Random(0)  # noqa: S311
+    messages = []
+    for i in range(args.messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        chars = args.user_chars if role == "user" else args.assistant_chars
+        content = make_text(rng, chars)
+        messages.append({"role": role, "content": content, "tokens": len(content) // 4})
+    return messages
+
+
+def measure(
+    encode: Callable[[dict], bytes],
+    decode: Callable[[bytes], dict],
+    messages: list[dict],
+    repeat: int,
+) -> dict[str, float]:
+    """Measure the size and the encoding and decoding times of a codec.
+
+    Args:
+        encode (Callable[[dict], bytes]): Encodes a message.
+        decode (Callable[[bytes], dict]): Decodes a message.
+        messages (list[dict]): The conversation.
+        repeat (int): Number of timed runs.
+
+    Returns:
+        dict[str, float]: Bytes of the conversation, microseconds to encode a
+            message and to decode the conversation.
+
+    """
+    values = [encode(message) for message in messages]
+    assert [decode(value) for value in values] == messages  # noqa: S101
+    encode_seconds = min(
+        timeit.repeat(lambda: [encode(m) for m in messages], number=1, repeat=repeat),
+    )
+    decode_seconds = min(
+        timeit.repeat(lambda: [decode(v) for v in values], number=1, repeat=repeat),
+    )
+    return {
+        "bytes": sum(len(value) for value in values),
+        "encode_us": encode_seconds / len(messages) * 1e6,
+        "decode_us": decode_seconds * 1e6,
+    }
+
+
+def main() -> None:
+    """Run the benchmark from the command line."""
+    args = parse_args()
+    for name, value in DEFAULT_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+
+    from chat_bot.history_codec import (  # noqa: PLC0415
+        COMPRESSIONS,
+        FORMATS,
+        HistoryCodec,
+    )
+
+    messages = make_conversation(args)
+    results = {
+        "legacy json": measure(
+            lambda message: json.dumps(message).encode(),
+            lambda value: dict(json.loads(value)),
+            messages,
+            args.repeat,
+        ),
+    }
+    for format_name in FORMATS:
+        for compression in ("none", *COMPRESSIONS):
+            try:
+                codec = HistoryCodec(format_name, compression, args.min_bytes)
+            except ValueError:
+                continue
+            results[f"{format_name} {compression}"] = measure(
+                codec.encode,
+                codec.decode,
+                messages,
+                args.repeat,
+            )
+
+    legacy_bytes = results["legacy json"]["bytes"]
+    print(  # noqa: T201
+        f"{'codec':<16}{'bytes':>10}{'vs legacy':>11}"
+        f"{'encode us/msg':>15}{'decode us/turn':>16}",
+    )
+    for name, result in results.items():
+        print(  # noqa: T201
+            f"{name:<16}{result['bytes']:>10}{result['bytes'] / legacy_bytes:>10.0%} "
+            f"{result['encode_us']:>14.1f}{result['decode_us']:>16.1f}",
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Import-time benchmark of the bot modules.
+
+Imports each module in a fresh interpreter with `python -X importtime`, reports
+the total import time and the slowest top-level packages, and checks that the
+packages the bot loads on first use are not imported eagerly. The modules are
+imported without the settings in the environment, as they must not read them on
+import. Exits with status 1 if one of them is imported eagerly, so startup
+regressions fail loudly.
+
+Usage:
+    uv run python -m benchmarks.import_time
+    uv run python -m benchmarks.import_time --module chat_bot.crud --top 20
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+from benchmarks.load_test import DEFAULT_ENVIRONMENT
+
+# Modules measured by default, and the packages they must not import eagerly
+DEFERRED_IMPORTS = {
+    "chat_bot.main": ("openai", "redis", "sqlalchemy"),
+    "chat_bot.crud": ("aiogram", "aiohttp", "openai"),
+    "chat_bot.models": ("aiogram", "aiohttp", "openai", "redis"),
+    "chat_bot.history_codec": ("aiogram", "aiohttp", "openai", "sqlalchemy"),
+}
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--module",
+        action="append",
+        help="module to import, may be repeated (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="imports of each module, the median is reported",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="slowest top-level packages to show",
+    )
+    return parser.parse_args()
+
+
+def measure_import(module: str) -> dict[str, int]:
+    """Import a module in a new interpreter and get the import times.
+
+    Args:
+        module (str): The module to import.
+
+    Returns:
+        dict[str, int]: Cumulative import time in microseconds of every module
+            imported, including `module`.
+
+    """
+    # The settings are read on first use, importing a module must not need them
+    environment = {
+        name: value
+        for name, value in os.environ.items()
+        if name not in DEFAULT_ENVIRONMENT
+    }
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=environment,
+    )
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    times: dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def top_level_times(times: dict[str, int]) -> dict[str, int]:
+    """Get the import time of the top-level packages, e.g. `openai`."""
+    packages: dict[str, int] = defaultdict(int)
+    for name, cumulative in times.items():
+        if "." not in name:
+            packages[name] = max(packages[name], cumulative)
+    return packages
+
+
+def main() -> None:
+    """Run the benchmark from the command line."""
+    args = parse_args()
+    modules = args.module or list(DEFERRED_IMPORTS)
+    failed = False
+    for module in modules:
+        runs = [measure_import(module) for _ in range(args.repeat)]
+        total = statistics.median(run[module] for run in runs)
+        packages = {
+            name: statistics.median(top_level_times(run).get(name, 0) for run in runs)
+            for name in top_level_times(runs[0])
+        }
+        print(f"{module}: {total / 1000:.1f} ms")  # noqa: T201
+        slowest = sorted(packages.items(), key=lambda item: -item[1])
+        for name, cumulative in slowest[: args.top]:
+            print(f"  {name:<32}{cumulative / 1000:>10.1f} ms")  # noqa: T201
+
+        eager = [name for name in DEFERRED_IMPORTS.get(module, ()) if name in runs[0]]
+        if eager:
+            failed = True
+            print(f"  imported eagerly: {', '.join(eager)}")  # noqa: T201
+        print()  # noqa: T201
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
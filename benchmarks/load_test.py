@@ -0,0 +1,376 @@
+"""End-to-end load benchmark of the bot.
+
+Drives the real `Dispatcher` from `chat_bot.main` with synthetic updates. Telegram
+is replaced by a session that records outbound calls, OpenAI by a local server
+with configurable latency. Redis and the database are fakeredis and
+SQLite in a temporary file unless URLs of real instances are given.
+
+Usage:
+    uv run python -m benchmarks.load_test --users 50 --messages 10
+"""
+
+import argparse
+import asyncio
+import functools
+import inspect
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from collections.abc import AsyncIterator, Callable
+from importlib import import_module
+from pathlib import Path
+from typing import Any
+
+from benchmarks.fakes import (
+    FakeOpenAIServer,
+    FakeTelegramSession,
+    make_text_update,
+    update_started_at,
+)
+
+# Settings required by `chat_bot.config`, real values are not needed
+DEFAULT_ENVIRONMENT = {
+    "BOT_TOKEN": "123456:BENCHMARK",
+    "API_KEY": "sk-benchmark",
+    "MODEL": "benchmark-model",
+    "POSTGRES_DB": "benchmark",
+    "POSTGRES_USER": "benchmark",
+    "POSTGRES_PASSWORD": "benchmark",
+    "LOG_LEVEL": "WARNING",
+}
+
+# Functions timed as stages: stage name -> (module, function)
+STAGES = {
+    "chat_session": ("chat_bot.ai_chat_service", "add_message_and_read_session"),
+    "get_chat_mode": ("chat_bot.ai_chat_service", "get_chat_mode"),
+    "llm": ("chat_bot.ai_chat_service", "get_chatgpt_response"),
+    "llm_stream": ("chat_bot.ai_chat_service", "stream_chatgpt_response"),
+    "save_response": ("chat_bot.ai_chat_service", "save_and_cache_response"),
+    "create_user": ("chat_bot.crud", "create_user"),
+}
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20, help="concurrent users")
+    parser.add_argument("--messages", type=int, default=5, help="messages per user")
+    parser.add_argument(
+        "--think-time",
+        type=float,
+        default=0.0,
+        help="pause between two messages of a user in seconds",
+    )
+    parser.add_argument(
+        "--openai-first-token",
+        type=float,
+        default=0.5,
+        help="OpenAI time to first token in seconds",
+    )
+    parser.add_argument(
+        "--openai-token-delay",
+        type=float,
+        default=0.02,
+        help="OpenAI delay between two tokens in seconds",
+    )
+    parser.add_argument(
+        "--openai-tokens",
+        type=int,
+        default=50,
+        help="tokens of every OpenAI response",
+    )
+    parser.add_argument(
+        "--telegram-latency",
+        type=float,
+        default=0.0,
+        help="latency of every Telegram API call in seconds",
+    )
+    parser.add_argument(
+        "--redis-url",
+        help="URL of a Redis server, fakeredis is used if not given",
+    )
+    parser.add_argument(
+        "--database-url",
+        help="SQLAlchemy URL of the database, SQLite is used if not given",
+    )
+    parser.add_argument(
+        "--no-stream",
+        action="store_true",
+        help="disable streaming of responses",
+    )
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """Get the nearest-rank percentile of the values."""
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(values: list[float]) -> dict[str, float]:
+    """Get the count, mean and percentiles of durations in milliseconds."""
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) * 1000 if values else math.nan,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+    }
+
+
+def instrument(durations: dict[str, list[float]]) -> None:
+    """Time the stage functions by replacing them in the modules that call them.
+
+    Args:
+        durations (dict[str, list[float]]): Collected durations by stage name.
+
+    """
+    for stage, (module_name, function_name) in STAGES.items():
+        module = import_module(module_name)
+        function: Callable = getattr(module, function_name)
+        if inspect.isasyncgenfunction(function):
+            wrapper = time_async_generator(function, durations[stage])
+        else:
+            wrapper = time_coroutine(function, durations[stage])
+        setattr(module, function_name, wrapper)
+
+
+def time_coroutine(function: Callable, durations: list[float]) -> Callable:
+    """Wrap a coroutine function to record its durations."""
+
+    @functools.wraps(function)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+        started_at = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            durations.append(time.perf_counter() - started_at)
+
+    return wrapper
+
+
+def time_async_generator(function: Callable, durations: list[float]) -> Callable:
+    """Wrap an async generator function to record its total durations."""
+
+    @functools.wraps(function)
+    async def wrapper(*args: Any, **kwargs: Any) -> AsyncIterator:  # noqa: ANN401
+        started_at = time.perf_counter()
+        try:
+            async for item in function(*args, **kwargs):
+                yield item
+        finally:
+            durations.append(time.perf_counter() - started_at)
+
+    return wrapper
+
+
+async def setup_backends(args: argparse.Namespace, openai_base_url: str) -> None:
+    """Point the bot to the fake or given backends.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+        openai_base_url (str): Base URL of the fake OpenAI server.
+
+    """
+    for name, value in DEFAULT_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    os.environ["STREAM_RESPONSES"] = str(not args.no_stream)
+    os.environ["OPENAI_BASE_URL"] = openai_base_url
+
+    from redis.asyncio import Redis  # noqa: PLC0415
+    from sqlalchemy.ext.asyncio import create_async_engine  # noqa: PLC0415
+
+    from chat_bot.app import app  # noqa: PLC0415
+
+    if args.redis_url:
+        app.redis = Redis.from_url(args.redis_url, decode_responses=True)
+        app.history_redis = Redis.from_url(args.redis_url)
+    else:
+        from fakeredis import FakeAsyncRedis, FakeServer  # noqa: PLC0415
+
+        server = FakeServer()
+        app.redis = FakeAsyncRedis(server=server, decode_responses=True)
+        app.history_redis = FakeAsyncRedis(server=server)
+
+    database_url = args.database_url
+    if database_url is None:
+        database_file = Path(tempfile.mkdtemp()) / "benchmark.db"
+        database_url = f"sqlite+aiosqlite:///{database_file}"
+    app.engine = create_async_engine(database_url)
+
+    from chat_bot import models  # noqa: F401, PLC0415
+    from chat_bot.database import Base  # noqa: PLC0415
+
+    async with app.engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+
+async def teardown_backends() -> None:
+    """Close the connections to the backends."""
+    from chat_bot.app import app  # noqa: PLC0415
+
+    await app.close()
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    """Run the benchmark.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+
+    Returns:
+        dict[str, Any]: The benchmark report.
+
+    """
+    openai_server = FakeOpenAIServer(
+        first_token_latency=args.openai_first_token,
+        token_latency=args.openai_token_delay,
+        response_tokens=args.openai_tokens,
+    )
+    await setup_backends(args, await openai_server.start())
+
+    from aiogram import Bot  # noqa: PLC0415
+
+    from chat_bot import main  # noqa: PLC0415
+    from chat_bot.app import app  # noqa: PLC0415
+    from chat_bot.compaction import compaction_tasks  # noqa: PLC0415
+    from chat_bot.config import settings  # noqa: PLC0415
+    from chat_bot.telegram_scheduler import (  # noqa: PLC0415
+        TelegramSchedulerMiddleware,
+    )
+
+    durations: dict[str, list[float]] = defaultdict(list)
+    instrument(durations)
+    session = FakeTelegramSession(latency=args.telegram_latency)
+    if settings.TELEGRAM_SCHEDULER_ENABLED:
+        session.middleware(TelegramSchedulerMiddleware())
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=session)
+    app.message_archive.start()
+    await app.warm_up()
+
+    # Chat IDs far from real ones, so a shared Redis is not polluted
+    first_chat_id = 10**12 + int(time.time())
+    chat_ids = range(first_chat_id, first_chat_id + args.users)
+    update_ids = iter(range(1, 10**9))
+    latencies: list[float] = []
+
+    async def feed(chat_id: int, text: str) -> None:
+        update = make_text_update(next(update_ids), chat_id, text, bot)
+        started_at = time.perf_counter()
+        token = update_started_at.set(started_at)
+        try:
+            await main.dp.feed_update(bot, update)
+        finally:
+            update_started_at.reset(token)
+        latencies.append(time.perf_counter() - started_at)
+
+    async def user(chat_id: int) -> None:
+        for i in range(args.messages):
+            await feed(chat_id, f"Benchmark message {i} from {chat_id}")
+            if args.think_time:
+                await asyncio.sleep(args.think_time)
+
+    await asyncio.gather(*(feed(chat_id, "/start") for chat_id in chat_ids))
+    registration = summarize(latencies)
+    latencies.clear()
+    session.first_edit_latencies.clear()
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(user(chat_id) for chat_id in chat_ids))
+    elapsed = time.perf_counter() - started_at
+    await asyncio.gather(*compaction_tasks.values(), return_exceptions=True)
+
+    report = {
+        "users": args.users,
+        "messages": len(latencies),
+        "elapsed_s": elapsed,
+        "messages_per_s": len(latencies) / elapsed,
+        "registration": registration,
+        "end_to_end": summarize(latencies),
+        "time_to_first_edit": summarize(session.first_edit_latencies),
+        "stages": {stage: summarize(values) for stage, values in durations.items()},
+        "telegram_calls": dict(session.calls),
+        "openai_requests": openai_server.requests,
+        "telegram_scheduler": app.telegram_scheduler.stats(),
+        "typing_replies": settings.TYPING_REPLIES,
+    }
+
+    await app.telegram_scheduler.close()
+    await bot.session.close()
+    await app.message_archive.close()
+    await teardown_backends()
+    await openai_server.stop()
+    return report
+
+
+def print_report(report: dict[str, Any]) -> None:
+    """Print the benchmark report as a table."""
+    print(  # noqa: T201
+        f"{report['messages']} messages from {report['users']} users in "
+        f"{report['elapsed_s']:.2f} s: {report['messages_per_s']:.1f} messages/s\n"
+        f"Telegram calls: {report['telegram_calls']}, "
+        f"OpenAI requests: {report['openai_requests']}, "
+        f"Telegram scheduler: {report['telegram_scheduler']}\n",
+    )
+    rows = {
+        "registration": report["registration"],
+        "end_to_end": report["end_to_end"],
+        "time_to_first_edit": report["time_to_first_edit"],
+        **{f"  {stage}": stats for stage, stats in report["stages"].items()},
+    }
+    print(  # noqa: T201
+        f"{'stage':<22}{'count':>8}{'mean ms':>10}{'p50 ms':>10}"
+        f"{'p95 ms':>10}{'p99 ms':>10}",
+    )
+    for name, stats in rows.items():
+        print(  # noqa: T201
+            f"{name:<22}{stats['count']:>8}{stats['mean_ms']:>10.1f}"
+            f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}",
+        )
+
+
+def check_report(report: dict[str, Any]) -> list[str]:
+    """Get the problems the benchmark report shows.
+
+    Args:
+        report (dict[str, Any]): The benchmark report.
+
+    Returns:
+        list[str]: The problems, empty if there is none.
+
+    """
+    problems = []
+    typing_actions = report["telegram_calls"].get("SendChatAction", 0)
+    if report["typing_replies"] and typing_actions < report["messages"]:
+        problems.append(
+            f"{typing_actions} typing actions for {report['messages']} messages, "
+            "every message must show one",
+        )
+    return problems
+
+
+def main() -> None:
+    """Run the benchmark from the command line."""
+    args = parse_args()
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))  # noqa: T201
+    else:
+        print_report(report)
+    problems = check_report(report)
+    for problem in problems:
+        print(f"Failed check: {problem}", file=sys.stderr)  # noqa: T201
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
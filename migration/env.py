@@ -6,13 +6,14 @@ from sqlalchemy.engine import Connection
 from sqlalchemy.ext.asyncio import async_engine_from_config
 
 from alembic import context
-from chat_bot.database import Base, DATABASE_URL
-from chat_bot.models import User
+from chat_bot.config import settings
+from chat_bot.database import Base
+from chat_bot.models import Message, User
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
-config.set_main_option("sqlalchemy.url", DATABASE_URL)
+config.set_main_option("sqlalchemy.url", settings.get_postgres_url())
 
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
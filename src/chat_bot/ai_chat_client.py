@@ -1,24 +1,377 @@
-import openai
+import asyncio
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
+from dataclasses import dataclass
+from typing import Any
 
+from chat_bot.app import app
 from chat_bot.config import get_logger, settings
+from chat_bot.llm_backends import LLMBackend, RequestKind
+from chat_bot.llm_scheduler import (
+    get_exhausted_delay,
+    get_retry_delay,
+)
+from chat_bot.metrics import (
+    llm_backend_requests,
+    llm_first_token,
+    llm_hedged_requests,
+    record_llm_usage,
+    timed,
+)
+from chat_bot.tokens import CHARS_PER_TOKEN
 
 log = get_logger(__name__)
 
-client = openai.AsyncOpenAI(api_key=settings.API_KEY)
+# Cancellation message of the requests another backend answered first
+LOST_RACE = "Another LLM backend answered first"
 
+# Closing of the streams that lost a hedged race, kept until they are closed
+background_tasks: set[asyncio.Future] = set()
+
+
+def estimate_tokens(messages: list[dict]) -> int:
+    """Roughly estimate the tokens a request will use, without tokenizing it.
+
+    Args:
+        messages (list[dict]): List of messages to send to the API.
+
+    Returns:
+        int: Estimated prompt and completion tokens.
+
+    """
+    prompt_chars = sum(len(message["content"]) for message in messages)
+    return prompt_chars // CHARS_PER_TOKEN + settings.LLM_EXPECTED_COMPLETION_TOKENS
+
+
+@dataclass
+class StreamStart:
+    """A streamed response whose first text has arrived.
+
+    Attributes:
+        stream (Any): The stream, to close once consumed.
+        chunks (AsyncIterator[Any]): The remaining chunks of the stream.
+        first (str): The first text of the response, empty if it had none.
+
+    """
+
+    stream: Any
+    chunks: AsyncIterator[Any]
+    first: str
+
+
+async def create_completion(backend: LLMBackend, **kwargs: Any) -> Any:  # noqa: ANN401
+    """Create a chat completion on a backend, without retrying.
+
+    Args:
+        backend (LLMBackend): The backend to send the request to.
+        **kwargs (Any): Arguments of the chat completion request, but the model.
+
+    Returns:
+        Any: The parsed completion, or the stream if `stream=True` was passed.
+
+    """
+    completions = backend.client.chat.completions
+    response = await completions.with_raw_response.create(
+        model=backend.model,
+        **kwargs,
+    )
+    delay = get_exhausted_delay(response.headers)
+    if delay:
+        # With other backends to serve the requests, only this one waits
+        if len(app.llm_backends) == 1:
+            app.llm_scheduler.pause(delay)
+        else:
+            backend.cooldown(delay)
+    return response.parse()
 
-async def get_chatgpt_response(messages: list[str]) -> str:
-    """Get response from OpenAI API.
+
+async def open_stream(backend: LLMBackend, messages: list[dict]) -> StreamStart:
+    """Stream a response from a backend until its first text arrives.
 
     Args:
+        backend (LLMBackend): The backend to send the request to.
         messages (list[dict]): List of messages to send to the API.
 
     Returns:
-        str: Response from the API.
+        StreamStart: The stream, positioned after its first text.
 
     """
-    completion = await client.chat.completions.create(
-        model=settings.MODEL,
+    stream = await create_completion(
+        backend,
         messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
     )
-    return completion.choices[0].message.content
+    chunks = aiter(stream)
+    try:
+        async for chunk in chunks:
+            # The usage is sent in the last chunk, which has no choices
+            record_llm_usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                return StreamStart(stream, chunks, chunk.choices[0].delta.content)
+    except BaseException:
+        await stream.close()
+        raise
+    return StreamStart(stream, chunks, "")
+
+
+def get_failure_delay(
+    backend: LLMBackend,
+    error: BaseException,
+    attempt: int,
+) -> float | None:
+    """Record a failed request and get the delay before retrying the backend.
+
+    Args:
+        backend (LLMBackend): The backend the request failed on.
+        error (BaseException): The error raised by the request.
+        attempt (int): Number of the failed attempt, starting from 0.
+
+    Returns:
+        (float | None): The delay in seconds, None if the request must not be
+            retried on the same backend, e.g. for invalid requests.
+
+    """
+    # Already loaded by the client, it's the slowest import of the bot
+    import openai  # noqa: PLC0415
+
+    if isinstance(error, openai.RateLimitError):
+        delay = get_retry_delay(error.response.headers, attempt)
+        backend.fail(delay)
+        # A single backend pauses all the requests, like the scheduler always did
+        if len(app.llm_backends) == 1:
+            app.llm_scheduler.backoff(delay)
+        else:
+            log.warning(
+                "LLM backend %s rate limited for %.2f s",
+                backend.name,
+                delay,
+            )
+        return delay
+    backend.fail(settings.LLM_BACKEND_ERROR_COOLDOWN_SECONDS)
+    log.warning("LLM backend %s request failed", backend.name, exc_info=error)
+    if isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+        return get_retry_delay({}, attempt)
+    return None
+
+
+async def run_attempt[T](
+    backend: LLMBackend,
+    kind: RequestKind,
+    attempt: Callable[[LLMBackend], Awaitable[T]],
+    delay: float,
+) -> T:
+    """Send a request to a backend, recording its latency and outcome.
+
+    Args:
+        backend (LLMBackend): The backend to send the request to.
+        kind (RequestKind): The kind of the request.
+        attempt (Callable[[LLMBackend], Awaitable[T]]): The request.
+        delay (float): Time to wait before sending the request.
+
+    Returns:
+        T: The result of the request.
+
+    """
+    if delay:
+        await asyncio.sleep(delay)
+    started_at = time.perf_counter()
+    try:
+        result = await attempt(backend)
+    except asyncio.CancelledError as cancelled:
+        # A request cancelled for the caller tells nothing of the backend latency,
+        # one that lost the race took at least as long as the backend usually does
+        if cancelled.args == (LOST_RACE,):
+            elapsed = time.perf_counter() - started_at
+            backend.observe(kind, max(elapsed, backend.latency[kind] or 0))
+        llm_backend_requests.labels(backend.name, "cancelled").inc()
+        raise
+    except Exception:
+        llm_backend_requests.labels(backend.name, "error").inc()
+        raise
+    latency = time.perf_counter() - started_at
+    backend.observe(kind, latency)
+    llm_backend_requests.labels(backend.name, "success").inc()
+    if kind == "stream":
+        llm_first_token.labels(backend.name).observe(latency)
+    return result
+
+
+def discard[T](
+    task: asyncio.Task[T],
+    close: Callable[[T], Awaitable[Any]] | None,
+    message: str | None = None,
+) -> None:
+    """Cancel a request that lost the race, closing its result if it has one."""
+
+    def close_result(task: asyncio.Task[T]) -> None:
+        if task.cancelled() or task.exception() is not None:
+            return
+        if close is not None:
+            closing = asyncio.ensure_future(close(task.result()))
+            background_tasks.add(closing)
+            closing.add_done_callback(background_tasks.discard)
+
+    task.cancel(message)
+    task.add_done_callback(close_result)
+
+
+async def request_llm[T](
+    kind: RequestKind,
+    attempt: Callable[[LLMBackend], Awaitable[T]],
+    close: Callable[[T], Awaitable[Any]] | None = None,
+    model: str | None = None,
+) -> T:
+    """Send a request to the best backend, hedged and failed over to the others.
+
+    The backends are tried in the order of `app.llm_backends.ranked`. If the request
+    hasn't completed after `LLM_HEDGE_DELAY_MS`, it's also sent to the next
+    backend and the first result wins, the other request is cancelled. At most
+    two requests run at once, a request left alone can be hedged again. Failed
+    requests are sent to the next backend right away, or retried on the same one
+    after a delay, up to `LLM_MAX_RETRIES` times.
+
+    Args:
+        kind (RequestKind): The kind of the request, whose latency ranks the
+            backends.
+        attempt (Callable[[LLMBackend], Awaitable[T]]): Sends the request to a
+            backend.
+        close (Callable[[T], Awaitable[Any]] | None): Releases the result of a
+            request that lost the race.
+        model (str | None): The model to request, None for any of the
+            configured backends.
+
+    Returns:
+        T: The result of the first successful request.
+
+    """
+    backends = app.llm_backends.ranked(kind, model)
+    hedge_delay = settings.LLM_HEDGE_DELAY_MS / 1000
+    running: dict[asyncio.Task[T], tuple[LLMBackend, float]] = {}
+    # Backends a request failed on aren't hedged to for the rest of this request,
+    # even after their cooldown, they are only retried after the failure delay
+    failed: set[LLMBackend] = set()
+    attempts = 0
+    answered = False
+
+    def start(delay: float = 0) -> None:
+        nonlocal attempts
+        backend = backends[attempts % len(backends)]
+        attempts += 1
+        task = asyncio.create_task(run_attempt(backend, kind, attempt, delay))
+        running[task] = (backend, time.monotonic() + delay)
+
+    start()
+    try:
+        while running:
+            timeout = None
+            hedge_backend = backends[attempts % len(backends)]
+            if (
+                hedge_delay
+                and len(running) == 1
+                and hedge_backend not in failed
+                and hedge_backend not in (backend for backend, _ in running.values())
+            ):
+                ((_, started_at),) = running.values()
+                timeout = max(started_at + hedge_delay - time.monotonic(), 0)
+            done, _ = await asyncio.wait(
+                running,
+                timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                llm_hedged_requests.inc()
+                start()
+                continue
+
+            error: BaseException | None = None
+            delay: float | None = None
+            for task in done:
+                if task.exception() is None:
+                    # The other requests, running or done, are discarded below
+                    del running[task]
+                    answered = True
+                    return task.result()
+                backend, _ = running.pop(task)
+                error = task.exception()
+                failed.add(backend)
+                delay = get_failure_delay(backend, error, attempts - 1)
+
+            # Keep waiting for the hedged request, if it's still running
+            if running:
+                continue
+            next_backend = backends[attempts % len(backends)]
+            if next_backend in failed and (
+                delay is None or attempts > settings.LLM_MAX_RETRIES
+            ):
+                raise error
+            start(delay if next_backend in failed else 0)
+    finally:
+        for task in running:
+            discard(task, close, LOST_RACE if answered else None)
+
+    msg = "LLM request ended without a result"
+    raise RuntimeError(msg)
+
+
+@timed
+async def get_chatgpt_response(
+    messages: list[dict],
+    tg_id: int = 0,
+    model: str | None = None,
+) -> str:
+    """Get response from OpenAI API.
+
+    Args:
+        messages (list[dict]): List of messages to send to the API.
+        tg_id (int): The Telegram ID of the user the request is made for.
+        model (str | None): The model to use, None for the configured backends.
+
+    Returns:
+        str: Response from the API, empty if it has no text, e.g. a refusal.
+
+    """
+    async with app.llm_scheduler.slot(tg_id, estimate_tokens(messages)):
+        completion = await request_llm(
+            "completion",
+            lambda backend: create_completion(backend, messages=messages),
+            model=model,
+        )
+    record_llm_usage(completion.usage)
+    return completion.choices[0].message.content or ""
+
+
+@timed
+async def stream_chatgpt_response(
+    messages: list[dict],
+    tg_id: int = 0,
+    model: str | None = None,
+) -> AsyncIterator[str]:
+    """Stream response from OpenAI API chunk by chunk.
+
+    Args:
+        messages (list[dict]): List of messages to send to the API.
+        tg_id (int): The Telegram ID of the user the request is made for.
+        model (str | None): The model to use, None for the configured backends.
+
+    Yields:
+        str: Text chunks of the response as soon as they arrive.
+
+    """
+    async with app.llm_scheduler.slot(tg_id, estimate_tokens(messages)):
+        start = await request_llm(
+            "stream",
+            lambda backend: open_stream(backend, messages),
+            close=lambda start: start.stream.close(),
+            model=model,
+        )
+        async with start.stream:
+            if start.first:
+                yield start.first
+            async for chunk in start.chunks:
+                record_llm_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta: str | None = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
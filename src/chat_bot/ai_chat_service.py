@@ -1,14 +1,34 @@
-import json
+import asyncio
+from collections.abc import AsyncIterator
 
 from chat_bot import prompts
-from chat_bot.ai_chat_client import get_chatgpt_response
-from chat_bot.config import get_logger
+from chat_bot.ai_chat_client import get_chatgpt_response, stream_chatgpt_response
+from chat_bot.app import app
+from chat_bot.archive import rehydrate_history
+from chat_bot.compaction import schedule_compaction
+from chat_bot.config import get_logger, settings
 from chat_bot.enums import ChatMode
-from chat_bot.redis_crud import add_message, read_messages
+from chat_bot.redis_crud import (
+    ChatSession,
+    add_message,
+    add_message_and_read_session,
+    messages_key_from_tg_id,
+)
+from chat_bot.response_cache import cache_response, get_cache_key, get_cached_response
+from chat_bot.tokens import count_tokens, get_history_token_budget, select_history
+from chat_bot.utils import get_chat_mode
 
 log = get_logger(__name__)
 
 
+# System message of each chat mode, shared by the prompts and never modified
+BASE_PROMPTS: dict[ChatMode, dict] = {
+    ChatMode.STRICT: {"role": "system", "content": prompts.STRICT},
+    ChatMode.NEUTRAL: {"role": "system", "content": prompts.NEUTRAL},
+    ChatMode.CASUAL: {"role": "system", "content": prompts.CASUAL},
+}
+
+
 def get_base_prompt(mode: ChatMode) -> list[dict]:
     """Get the base prompt for the chat mode.
 
@@ -16,65 +36,204 @@ def get_base_prompt(mode: ChatMode) -> list[dict]:
         mode (ChatMode): The chat mode to use.
 
     Returns:
-        list[dict]: A list containing the system message for the chat mode.
+        list[dict]: A new list containing the system message for the chat mode.
 
     """
-    system_message: dict = {
-        "role": "system",
-        "content": (
-            prompts.NEUTRAL
-            if mode == ChatMode.NEUTRAL
-            else prompts.CASUAL
-            if mode == ChatMode.CASUAL
-            else prompts.STRICT
-        ),
-    }
-    return [system_message]
+    return [BASE_PROMPTS[mode]]
 
 
-async def handle_user_message(
+async def prepare_messages(
     tg_id: int,
     message_text: str,
-    mode: ChatMode = ChatMode.NEUTRAL,
-) -> str:
-    """Handle user message and get response from OpenAI.
+    mode: ChatMode | None,
+) -> tuple[list[dict], str | None]:
+    """Save the user message, pick the model and build the prompt for it.
+
+    The user message is saved and the chat history is read in a single Redis
+    round trip. Long histories are compacted in the background, expired ones are
+    restored from the archive. The model is picked by `app.model_router` from the
+    size of the message and the history and the chat mode.
 
     Args:
         tg_id (int): The Telegram ID of the user.
         message_text (str): The message text from the user.
-        mode (ChatMode): The chat mode to use.
+        mode (ChatMode | None): The chat mode to use, None to use the user's mode.
 
     Returns:
-        str: The response text from OpenAI.
+        tuple[list[dict], str | None]: The system prompt followed by the chat
+            history, and the model, None for the default one.
 
     """
-    log.debug("Current mode: %s", mode)
-    key = f"chat:{tg_id}:messages"
-
-    # 1. Save user message to Redis
-    user_msg: str = json.dumps({"role": "user", "content": message_text})
-    await add_message(key, user_msg)
-    log.debug("Key: %s, Message: %s", key, user_msg)
+    # 1. Save user message with its token count to Redis and read the session state
+    user_msg: dict = {"role": "user", "content": message_text}
+    stored_msg: dict = {**user_msg, "tokens": count_tokens(message_text)}
+    session: ChatSession = await add_message_and_read_session(
+        tg_id,
+        app.history_codec.encode(stored_msg),
+    )
+    log.debug("User: %s, Message: %s", tg_id, user_msg)
+
+    # The new message is alone if the history expired, restore it from the archive
+    if (
+        settings.ARCHIVE_REHYDRATE
+        and len(session.messages) == 1
+        and session.summary is None
+    ):
+        session.messages[:0] = await rehydrate_history(tg_id)
+    app.message_archive.add(tg_id, stored_msg)
 
     # 2. Prepare messages with system prompt
+    if mode is None:
+        mode = session.mode or await get_chat_mode(tg_id)
+    log.debug("Current mode: %s", mode)
     messages: list = get_base_prompt(mode)
 
-    # 3. Fetch previous messages from Redis
-    redis_messages: list[dict] = await read_messages(key)
-    if not redis_messages:
-        messages.append(dict(user_msg))
+    # 3. Route the message to a model
+    history_tokens: int = sum(
+        message.get("tokens") or count_tokens(message["content"])
+        for message in session.messages
+    )
+    if session.summary:
+        history_tokens += session.summary["tokens"]
+    model: str | None = app.model_router.route(
+        tg_id,
+        message_text,
+        stored_msg["tokens"],
+        history_tokens,
+        mode,
+    )
+
+    # 4. Add the summary of the compacted history
+    budget: int = get_history_token_budget(model)
+    if session.summary:
+        messages.append(
+            {
+                "role": "system",
+                "content": prompts.SUMMARY_CONTEXT + session.summary["content"],
+            },
+        )
+        budget -= session.summary["tokens"]
+
+    # 5. Add the newest messages from Redis that fit into the token budget
+    if not session.messages:
+        messages.append(user_msg)
     else:
-        messages.extend(redis_messages)
+        messages.extend(select_history(session.messages, budget))
+        schedule_compaction(tg_id, session)
 
     log.debug("\n\n\nMessages: %s\n\n\n", messages)
+    return messages, model
 
-    # 4. Fetch response from OpenAI
-    response_text = await get_chatgpt_response(messages)
-    log.info("AI response: %s", response_text)
 
-    # 5. Save response from OpenAI
-    assistant_msg = {"role": "assistant", "content": response_text}
-    await add_message(key, json.dumps(assistant_msg))
+async def save_response(tg_id: int, response_text: str) -> None:
+    """Save the response from OpenAI to the user's chat history.
+
+    Empty responses are not saved, they would only take room in the history.
+
+    Args:
+        tg_id (int): The Telegram ID of the user.
+        response_text (str): The response text from OpenAI.
+
+    """
+    if not response_text:
+        log.warning("Empty AI response not saved for user %s", tg_id)
+        return
+    log.debug("AI response: %s", response_text)
+    assistant_msg = {
+        "role": "assistant",
+        "content": response_text,
+        "tokens": count_tokens(response_text),
+    }
+    await add_message(
+        messages_key_from_tg_id(tg_id),
+        app.history_codec.encode(assistant_msg),
+    )
+    app.message_archive.add(tg_id, assistant_msg)
     log.debug("AI response saved")
 
+
+async def handle_user_message(
+    tg_id: int,
+    message_text: str,
+    mode: ChatMode | None = None,
+) -> str:
+    """Handle user message and get response from OpenAI.
+
+    Args:
+        tg_id (int): The Telegram ID of the user.
+        message_text (str): The message text from the user.
+        mode (ChatMode | None): The chat mode to use, None to use the user's mode.
+
+    Returns:
+        str: The response text from OpenAI.
+
+    """
+    messages, model = await prepare_messages(tg_id, message_text, mode)
+
+    cache_key: str | None = get_cache_key(messages, model or settings.MODEL)
+    if cache_key and (response_text := await get_cached_response(cache_key)):
+        await save_response(tg_id, response_text)
+        return response_text
+
+    response_text = await get_chatgpt_response(messages, tg_id, model)
+    await save_and_cache_response(tg_id, response_text, cache_key)
+
     return response_text
+
+
+async def stream_user_message(
+    tg_id: int,
+    message_text: str,
+    mode: ChatMode | None = None,
+) -> AsyncIterator[str]:
+    """Handle user message and stream the response from OpenAI.
+
+    The full response is saved to the chat history once the stream ends.
+
+    Args:
+        tg_id (int): The Telegram ID of the user.
+        message_text (str): The message text from the user.
+        mode (ChatMode | None): The chat mode to use, None to use the user's mode.
+
+    Yields:
+        str: Text chunks of the response as they arrive from OpenAI.
+
+    """
+    messages, model = await prepare_messages(tg_id, message_text, mode)
+
+    cache_key: str | None = get_cache_key(messages, model or settings.MODEL)
+    if cache_key and (response_text := await get_cached_response(cache_key)):
+        yield response_text
+        await save_response(tg_id, response_text)
+        return
+
+    chunks: list[str] = []
+    async for chunk in stream_chatgpt_response(messages, tg_id, model):
+        chunks.append(chunk)
+        yield chunk
+
+    await save_and_cache_response(tg_id, "".join(chunks), cache_key)
+
+
+async def save_and_cache_response(
+    tg_id: int,
+    response_text: str,
+    cache_key: str | None,
+) -> None:
+    """Save the response to the chat history and to the response cache.
+
+    Empty responses are not cached, they would be read back as misses.
+
+    Args:
+        tg_id (int): The Telegram ID of the user.
+        response_text (str): The response text from OpenAI.
+        cache_key (str | None): The response cache key, None to not cache it.
+
+    """
+    if cache_key is None or not response_text:
+        await save_response(tg_id, response_text)
+        return
+    await asyncio.gather(
+        save_response(tg_id, response_text),
+        cache_response(cache_key, response_text),
+    )
@@ -0,0 +1,304 @@
+import asyncio
+from functools import cached_property
+from typing import TYPE_CHECKING, Any
+
+from chat_bot.config import get_logger, settings
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+    from openai import AsyncOpenAI
+    from redis.asyncio import Redis
+    from redis.commands.core import AsyncScript
+    from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+    from chat_bot.archive import MessageArchive
+    from chat_bot.batch_writer import BatchWriter
+    from chat_bot.coalescer import MessageCoalescer
+    from chat_bot.enums import ChatMode
+    from chat_bot.history_codec import HistoryCodec
+    from chat_bot.llm_backends import LLMBackendPool
+    from chat_bot.llm_scheduler import LLMScheduler
+    from chat_bot.local_cache import LRUCache
+    from chat_bot.model_router import ModelRouter
+    from chat_bot.telegram_scheduler import TelegramScheduler
+
+log = get_logger(__name__)
+
+
+class Application:
+    """Clients of the services the bot depends on, and the state of the process.
+
+    Each client, cache and scheduler is created on first use rather than when the
+    package is imported, so imports are fast and free of side effects and don't
+    need the settings, e.g. for migrations and tools, and one can be replaced
+    before it's used, e.g. by benchmarks. `close` releases the clients that have
+    been created.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the application, without creating any client."""
+        self._openai_clients: dict[tuple[str | None, str | None], AsyncOpenAI] = {}
+
+    @cached_property
+    def bot(self) -> "Bot":
+        """Telegram bot, with HTML parse mode by default."""
+        from aiogram import Bot  # noqa: PLC0415
+        from aiogram.client.default import DefaultBotProperties  # noqa: PLC0415
+        from aiogram.enums import ParseMode  # noqa: PLC0415
+
+        from chat_bot.telegram_metrics import TelegramMetricsMiddleware  # noqa: PLC0415
+        from chat_bot.telegram_scheduler import (  # noqa: PLC0415
+            TelegramSchedulerMiddleware,
+        )
+
+        bot = Bot(
+            token=settings.BOT_TOKEN,
+            default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+        )
+        # The first middleware is the outermost, so requests are timed once sent
+        if settings.TELEGRAM_SCHEDULER_ENABLED:
+            bot.session.middleware(TelegramSchedulerMiddleware())
+        bot.session.middleware(TelegramMetricsMiddleware())
+        return bot
+
+    @cached_property
+    def openai_client(self) -> "AsyncOpenAI":
+        """OpenAI client, without retries, which are done by `request_llm`."""
+        from openai import AsyncOpenAI  # noqa: PLC0415
+
+        return AsyncOpenAI(api_key=settings.API_KEY, max_retries=0)
+
+    def get_openai_client(
+        self,
+        base_url: str | None = None,
+        api_key: str | None = None,
+    ) -> "AsyncOpenAI":
+        """Get the client of an OpenAI-compatible API.
+
+        Args:
+            base_url (str | None): The base URL of the API, None for OpenAI.
+            api_key (str | None): The API key, None for `API_KEY`.
+
+        Returns:
+            AsyncOpenAI: The client, shared by the calls with the same arguments.
+
+        """
+        if base_url is None and api_key is None:
+            return self.openai_client
+        key = (base_url, api_key)
+        if key not in self._openai_clients:
+            from openai import AsyncOpenAI  # noqa: PLC0415
+
+            self._openai_clients[key] = AsyncOpenAI(
+                base_url=base_url,
+                api_key=api_key or settings.API_KEY,
+                max_retries=0,
+            )
+        return self._openai_clients[key]
+
+    @cached_property
+    def engine(self) -> "AsyncEngine":
+        """Database engine."""
+        from sqlalchemy.ext.asyncio import create_async_engine  # noqa: PLC0415
+
+        return create_async_engine(url=settings.get_postgres_url())
+
+    @cached_property
+    def session_maker(self) -> "async_sessionmaker[AsyncSession]":
+        """Factory of database sessions."""
+        from sqlalchemy.ext.asyncio import async_sessionmaker  # noqa: PLC0415
+
+        return async_sessionmaker(self.engine, expire_on_commit=False)
+
+    @cached_property
+    def redis(self) -> "Redis":
+        """Redis client decoding the responses to strings."""
+        from redis.asyncio import Redis  # noqa: PLC0415
+
+        return Redis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=settings.REDIS_DB,
+            decode_responses=True,
+        )
+
+    @cached_property
+    def history_redis(self) -> "Redis":
+        """Redis client for the chat history, whose entries may be binary."""
+        from redis.asyncio import Redis  # noqa: PLC0415
+
+        return Redis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=settings.REDIS_DB,
+        )
+
+    @cached_property
+    def history_codec(self) -> "HistoryCodec":
+        """Codec of the chat history entries stored in Redis."""
+        from chat_bot.history_codec import HistoryCodec  # noqa: PLC0415
+
+        return HistoryCodec(
+            format=settings.HISTORY_FORMAT,
+            compression=settings.HISTORY_COMPRESSION,
+            compression_min_bytes=settings.HISTORY_COMPRESSION_MIN_BYTES,
+        )
+
+    @cached_property
+    def chat_mode_cache(self) -> "LRUCache[int, ChatMode]":
+        """Process-local cache in front of the Redis cache of chat modes."""
+        from chat_bot.local_cache import LRUCache  # noqa: PLC0415
+        from chat_bot.metrics import cache_requests  # noqa: PLC0415
+
+        cache: LRUCache[int, ChatMode] = LRUCache(
+            maxsize=settings.MODE_CACHE_MAX_SIZE,
+            ttl=settings.MODE_CACHE_TTL_SECONDS,
+        )
+        cache_requests.set_function(lambda: cache.hits, "chat_mode", "hit")
+        cache_requests.set_function(lambda: cache.misses, "chat_mode", "miss")
+        cache_requests.set_function(lambda: cache.evictions, "chat_mode", "eviction")
+        return cache
+
+    @cached_property
+    def coalescer(self) -> "MessageCoalescer":
+        """Coalescer of the bursts of messages from a chat into a single turn."""
+        from chat_bot.coalescer import MessageCoalescer  # noqa: PLC0415
+
+        return MessageCoalescer(window=settings.COALESCE_WINDOW_MS / 1000)
+
+    @cached_property
+    def registration_writer(self) -> "BatchWriter[int, str]":
+        """Writer inserting the registrations arriving within a short window."""
+        from chat_bot.batch_writer import BatchWriter  # noqa: PLC0415
+        from chat_bot.crud import insert_users  # noqa: PLC0415
+
+        return BatchWriter(
+            write=insert_users,
+            window=settings.REGISTRATION_BATCH_WINDOW_MS / 1000,
+            max_size=settings.REGISTRATION_BATCH_MAX_SIZE,
+        )
+
+    @cached_property
+    def message_archive(self) -> "MessageArchive":
+        """Write-behind archive of the chat history in the database."""
+        from chat_bot.archive import MessageArchive  # noqa: PLC0415
+
+        return MessageArchive(
+            batch_size=settings.ARCHIVE_BATCH_SIZE,
+            flush_interval=settings.ARCHIVE_FLUSH_INTERVAL_SECONDS,
+            max_pending=settings.ARCHIVE_MAX_PENDING,
+        )
+
+    @cached_property
+    def llm_backends(self) -> "LLMBackendPool":
+        """The LLM backends, the default one using `MODEL` if none is configured."""
+        from chat_bot.llm_backends import LLMBackendPool, load_backends  # noqa: PLC0415
+
+        return LLMBackendPool(load_backends(settings.LLM_BACKENDS))
+
+    @cached_property
+    def llm_scheduler(self) -> "LLMScheduler":
+        """Scheduler of the OpenAI requests."""
+        from chat_bot.llm_scheduler import LLMScheduler  # noqa: PLC0415
+        from chat_bot.metrics import (  # noqa: PLC0415
+            llm_active_requests,
+            llm_queue_depth,
+            llm_rate_limited,
+        )
+
+        scheduler = LLMScheduler(
+            max_concurrency=settings.LLM_MAX_CONCURRENCY,
+            tokens_per_minute=settings.LLM_TOKENS_PER_MINUTE,
+        )
+        llm_queue_depth.set_function(lambda: scheduler.queue_depth)
+        llm_active_requests.set_function(lambda: scheduler.active)
+        llm_rate_limited.set_function(lambda: scheduler.rate_limited)
+        return scheduler
+
+    @cached_property
+    def model_router(self) -> "ModelRouter":
+        """Router of the messages to the model tiers."""
+        from chat_bot.model_router import ModelRouter, ModelTier  # noqa: PLC0415
+
+        return ModelRouter(
+            [ModelTier.from_settings(tier) for tier in settings.MODEL_TIERS],
+        )
+
+    @cached_property
+    def telegram_scheduler(self) -> "TelegramScheduler":
+        """Scheduler of the Telegram requests to chats."""
+        from chat_bot.metrics import telegram_outbound_queue_depth  # noqa: PLC0415
+        from chat_bot.telegram_scheduler import TelegramScheduler  # noqa: PLC0415
+
+        scheduler = TelegramScheduler(
+            rate=settings.TELEGRAM_GLOBAL_RATE_PER_SECOND,
+            burst=settings.TELEGRAM_GLOBAL_BURST,
+            chat_rate=settings.TELEGRAM_CHAT_RATE_PER_SECOND,
+            chat_burst=settings.TELEGRAM_CHAT_BURST,
+        )
+        telegram_outbound_queue_depth.set_function(
+            lambda: scheduler.queue_depth,
+        )
+        return scheduler
+
+    async def warm_up(self) -> None:
+        """Create the clients loaded lazily before they are first needed.
+
+        The imports run in a thread, so the updates are handled meanwhile instead
+        of the first ones waiting for them.
+        """
+        await asyncio.to_thread(lambda: self.openai_client)
+        log.info("Application clients warmed up")
+
+    async def close(self) -> None:
+        """Close the clients that have been created."""
+        created = vars(self)
+        if "bot" in created:
+            await self.bot.session.close()
+        if "openai_client" in created:
+            await self.openai_client.close()
+        for client in self._openai_clients.values():
+            await client.close()
+        if "redis" in created:
+            await self.redis.aclose()
+        if "history_redis" in created:
+            await self.history_redis.aclose()
+        if "engine" in created:
+            await self.engine.dispose()
+        log.info("Application clients closed")
+
+
+app = Application()
+
+
+class LazyScript:
+    """Lua script registered on a Redis client of the application on first call."""
+
+    def __init__(self, script: str, client: str = "redis") -> None:
+        """Initialize the script.
+
+        Args:
+            script (str): The source of the script.
+            client (str): The attribute of the application with the client to run
+                the script on.
+
+        """
+        self.script = script
+        self.client = client
+        self._registered: AsyncScript | None = None
+
+    async def __call__(self, keys: list, args: list) -> Any:  # noqa: ANN401
+        """Run the script.
+
+        Args:
+            keys (list): The keys the script accesses.
+            args (list): The other arguments of the script.
+
+        Returns:
+            Any: The result of the script.
+
+        """
+        if self._registered is None:
+            client: Redis = getattr(app, self.client)
+            self._registered = client.register_script(self.script)
+        return await self._registered(keys=keys, args=args)
@@ -0,0 +1,157 @@
+import asyncio
+import contextlib
+from collections import deque
+
+from chat_bot.app import app
+from chat_bot.config import get_logger, settings
+from chat_bot.metrics import archived_messages, timed
+from chat_bot.redis_crud import is_history_reset, prepend_messages
+
+log = get_logger(__name__)
+
+# Time given to the pending messages to be written on shutdown
+SHUTDOWN_TIMEOUT_SECONDS = 10
+
+
+class MessageArchive:
+    """Write-behind archive of the chat history in the database.
+
+    Messages are queued without waiting for the database and written in batches
+    by a background task. The queue is bounded, messages are dropped when it's
+    full, e.g. while the database is unavailable.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        flush_interval: float,
+        max_pending: int,
+    ) -> None:
+        """Initialize the archive.
+
+        Args:
+            batch_size (int): Maximum number of messages written at once.
+            flush_interval (float): Maximum delay before writing a message in seconds.
+            max_pending (int): Maximum number of messages waiting to be written.
+
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: deque[dict] = deque()
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task: asyncio.Task | None = None
+
+    def add(self, tg_id: int, message: dict) -> None:
+        """Queue a message to be archived.
+
+        Args:
+            tg_id (int): The Telegram ID of the user.
+            message (dict): The message with role, content and optional tokens.
+
+        """
+        if self._task is None:
+            return
+        if len(self._pending) >= self.max_pending:
+            archived_messages.labels("dropped").inc()
+            log.warning("Message archive queue is full, dropping: tg_id=%s", tg_id)
+            return
+        self._pending.append(
+            {
+                "tg_id": tg_id,
+                "role": message["role"],
+                "content": message["content"],
+                "tokens": message.get("tokens", 0),
+            },
+        )
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def add_reset(self, tg_id: int) -> None:
+        """Queue a reset of the user's chat history."""
+        from chat_bot.crud import RESET_ROLE  # noqa: PLC0415
+
+        self.add(tg_id, {"role": RESET_ROLE, "content": ""})
+
+    def start(self) -> None:
+        """Start writing the queued messages in the background."""
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = SHUTDOWN_TIMEOUT_SECONDS) -> None:  # noqa: ASYNC109
+        """Write the queued messages and stop.
+
+        Args:
+            timeout (float): Maximum time to wait for the messages to be written.
+
+        """
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except TimeoutError:
+            log.warning("Message archive not flushed: %s pending", len(self._pending))
+        self._task = None
+
+    async def _run(self) -> None:
+        while not (self._closing and not self._pending):
+            if not self._closing and len(self._pending) < self.batch_size:
+                # Wait for a full batch, the flush interval or shutdown
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            self._wakeup.clear()
+            batch = [
+                self._pending.popleft()
+                for _ in range(min(self.batch_size, len(self._pending)))
+            ]
+            if batch:
+                await self._write(batch)
+
+    async def _write(self, batch: list[dict]) -> None:
+        from chat_bot.crud import insert_messages  # noqa: PLC0415
+
+        try:
+            await insert_messages(batch)
+        except Exception:
+            archived_messages.labels("dropped").inc(len(batch))
+            log.exception("Failed to archive %s messages", len(batch))
+        else:
+            archived_messages.labels("archived").inc(len(batch))
+
+
+@timed
+async def rehydrate_history(tg_id: int) -> list[dict]:
+    """Restore the chat history of a user from the archive after it expired in Redis.
+
+    The history is not restored if it has been reset recently, as the reset may
+    not be archived yet.
+
+    Args:
+        tg_id (int): The Telegram ID of the user.
+
+    Returns:
+        list[dict]: The restored messages with role, content and tokens, oldest
+            first. Empty if there is nothing to restore or an error occurred.
+
+    """
+    from chat_bot.crud import read_archived_messages  # noqa: PLC0415
+
+    try:
+        if await is_history_reset(tg_id):
+            return []
+        # Leave room for the message that started the new session
+        messages = await read_archived_messages(
+            tg_id,
+            settings.REDIS_MAX_MESSAGES - 1,
+        )
+        if not messages:
+            return []
+        await prepend_messages(tg_id, list(map(app.history_codec.encode, messages)))
+    except Exception:
+        log.exception("Failed to rehydrate chat history: tg_id=%s", tg_id)
+        return []
+    log.info("Chat history rehydrated: tg_id=%s, messages=%s", tg_id, len(messages))
+    return messages
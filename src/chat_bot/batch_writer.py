@@ -0,0 +1,85 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+
+from chat_bot.config import get_logger
+
+log = get_logger(__name__)
+
+
+class BatchWriter[K, V]:
+    """Group writes arriving within a short window into a single batch.
+
+    A batch is written when the window since its first item has passed or it
+    reached `max_size` items. Items with the same key are written once.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[dict[K, V]], Awaitable[set[K]]],
+        window: float,
+        max_size: int,
+    ) -> None:
+        """Initialize the writer.
+
+        Args:
+            write (Callable[[dict[K, V]], Awaitable[set[K]]]): Writes a batch of
+                items and returns the keys of the items that were written.
+            window (float): Time to wait for more items in seconds.
+            max_size (int): Maximum number of items in a batch.
+
+        """
+        self.write = write
+        self.window = window
+        self.max_size = max_size
+        self._batch: dict[K, V] = {}
+        self._result: asyncio.Future[set[K]] | None = None
+        self._timer: asyncio.TimerHandle | None = None
+        # References to the running writes, so they are not garbage collected
+        self._tasks: set[asyncio.Task] = set()
+
+    async def add(self, key: K, value: V) -> bool:
+        """Add an item to the current batch and wait until the batch is written.
+
+        Args:
+            key (K): The key of the item.
+            value (V): The item.
+
+        Returns:
+            bool: True if the item was written, False if `write` skipped it.
+
+        Raises:
+            Exception: The exception raised by `write` for the batch.
+
+        """
+        loop = asyncio.get_running_loop()
+        if self._result is None:
+            self._result = loop.create_future()
+            self._timer = loop.call_later(self.window, self._flush)
+        self._batch[key] = value
+        result = self._result
+        if len(self._batch) >= self.max_size:
+            self._flush()
+        # The result is shared by the batch, a cancelled caller must not cancel it
+        written: set[K] = await asyncio.shield(result)
+        return key in written
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, result = self._batch, self._result
+        self._batch, self._result = {}, None
+        if result is None:
+            return
+        task = asyncio.create_task(self._write_batch(batch, result))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write_batch(self, batch: dict[K, V], result: asyncio.Future) -> None:
+        log.debug("Writing batch of %s items", len(batch))
+        try:
+            written = await self.write(batch)
+        except Exception as e:  # noqa: BLE001
+            result.set_exception(e)
+        else:
+            result.set_result(written)
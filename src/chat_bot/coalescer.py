@@ -0,0 +1,65 @@
+import asyncio
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+from chat_bot.config import get_logger
+
+log = get_logger(__name__)
+
+
+class MessageCoalescer:
+    """Merge messages of a chat that arrive in a burst into a single turn.
+
+    The first message of a burst waits `window` seconds and for the previous turn
+    of the chat to finish. Messages that arrive in the meantime are appended to
+    it and handled by the same turn, so turns of a chat never overlap.
+    """
+
+    def __init__(self, window: float) -> None:
+        """Initialize the coalescer.
+
+        Args:
+            window (float): Time to wait for more messages in seconds.
+
+        """
+        self._window = window
+        self._pending: dict[int, list[str]] = {}
+        self._locks: dict[int, asyncio.Lock] = {}
+
+    @asynccontextmanager
+    async def turn(self, chat_id: int, text: str) -> AsyncIterator[str | None]:
+        """Join the next turn of the chat.
+
+        Args:
+            chat_id (int): The chat ID.
+            text (str): The message text.
+
+        Yields:
+            (str | None): The merged text of all messages of the turn if the caller
+                has to handle the turn, None if the message was merged into a turn
+                handled by another caller.
+
+        """
+        pending: list[str] | None = self._pending.get(chat_id)
+        if pending is not None:
+            pending.append(text)
+            log.debug("Message merged into the next turn: chat_id=%s", chat_id)
+            yield None
+            return
+
+        pending = self._pending[chat_id] = [text]
+        lock: asyncio.Lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            if self._window > 0:
+                await asyncio.sleep(self._window)
+            async with lock:
+                del self._pending[chat_id]
+                if len(pending) > 1:
+                    log.info("Merged %s messages: chat_id=%s", len(pending), chat_id)
+                yield "\n\n".join(pending)
+        finally:
+            # Drop the messages if the turn was cancelled before it started
+            if self._pending.get(chat_id) is pending:
+                del self._pending[chat_id]
+            if not lock.locked() and chat_id not in self._pending:
+                self._locks.pop(chat_id, None)
@@ -0,0 +1,131 @@
+import asyncio
+import json
+
+from chat_bot import prompts
+from chat_bot.ai_chat_client import get_chatgpt_response
+from chat_bot.app import app
+from chat_bot.config import get_logger, settings
+from chat_bot.redis_crud import (
+    ChatSession,
+    messages_key_from_tg_id,
+    read_raw_messages,
+    replace_messages_with_summary,
+)
+from chat_bot.tokens import count_tokens
+
+log = get_logger(__name__)
+
+# Running compaction tasks by Telegram ID, also keeps references to the tasks
+compaction_tasks: dict[int, asyncio.Task] = {}
+
+
+def needs_compaction(messages: list[dict]) -> bool:
+    """Check whether the chat history is long enough to be compacted.
+
+    Args:
+        messages (list[dict]): Chat history with token counts, oldest first.
+
+    Returns:
+        bool: True if the history passed one of the compaction thresholds.
+
+    """
+    if len(messages) <= settings.COMPACTION_KEEP_MESSAGES:
+        return False
+    if len(messages) >= settings.COMPACTION_TRIGGER_MESSAGES:
+        return True
+    tokens = sum(
+        message.get("tokens") or count_tokens(message["content"])
+        for message in messages
+    )
+    return tokens >= settings.COMPACTION_TRIGGER_TOKENS
+
+
+def schedule_compaction(tg_id: int, session: ChatSession) -> None:
+    """Start compacting the chat history in the background if it's needed.
+
+    Args:
+        tg_id (int): The Telegram ID of the user.
+        session (ChatSession): The current session state of the user.
+
+    """
+    if (
+        not settings.COMPACTION_ENABLED
+        or tg_id in compaction_tasks
+        or not needs_compaction(session.messages)
+    ):
+        return
+    log.info("Scheduling chat history compaction: tg_id=%s", tg_id)
+    task = asyncio.create_task(compact_history(tg_id, session.summary))
+    compaction_tasks[tg_id] = task
+    task.add_done_callback(lambda _: compaction_tasks.pop(tg_id, None))
+
+
+async def cancel_compactions() -> int:
+    """Cancel the running compactions and wait for them to stop, e.g. on shutdown.
+
+    The chat histories are left as they were, they're compacted again on the next
+    message.
+
+    Returns:
+        int: Number of cancelled compactions.
+
+    """
+    tasks = list(compaction_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return len(tasks)
+
+
+async def compact_history(tg_id: int, summary: dict | None) -> bool:
+    """Fold the oldest messages of the chat history into the summary.
+
+    The newest `COMPACTION_KEEP_MESSAGES` messages are kept as they are.
+
+    Args:
+        tg_id (int): The Telegram ID of the user.
+        summary (dict | None): The current summary of the chat history.
+
+    Returns:
+        bool: True if the history was compacted, False otherwise.
+
+    """
+    values: list[bytes] = await read_raw_messages(messages_key_from_tg_id(tg_id))
+    summarized: list[bytes] = values[: -settings.COMPACTION_KEEP_MESSAGES]
+    if not summarized:
+        return False
+
+    transcript = "\n\n".join(
+        f"{message['role']}: {message['content']}"
+        for message in map(app.history_codec.decode, summarized)
+    )
+    if summary:
+        transcript = (
+            f"Previous summary:\n{summary['content']}\n\nNew messages:\n{transcript}"
+        )
+
+    try:
+        summary_text: str = await get_chatgpt_response(
+            [
+                {"role": "system", "content": prompts.SUMMARY},
+                {"role": "user", "content": transcript},
+            ],
+            tg_id,
+        )
+    except Exception:
+        log.exception("Failed to summarize chat history: tg_id=%s", tg_id)
+        return False
+
+    new_summary = {"content": summary_text, "tokens": count_tokens(summary_text)}
+    compacted = await replace_messages_with_summary(
+        tg_id,
+        summarized,
+        json.dumps(new_summary),
+    )
+    log.info(
+        "Chat history compaction: tg_id=%s, messages=%s, compacted=%s",
+        tg_id,
+        len(summarized),
+        compacted,
+    )
+    return compacted
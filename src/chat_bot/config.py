@@ -1,8 +1,42 @@
 import logging
+import queue
+from functools import cache
+from logging.handlers import QueueListener
 from pathlib import Path
+from typing import Literal, cast
 
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from chat_bot.log_handlers import (
+    DeferredQueueHandler,
+    RedactingFormatter,
+    SamplingFilter,
+)
+
+
+class LLMBackendSettings(BaseModel):
+    """An OpenAI-compatible API serving a model, see `Settings.LLM_BACKENDS`."""
+
+    name: str
+    model: str
+    base_url: str | None = None
+    api_key: str | None = None
+
+
+class ModelTierSettings(BaseModel):
+    """A model messages are routed to, see `Settings.MODEL_TIERS`.
+
+    A message is routed to the tier if it meets all the conditions that are set.
+    """
+
+    model: str
+    max_message_tokens: int | None = None
+    max_history_tokens: int | None = None
+    modes: list[Literal["STRICT", "NEUTRAL", "CASUAL"]] | None = None
+    pattern: str | None = None
+    exclude_pattern: str | None = None
+
 
 class Settings(BaseSettings):
     """Settings class for the application.
@@ -14,9 +48,54 @@ class Settings(BaseSettings):
     # Telegram Bot token
     BOT_TOKEN: str
 
+    # Webhook mode, long polling is used if disabled
+    WEBHOOK_ENABLED: bool = False
+    WEBHOOK_URL: str = ""
+    WEBHOOK_PATH: str = "/webhook"
+    WEBHOOK_SECRET: str = ""
+    WEBHOOK_HOST: str = "0.0.0.0"  # noqa: S104
+    WEBHOOK_PORT: int = 8080
+    WEBHOOK_DELETE_ON_SHUTDOWN: bool = False
+    WEBHOOK_SHUTDOWN_TIMEOUT_SECONDS: float = 30
+
+    # Split receiving and handling updates between processes through Redis Streams
+    PROCESS_ROLE: Literal["standalone", "ingest", "worker", "supervisor"] = "standalone"
+    STREAM_PARTITIONS: int = 16
+    STREAM_MAX_LENGTH: int = 100_000
+    STREAM_WORKER_NAME: str = ""
+    STREAM_WORKER_MAX_TASKS: int = 256
+    STREAM_LEASE_SECONDS: float = 15
+    STREAM_SHUTDOWN_TIMEOUT_SECONDS: float = 30
+
+    # Stream worker processes run by a supervisor, 0 for one per CPU core
+    SUPERVISOR_WORKERS: int = 0
+    SUPERVISOR_RESTART_DELAY_SECONDS: float = 1
+
+    # Admission control of the incoming messages, 0 disables a limit
+    RATE_LIMIT_USER_PER_MINUTE: float = 0
+    RATE_LIMIT_USER_BURST: int = 10
+    RATE_LIMIT_GLOBAL_PER_SECOND: float = 0
+    RATE_LIMIT_GLOBAL_BURST: int = 100
+    ADMISSION_MAX_LLM_QUEUE_DEPTH: int = 0
+
     # OpenAI API settings
     API_KEY: str
     MODEL: str
+    LLM_MAX_CONCURRENCY: int = 32
+    LLM_TOKENS_PER_MINUTE: int = 0
+    LLM_EXPECTED_COMPLETION_TOKENS: int = 500
+    LLM_MAX_RETRIES: int = 3
+    LLM_BACKOFF_BASE_SECONDS: float = 1.0
+    LLM_BACKOFF_MAX_SECONDS: float = 60.0
+
+    # LLM backends requests are routed, hedged and failed over between
+    LLM_BACKENDS: list[LLMBackendSettings] = []
+    LLM_HEDGE_DELAY_MS: int = 0
+    LLM_BACKEND_ERROR_COOLDOWN_SECONDS: float = 30
+    LLM_BACKEND_LATENCY_DECAY: float = 0.2
+
+    # Route each message to the first matching model tier, MODEL otherwise
+    MODEL_TIERS: list[ModelTierSettings] = []
 
     # PostgreSQL
     POSTGRES_HOST: str = "localhost"
@@ -25,6 +104,10 @@ class Settings(BaseSettings):
     POSTGRES_USER: str
     POSTGRES_PASSWORD: str
 
+    # Insert registrations arriving within a short window in a single statement
+    REGISTRATION_BATCH_WINDOW_MS: int = 0
+    REGISTRATION_BATCH_MAX_SIZE: int = 500
+
     # Redis
     REDIS_HOST: str = "localhost"
     REDIS_PORT: int = 6379
@@ -32,9 +115,72 @@ class Settings(BaseSettings):
     REDIS_TTL_HOURS: int = 12
     REDIS_MAX_MESSAGES: int = 40
 
+    # Encoding of the chat history entries
+    HISTORY_FORMAT: Literal["json", "msgpack"] = "json"
+    HISTORY_COMPRESSION: Literal["none", "zstd", "lz4"] = "none"
+    HISTORY_COMPRESSION_MIN_BYTES: int = 512
+
+    # Durable archive of the chat history in the database
+    ARCHIVE_ENABLED: bool = True
+    ARCHIVE_REHYDRATE: bool = True
+    ARCHIVE_BATCH_SIZE: int = 500
+    ARCHIVE_FLUSH_INTERVAL_SECONDS: float = 1.0
+    ARCHIVE_MAX_PENDING: int = 10_000
+
+    # Chat history sent to the model
+    HISTORY_TOKEN_BUDGET: int = 4000
+    MODEL_HISTORY_TOKEN_BUDGETS: dict[str, int] = {}
+
+    # Chat history compaction
+    COMPACTION_ENABLED: bool = True
+    COMPACTION_TRIGGER_MESSAGES: int = 30
+    COMPACTION_TRIGGER_TOKENS: int = 3000
+    COMPACTION_KEEP_MESSAGES: int = 10
+
+    # Cache of responses to prompts with a short history
+    RESPONSE_CACHE_ENABLED: bool = False
+    RESPONSE_CACHE_MAX_HISTORY: int = 0
+    RESPONSE_CACHE_TTL_SECONDS: int = 24 * 60 * 60
+    RESPONSE_CACHE_MAX_ENTRIES: int = 10_000
+
+    # Process-local chat mode cache
+    MODE_CACHE_MAX_SIZE: int = 10_000
+    MODE_CACHE_TTL_SECONDS: float = 300
+
+    # Merge messages sent in a burst into a single turn
+    COALESCE_WINDOW_MS: int = 0
+
+    # Cancel the turn in progress when a new message of the chat arrives
+    CANCEL_SUPERSEDED_TURNS: bool = False
+
+    # Outbound Telegram requests, shaped to the flood limits of the Bot API
+    TELEGRAM_SCHEDULER_ENABLED: bool = True
+    TELEGRAM_GLOBAL_RATE_PER_SECOND: float = 30
+    TELEGRAM_GLOBAL_BURST: int = 30
+    TELEGRAM_CHAT_RATE_PER_SECOND: float = 1
+    TELEGRAM_CHAT_BURST: int = 3
+
+    # Streaming responses
+    STREAM_RESPONSES: bool = True
+    STREAM_EDIT_INTERVAL_SECONDS: float = 1.0
+
+    # Reply in a single message after a typing action, instead of a wait message
+    TYPING_REPLIES: bool = False
+    TYPING_INTERVAL_SECONDS: float = 4
+
+    # Prometheus metrics
+    METRICS_ENABLED: bool = True
+    METRICS_HOST: str = "0.0.0.0"  # noqa: S104
+    METRICS_PORT: int = 8000
+
     # Basic settings
     LOG_LEVEL: str = "INFO"
 
+    # Logging of frequent messages
+    LOG_SAMPLE_RATE_PER_SECOND: float = 5
+    LOG_SAMPLE_BURST: int = 20
+    LOG_MAX_MESSAGE_LENGTH: int = 500
+
     model_config = SettingsConfigDict(env_file=".env")
 
     @property
@@ -55,22 +201,84 @@ class Settings(BaseSettings):
         )
 
 
-settings = Settings()
+@cache
+def get_settings() -> Settings:
+    """Load the settings from the environment and the `.env` file, once."""
+    return Settings()
+
+
+class LazySettings:
+    """Settings loaded on first attribute access rather than on import.
+
+    So the modules that don't read the settings when imported, e.g. the models
+    used by the migrations, can be imported without the environment.
+    """
+
+    def __getattr__(self, name: str) -> object:
+        """Get a setting, loading the settings if needed."""
+        return getattr(get_settings(), name)
+
+
+settings = cast("Settings", LazySettings())
+
+
+def configure_logging() -> QueueListener:
+    """Log to the console and to `logs/app.log` from a background thread.
 
-# Logger configuration
-Path("logs").mkdir(parents=True, exist_ok=True)
+    Records are only filtered by the threads that log, e.g. the event loop, the
+    listener thread formats and writes them. Called by the entry point rather
+    than on import, so importing the package doesn't create the log file. The
+    errors logged by the bot are counted in `chat_bot_log_errors_total`.
 
-LOG_LEVEL = settings.LOG_LEVEL.upper()
+    Returns:
+        QueueListener: The started listener, to stop on exit so the queued records
+            are written.
 
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL, logging.INFO),
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[
+    """
+    from chat_bot.metrics import ErrorCountingHandler  # noqa: PLC0415
+
+    Path("logs").mkdir(parents=True, exist_ok=True)
+    log_level = settings.LOG_LEVEL.upper()
+    formatter = RedactingFormatter(
+        fmt="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        max_message_length=settings.LOG_MAX_MESSAGE_LENGTH,
+        secrets=[
+            settings.BOT_TOKEN,
+            settings.API_KEY,
+            settings.POSTGRES_PASSWORD,
+            settings.WEBHOOK_SECRET,
+            *(backend.api_key or "" for backend in settings.LLM_BACKENDS),
+        ],
+    )
+    handlers: list[logging.Handler] = [
         logging.StreamHandler(),
         logging.FileHandler("logs/app.log"),
-    ],
-)
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(
+        SamplingFilter(
+            rate=settings.LOG_SAMPLE_RATE_PER_SECOND,
+            burst=settings.LOG_SAMPLE_BURST,
+        ),
+    )
+    logging.basicConfig(
+        level=getattr(logging, log_level, logging.INFO),
+        handlers=[queue_handler],
+    )
+    # Counted before sampling, so the metric has every error
+    logging.getLogger("chat_bot").addHandler(ErrorCountingHandler(logging.ERROR))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+    effective_level: str = logging.getLevelName(log.getEffectiveLevel())
+    log.debug("Configured LOG_LEVEL: %s", log_level)
+    log.info("Effective LOG_LEVEL: %s", effective_level)
+    return listener
 
 
 def get_logger(name: str) -> logging.Logger:
@@ -79,6 +287,3 @@ def get_logger(name: str) -> logging.Logger:
 
 
 log = get_logger(__name__)
-effective_level: str = logging.getLevelName(log.getEffectiveLevel())
-log.debug("Configured LOG_LEVEL: %s", LOG_LEVEL)
-log.info("Effective LOG_LEVEL: %s", effective_level)
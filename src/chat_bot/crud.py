@@ -1,14 +1,19 @@
-from sqlalchemy import select
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from chat_bot.config import get_logger
-from chat_bot.database import async_session_maker
+from chat_bot.app import app
+from chat_bot.config import get_logger, settings
 from chat_bot.enums import ChatMode
-from chat_bot.models import User
+from chat_bot.metrics import timed
+from chat_bot.models import Message, User
 
 # Get configured logger
 log = get_logger(__name__)
 
+# Role of the archived entries that mark a reset of the chat history
+RESET_ROLE = "reset"
+
 
 async def get_user_by_tg_id(session: AsyncSession, tg_id: int) -> User | None:
     """Retrieve a user from the database by their Telegram ID.
@@ -26,6 +31,34 @@ async def get_user_by_tg_id(session: AsyncSession, tg_id: int) -> User | None:
     return result.scalar_one_or_none()
 
 
+async def insert_users(users: dict[int, str]) -> set[int]:
+    """Insert new users into the database, skipping the existing ones.
+
+    Args:
+        users (dict[int, str]): First names of the users by Telegram ID.
+
+    Returns:
+        set[int]: Telegram IDs of the users that were created.
+
+    """
+    stmt = (
+        insert(User)
+        .values(
+            [
+                {"tg_id": tg_id, "first_name": first_name}
+                for tg_id, first_name in users.items()
+            ],
+        )
+        .on_conflict_do_nothing(index_elements=[User.tg_id])
+        .returning(User.tg_id)
+    )
+    async with app.session_maker() as session:
+        result = await session.execute(stmt)
+        await session.commit()
+    return set(result.scalars())
+
+
+@timed
 async def create_user(tg_id: int, first_name: str) -> bool:
     """Create a new user in the database if the given Telegram ID does not exist.
 
@@ -39,28 +72,20 @@ async def create_user(tg_id: int, first_name: str) -> bool:
 
     """
     log.info("Creating new user with tg_id=%s", tg_id)
-    async with async_session_maker() as session:
-        try:
-            user = await get_user_by_tg_id(session=session, tg_id=tg_id)
-            if user:
-                log.info("User with tg_id=%s already exists", tg_id)
-            else:
-                new_user = User(tg_id=tg_id, first_name=first_name)
-                session.add(new_user)
-                await session.commit()
-                await session.refresh(new_user)
-                log.info(
-                    "User created: user_id=%s, tg_id=%s, first_name=%s",
-                    new_user.id,
-                    tg_id,
-                    first_name,
-                )
-        except Exception:
-            log.exception("Failed to create or check user")
-            return False
-
+    try:
+        if settings.REGISTRATION_BATCH_WINDOW_MS > 0:
+            created = await app.registration_writer.add(tg_id, first_name)
         else:
-            return True
+            created = tg_id in await insert_users({tg_id: first_name})
+    except Exception:
+        log.exception("Failed to create or check user")
+        return False
+
+    if created:
+        log.info("User created: tg_id=%s, first_name=%s", tg_id, first_name)
+    else:
+        log.info("User with tg_id=%s already exists", tg_id)
+    return True
 
 
 async def set_user_chat_mode(tg_id: int, chat_mode: ChatMode) -> bool:
@@ -74,14 +99,14 @@ async def set_user_chat_mode(tg_id: int, chat_mode: ChatMode) -> bool:
         bool: True if the chat mode was successfully set, False otherwise.
 
     """
-    async with async_session_maker() as session:
+    async with app.session_maker() as session:
         try:
             user = await get_user_by_tg_id(session=session, tg_id=tg_id)
             if not user:
                 log.info("User with tg_id=%s not found", tg_id)
                 return False
             user.chat_mode = chat_mode
-            session.commit()
+            await session.commit()
         except Exception:
             log.exception("Failed to set user chat mode")
             return False
@@ -100,10 +125,51 @@ async def get_user_chat_mode(tg_id: int) -> ChatMode:
         ChatMode: The chat mode of the user.
 
     """
-    async with async_session_maker() as session:
+    async with app.session_maker() as session:
         user = await get_user_by_tg_id(session=session, tg_id=tg_id)
         if user:
             log.info("User with tg_id=%s found, chat mode: %s", tg_id, user.chat_mode)
             return user.chat_mode
         log.info("User with tg_id=%s not found, defaulting to 'NEUTRAL'", tg_id)
         return ChatMode.NEUTRAL
+
+
+@timed
+async def insert_messages(messages: list[dict]) -> None:
+    """Insert messages into the archive with a single multi-row insert.
+
+    Args:
+        messages (list[dict]): Messages with tg_id, role, content and tokens.
+
+    """
+    async with app.session_maker() as session:
+        await session.execute(insert(Message), messages)
+        await session.commit()
+
+
+@timed
+async def read_archived_messages(tg_id: int, limit: int) -> list[dict]:
+    """Read the newest archived messages of a user sent after their last reset.
+
+    Args:
+        tg_id (int): Telegram user ID.
+        limit (int): Maximum number of messages to read.
+
+    Returns:
+        list[dict]: Messages with role, content and tokens, oldest first.
+
+    """
+    last_reset = (
+        select(func.coalesce(func.max(Message.id), 0))
+        .where(Message.tg_id == tg_id, Message.role == RESET_ROLE)
+        .scalar_subquery()
+    )
+    stmt = (
+        select(Message.role, Message.content, Message.tokens)
+        .where(Message.tg_id == tg_id, Message.id > last_reset)
+        .order_by(Message.id.desc())
+        .limit(limit)
+    )
+    async with app.session_maker() as session:
+        result = await session.execute(stmt)
+    return [row._asdict() for row in reversed(result.all())]
@@ -2,11 +2,7 @@ from datetime import datetime
 
 from sqlalchemy import Integer, func, text
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.ext.asyncio import (
-    AsyncAttrs,
-    async_sessionmaker,
-    create_async_engine,
-)
+from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -14,17 +10,11 @@ from sqlalchemy.orm import (
     mapped_column,
 )
 
-from chat_bot.config import get_logger, settings
+from chat_bot.app import app
+from chat_bot.config import get_logger
 
 # Get configured logger
 log = get_logger(__name__)
-DATABASE_URL = settings.get_postgres_url()
-
-# Create async engine for working with database
-engine = create_async_engine(url=DATABASE_URL)
-
-# Create session maker to interact with database
-async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -58,7 +48,7 @@ async def check_database_connection() -> None:
     """
     log.info("Checking database connection...")
     try:
-        async with async_session_maker() as session:
+        async with app.session_maker() as session:
             stmt = text("SELECT 1")
             await session.execute(stmt)
         log.info("✅ Successful connection to the database")
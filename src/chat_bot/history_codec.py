@@ -0,0 +1,168 @@
+import json
+from collections.abc import Callable
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from chat_bot.config import get_logger
+
+log = get_logger(__name__)
+
+# Entries written before the codec was introduced are JSON objects
+LEGACY_PREFIX = b"{"
+
+# Every other entry starts with a format byte and a compression byte
+JSON_FORMAT = b"j"
+MSGPACK_FORMAT = b"m"
+NO_COMPRESSION = b"-"
+ZSTD_COMPRESSION = b"z"
+LZ4_COMPRESSION = b"l"
+
+# Roles are stored as small integers instead of repeating their names
+ROLES = ("system", "user", "assistant")
+ROLE_TAGS = {role: tag for tag, role in enumerate(ROLES)}
+
+
+def dump_json(value: Any) -> bytes:  # noqa: ANN401
+    """Encode a value as compact JSON, with orjson if it's installed."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def load_json(data: bytes) -> Any:  # noqa: ANN401
+    """Decode a JSON value, with orjson if it's installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def get_serializers() -> dict[bytes, tuple[Callable, Callable]]:
+    """Get the available (dump, load) functions by format byte."""
+    serializers: dict[bytes, tuple[Callable, Callable]] = {
+        JSON_FORMAT: (dump_json, load_json),
+    }
+    if msgpack is not None:
+        serializers[MSGPACK_FORMAT] = (msgpack.packb, msgpack.unpackb)
+    return serializers
+
+
+def get_compressors() -> dict[bytes, tuple[Callable, Callable]]:
+    """Get the available (compress, decompress) functions by compression byte."""
+    compressors: dict[bytes, tuple[Callable, Callable]] = {}
+    if zstandard is not None:
+        compressors[ZSTD_COMPRESSION] = (
+            zstandard.ZstdCompressor(level=3).compress,
+            zstandard.ZstdDecompressor().decompress,
+        )
+    if lz4 is not None:
+        compressors[LZ4_COMPRESSION] = (lz4.frame.compress, lz4.frame.decompress)
+    return compressors
+
+
+FORMATS = {"json": JSON_FORMAT, "msgpack": MSGPACK_FORMAT}
+COMPRESSIONS = {"zstd": ZSTD_COMPRESSION, "lz4": LZ4_COMPRESSION}
+
+
+class HistoryCodec:
+    """Encode chat history messages stored in Redis.
+
+    A message is stored as a `[role tag, content, tokens]` array in JSON or
+    msgpack, optionally compressed if it's long. Entries in any format, including
+    the JSON objects written by older versions, are decoded transparently, so the
+    codec can be changed without clearing the history.
+    """
+
+    def __init__(
+        self,
+        format: str = "json",  # noqa: A002
+        compression: str = "none",
+        compression_min_bytes: int = 512,
+    ) -> None:
+        """Initialize the codec.
+
+        Args:
+            format (str): Serialization of new entries, "json" or "msgpack".
+            compression (str): Compression of long new entries, "none", "zstd"
+                or "lz4".
+            compression_min_bytes (int): Minimum serialized size of an entry to
+                compress it.
+
+        Raises:
+            ValueError: If the format or the compression is unknown or the package
+                it needs is not installed.
+
+        """
+        self._serializers = get_serializers()
+        self._compressors = get_compressors()
+
+        self._format = FORMATS.get(format)
+        if self._format not in self._serializers:
+            msg = f"History format {format!r} is unknown or not installed"
+            raise ValueError(msg)
+        self._dump, _ = self._serializers[self._format]
+
+        self._compression = COMPRESSIONS.get(compression)
+        if compression != "none" and self._compression not in self._compressors:
+            msg = f"History compression {compression!r} is unknown or not installed"
+            raise ValueError(msg)
+        self._compress = (
+            self._compressors[self._compression][0] if self._compression else None
+        )
+        self.compression_min_bytes = compression_min_bytes
+
+    def encode(self, message: dict) -> bytes:
+        """Encode a message.
+
+        Args:
+            message (dict): The message with role, content and optional tokens.
+
+        Returns:
+            bytes: The encoded message.
+
+        """
+        payload: bytes = self._dump(
+            [ROLE_TAGS[message["role"]], message["content"], message.get("tokens", 0)],
+        )
+        if self._compress is not None and len(payload) >= self.compression_min_bytes:
+            return self._format + self._compression + self._compress(payload)
+        return self._format + NO_COMPRESSION + payload
+
+    def decode(self, value: bytes) -> dict:
+        """Decode a message written in any format.
+
+        Args:
+            value (bytes): The encoded message.
+
+        Returns:
+            dict: The message with role, content and tokens.
+
+        """
+        if value[:1] == LEGACY_PREFIX:
+            return json.loads(value)
+        payload = value[2:]
+        compression = value[1:2]
+        if compression != NO_COMPRESSION:
+            _, decompress = self._compressors[compression]
+            payload = decompress(payload)
+        _, load = self._serializers[value[:1]]
+        role, content, tokens = load(payload)
+        return {"role": ROLES[role], "content": content, "tokens": tokens}
@@ -0,0 +1,200 @@
+import time
+from typing import TYPE_CHECKING, Literal
+
+from chat_bot.app import app
+from chat_bot.config import LLMBackendSettings, get_logger, settings
+from chat_bot.metrics import llm_backend_latency
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+log = get_logger(__name__)
+
+# Latency is tracked separately for the time to the first token of streamed
+# responses and the duration of complete ones
+RequestKind = Literal["stream", "completion"]
+REQUEST_KINDS: tuple[RequestKind, ...] = ("stream", "completion")
+
+
+class LLMBackend:
+    """An OpenAI-compatible API serving a model, with its recent latency.
+
+    Attributes:
+        name (str): The name of the backend, used in the logs and metrics.
+        model (str): The model requested from the API.
+        base_url (str | None): The base URL of the API, None for OpenAI.
+        api_key (str | None): The API key, None for `API_KEY`.
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        base_url: str | None = None,
+        api_key: str | None = None,
+    ) -> None:
+        """Initialize the backend.
+
+        Args:
+            name (str): The name of the backend, used in the logs and metrics.
+            model (str): The model requested from the API.
+            base_url (str | None): The base URL of the API, None for OpenAI.
+            api_key (str | None): The API key, None for `API_KEY`.
+
+        """
+        self.name = name
+        self.model = model
+        self.base_url = base_url
+        self.api_key = api_key
+        # Exponentially weighted moving average of the latency by request kind
+        self.latency: dict[RequestKind, float | None] = dict.fromkeys(REQUEST_KINDS)
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        """Get the client of the API."""
+        return app.get_openai_client(self.base_url, self.api_key)
+
+    def observe(self, kind: RequestKind, seconds: float) -> None:
+        """Record the latency of a request.
+
+        Args:
+            kind (RequestKind): The kind of the request.
+            seconds (float): The time to the first token of a streamed response,
+                or the duration of a complete one. For requests cancelled
+                before, the time they ran for, a lower bound.
+
+        """
+        self.requests += 1
+        latency = self.latency[kind]
+        if latency is None:
+            self.latency[kind] = seconds
+        else:
+            decay = settings.LLM_BACKEND_LATENCY_DECAY
+            self.latency[kind] = latency + decay * (seconds - latency)
+
+    def fail(self, cooldown: float) -> None:
+        """Record a failed request and rank the backend last for a while.
+
+        Args:
+            cooldown (float): Time in seconds the backend is ranked last for.
+
+        """
+        self.errors += 1
+        self.cooldown(cooldown)
+
+    def cooldown(self, seconds: float) -> None:
+        """Rank the backend last for a while, e.g. while it's rate limited.
+
+        Args:
+            seconds (float): Time in seconds the backend is ranked last for.
+
+        """
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    def stats(self) -> dict[str, float | None]:
+        """Get the backend counters and latency.
+
+        Returns:
+            dict[str, float | None]: Requests, errors and latency by request kind.
+
+        """
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            **{f"latency_{kind}": latency for kind, latency in self.latency.items()},
+        }
+
+
+class LLMBackendPool:
+    """The LLM backends, ranked by their health and recent latency."""
+
+    def __init__(self, backends: list[LLMBackend]) -> None:
+        """Initialize the pool.
+
+        Args:
+            backends (list[LLMBackend]): The backends, in order of preference
+                until their latency is known.
+
+        """
+        self.backends = backends
+        # Backends on OpenAI created for the models no backend serves
+        self._model_backends: dict[str, LLMBackend] = {}
+        for backend in backends:
+            self._export_latency(backend)
+
+    def __len__(self) -> int:
+        """Get the number of backends."""
+        return len(self.backends)
+
+    def ranked(self, kind: RequestKind, model: str | None = None) -> list[LLMBackend]:
+        """Get the backends in the order they should be tried.
+
+        Backends cooling down after an error come last. The others are ordered by
+        their latency for this kind of request, the ones not used yet come after
+        them in the configured order.
+
+        Args:
+            kind (RequestKind): The kind of the request.
+            model (str | None): The model to request, None for any of the
+                configured backends.
+
+        Returns:
+            list[LLMBackend]: The backends, the first one is the primary.
+
+        """
+        now = time.monotonic()
+        backends = self.backends
+        if model is not None:
+            backends = [backend for backend in backends if backend.model == model]
+            if not backends:
+                backends = [self._get_model_backend(model)]
+
+        def rank(item: tuple[int, LLMBackend]) -> tuple[bool, float, int]:
+            index, backend = item
+            latency = backend.latency[kind]
+            return (
+                backend.cooldown_until > now,
+                float("inf") if latency is None else latency,
+                index,
+            )
+
+        return [backend for _, backend in sorted(enumerate(backends), key=rank)]
+
+    def stats(self) -> dict[str, dict[str, float | None]]:
+        """Get the counters and latency of every backend."""
+        return {
+            backend.name: backend.stats()
+            for backend in (*self.backends, *self._model_backends.values())
+        }
+
+    def _get_model_backend(self, model: str) -> LLMBackend:
+        backend = self._model_backends.get(model)
+        if backend is None:
+            backend = self._model_backends[model] = LLMBackend(name=model, model=model)
+            self._export_latency(backend)
+        return backend
+
+    def _export_latency(self, backend: LLMBackend) -> None:
+        for kind in REQUEST_KINDS:
+            llm_backend_latency.labels(backend.name, kind).set_function(
+                lambda backend=backend, kind=kind: backend.latency[kind] or 0,
+            )
+
+
+def load_backends(configured: list[LLMBackendSettings]) -> list[LLMBackend]:
+    """Create the configured backends, or the default one using `MODEL`.
+
+    Args:
+        configured (list[LLMBackendSettings]): The `LLM_BACKENDS` setting.
+
+    Returns:
+        list[LLMBackend]: The backends.
+
+    """
+    if not configured:
+        return [LLMBackend(name="default", model=settings.MODEL)]
+    return [LLMBackend(**backend.model_dump()) for backend in configured]
@@ -0,0 +1,273 @@
+import asyncio
+import random
+import re
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Mapping
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+
+from chat_bot.config import get_logger, settings
+from chat_bot.metrics import llm_queue_wait
+
+log = get_logger(__name__)
+
+# Duration format of the OpenAI rate limit reset headers, e.g. "1m30s" or "20ms"
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+@dataclass
+class Waiter:
+    """A request waiting for an LLM slot."""
+
+    future: asyncio.Future
+    tokens: int
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+def parse_duration(value: str | None) -> float | None:
+    """Parse a rate limit reset duration like "1m30s" into seconds.
+
+    Args:
+        value (str | None): The header value.
+
+    Returns:
+        (float | None): The duration in seconds, None if it can't be parsed.
+
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def get_retry_delay(headers: Mapping[str, str], attempt: int) -> float:
+    """Get the delay before retrying a rate limited request.
+
+    The delay from the response headers is used if present, otherwise an
+    exponential backoff with jitter.
+
+    Args:
+        headers (Mapping[str, str]): Headers of the rate limited response.
+        attempt (int): Number of the failed attempt, starting from 0.
+
+    Returns:
+        float: The delay in seconds.
+
+    """
+    retry_after_ms = parse_duration(headers.get("retry-after-ms"))
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    for header in ("retry-after", "x-ratelimit-reset-requests"):
+        delay = parse_duration(headers.get(header))
+        if delay is not None:
+            return delay
+    delay = min(
+        settings.LLM_BACKOFF_BASE_SECONDS * 2**attempt,
+        settings.LLM_BACKOFF_MAX_SECONDS,
+    )
+    return delay * random.uniform(0.5, 1)  # noqa: S311
+
+
+def get_exhausted_delay(headers: Mapping[str, str]) -> float | None:
+    """Get the time until an exhausted rate limit resets.
+
+    Args:
+        headers (Mapping[str, str]): Headers of a successful response.
+
+    Returns:
+        (float | None): The delay in seconds, None if no limit is exhausted.
+
+    """
+    delays = [
+        parse_duration(headers.get(f"x-ratelimit-reset-{limit}"))
+        for limit in ("requests", "tokens")
+        if headers.get(f"x-ratelimit-remaining-{limit}") == "0"
+    ]
+    return max((delay for delay in delays if delay), default=None)
+
+
+class LLMScheduler:
+    """Admission control for LLM requests.
+
+    Limits the number of concurrent requests and the estimated tokens per minute.
+    Waiting requests are served round-robin across users, so one user can't starve
+    the others. Rate limit responses pause all requests for the requested delay.
+    """
+
+    def __init__(self, max_concurrency: int, tokens_per_minute: int) -> None:
+        """Initialize the scheduler.
+
+        Args:
+            max_concurrency (int): Maximum number of concurrent requests.
+            tokens_per_minute (int): Token budget per minute, 0 for unlimited.
+
+        """
+        self._max_concurrency = max_concurrency
+        self._tokens_per_minute = tokens_per_minute
+        self._tokens = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._timer: asyncio.TimerHandle | None = None
+        self._queues: OrderedDict[int, deque[Waiter]] = OrderedDict()
+        self._active = 0
+        self.granted = 0
+        self.rate_limited = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    @property
+    def active(self) -> int:
+        """Get the number of requests holding a slot."""
+        return self._active
+
+    @property
+    def queue_depth(self) -> int:
+        """Get the number of requests waiting for a slot."""
+        return sum(len(queue) for queue in self._queues.values())
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, tokens: int) -> AsyncIterator[None]:
+        """Hold an LLM slot for the duration of the context.
+
+        Args:
+            user_id (int): The user the request is made for.
+            tokens (int): Estimated number of tokens of the request.
+
+        """
+        await self.acquire(user_id, tokens)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, user_id: int, tokens: int) -> None:
+        """Wait for an LLM slot.
+
+        Args:
+            user_id (int): The user the request is made for.
+            tokens (int): Estimated number of tokens of the request.
+
+        """
+        waiter = Waiter(asyncio.get_running_loop().create_future(), tokens)
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release()
+            else:
+                self._remove(user_id, waiter)
+            raise
+
+    def release(self) -> None:
+        """Release an LLM slot."""
+        self._active -= 1
+        self._dispatch()
+
+    def backoff(self, delay: float) -> None:
+        """Pause all requests after a rate limit response.
+
+        Args:
+            delay (float): Time to pause for in seconds.
+
+        """
+        self.rate_limited += 1
+        self.pause(delay)
+        log.warning("LLM rate limit hit, pausing requests for %.2f s", delay)
+
+    def pause(self, delay: float) -> None:
+        """Don't start new requests for the given time.
+
+        Args:
+            delay (float): Time to pause for in seconds.
+
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    def stats(self) -> dict[str, float]:
+        """Get the scheduler counters.
+
+        Returns:
+            dict[str, float]: Queue depth, active requests and wait times.
+
+        """
+        return {
+            "queue_depth": self.queue_depth,
+            "active": self._active,
+            "granted": self.granted,
+            "rate_limited": self.rate_limited,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_max": self.wait_seconds_max,
+        }
+
+    def _remove(self, user_id: int, waiter: Waiter) -> None:
+        queue = self._queues.get(user_id)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[user_id]
+
+    def _refill(self, now: float) -> None:
+        rate = self._tokens_per_minute / 60
+        self._tokens = min(
+            self._tokens + (now - self._refilled_at) * rate,
+            self._tokens_per_minute,
+        )
+        self._refilled_at = now
+
+    def _dispatch(self) -> None:
+        while self._queues and self._active < self._max_concurrency:
+            now = time.monotonic()
+            if self._paused_until > now:
+                self._schedule(self._paused_until - now)
+                return
+
+            user_id, queue = next(iter(self._queues.items()))
+            waiter = queue[0]
+            if not waiter.future.done():
+                if self._tokens_per_minute:
+                    self._refill(now)
+                    tokens = min(waiter.tokens, self._tokens_per_minute)
+                    if tokens > self._tokens:
+                        rate = self._tokens_per_minute / 60
+                        self._schedule((tokens - self._tokens) / rate)
+                        return
+                    self._tokens -= tokens
+
+                self._active += 1
+                self.granted += 1
+                wait_seconds = now - waiter.enqueued_at
+                self.wait_seconds_total += wait_seconds
+                self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+                llm_queue_wait.observe(wait_seconds)
+                waiter.future.set_result(None)
+
+            # Serve the next user on the following iteration
+            queue.popleft()
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+
+    def _schedule(self, delay: float) -> None:
+        loop = asyncio.get_running_loop()
+        when = loop.time() + delay
+        if self._timer is not None and self._timer.when() <= when:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = loop.call_at(when, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
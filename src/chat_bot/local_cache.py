@@ -0,0 +1,93 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache[K, V]:
+    """Bounded in-process cache with LRU eviction and per-entry TTL.
+
+    The cache is not thread-safe, it is meant to be used from the event loop.
+
+    Attributes:
+        hits (int): Number of lookups that found a fresh entry.
+        misses (int): Number of lookups that found nothing or an expired entry.
+        evictions (int): Number of entries evicted to respect the size limit.
+
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        """Initialize the cache.
+
+        Args:
+            maxsize (int): Maximum number of entries.
+            ttl (float): Time to live of an entry in seconds.
+
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        """Get the number of entries in the cache, including expired ones."""
+        return len(self._data)
+
+    def get(self, key: K) -> V | None:
+        """Get a value from the cache.
+
+        Args:
+            key (K): The key to look up.
+
+        Returns:
+            (V | None): The cached value, None if it's missing or expired.
+
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        """Add or replace a value in the cache.
+
+        Args:
+            key (K): The key to store the value under.
+            value (V): The value to store.
+
+        """
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: K) -> None:
+        """Remove a value from the cache if present."""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove all values from the cache."""
+        self._data.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Get the cache counters.
+
+        Returns:
+            dict[str, int]: Hits, misses, evictions and current size.
+
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._data),
+        }
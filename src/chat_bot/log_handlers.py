@@ -0,0 +1,129 @@
+import logging
+import re
+import time
+from logging.handlers import QueueHandler
+
+# Telegram bot tokens and OpenAI API keys, which may appear in URLs and errors
+SECRET_PATTERNS = (
+    re.compile(r"\d{6,}:[A-Za-z0-9_-]{30,}"),
+    re.compile(r"\bsk-[A-Za-z0-9_-]{16,}"),
+)
+REDACTED = "[REDACTED]"
+
+# Shorter secrets are not redacted, they would match ordinary words
+SECRET_MIN_LENGTH = 6
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue handler leaving the formatting of the records to the listener.
+
+    The standard handler formats the message before queuing it, on the thread
+    that logs. The records are only read by the listener thread of this process,
+    so they are queued as they are.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Queue the record unchanged."""
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Rate limit the records below WARNING logged by each call site.
+
+    Each message template of each logger gets a token bucket, the records above
+    its rate are dropped and their number is added to the next record logged.
+    """
+
+    # Buckets are forgotten when there are more, e.g. for messages built with
+    # f-strings, which have a template per message
+    MAX_BUCKETS = 1024
+
+    def __init__(self, rate: float, burst: int) -> None:
+        """Initialize the filter.
+
+        Args:
+            rate (float): Records per second allowed for each call site, 0 to
+                disable sampling.
+            burst (int): Records allowed at once before the rate applies.
+
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # Available tokens, last update time and suppressed records by call site
+        self._buckets: dict[tuple[str, object], list[float]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """Check whether the record is within the rate of its call site."""
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                self._buckets.clear()
+            bucket = self._buckets[key] = [self.burst, now, 0]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] += 1
+            return False
+        bucket[0] = tokens - 1
+        if bucket[2]:
+            record.suppressed = int(bucket[2])
+            bucket[2] = 0
+        return True
+
+
+class RedactingFormatter(logging.Formatter):
+    """Formatter truncating long messages and redacting secrets."""
+
+    def __init__(
+        self,
+        fmt: str,
+        datefmt: str,
+        max_message_length: int,
+        secrets: list[str],
+    ) -> None:
+        """Initialize the formatter.
+
+        Args:
+            fmt (str): The format of the records.
+            datefmt (str): The format of the record times.
+            max_message_length (int): Maximum length of a message, longer ones
+                are truncated, 0 for unlimited. Tracebacks are not truncated.
+            secrets (list[str]): Values to redact, in addition to the ones
+                matching `SECRET_PATTERNS`. Empty and short values are ignored.
+
+        """
+        super().__init__(fmt, datefmt)
+        self.max_message_length = max_message_length
+        self.secrets = [
+            secret for secret in secrets if len(secret) >= SECRET_MIN_LENGTH
+        ]
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format the record."""
+        message = record.getMessage()
+        if 0 < self.max_message_length < len(message):
+            truncated = len(message) - self.max_message_length
+            message = (
+                f"{message[: self.max_message_length]}... "
+                f"[{truncated} characters truncated]"
+            )
+        if suppressed := getattr(record, "suppressed", 0):
+            message += f" [{suppressed} similar messages suppressed]"
+        # Format a copy, the record is shared by the handlers of the listener
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg, record.args = message, None
+        return self.redact(super().format(record))
+
+    def redact(self, text: str) -> str:
+        """Replace the secrets in a text."""
+        for secret in self.secrets:
+            text = text.replace(secret, REDACTED)
+        for pattern in SECRET_PATTERNS:
+            text = pattern.sub(REDACTED, text)
+        return text
@@ -1,39 +1,68 @@
 import asyncio
 
-from aiogram import Bot, Dispatcher, Router
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
-from aiogram.filters import Command, CommandStart
-from aiogram.filters.callback_data import CallbackData
-from aiogram.types import CallbackQuery, InlineKeyboardMarkup, Message
+from aiogram import Dispatcher, Router
+from aiogram.filters import KICKED, ChatMemberUpdatedFilter, Command, CommandStart
+from aiogram.types import (
+    CallbackQuery,
+    ChatMemberUpdated,
+    Message,
+)
 from aiogram.types.bot_command import BotCommand
 from aiogram.utils import markdown
-from aiogram.utils.keyboard import InlineKeyboardBuilder
-from pydantic import BaseModel
 
-from chat_bot.ai_chat_service import handle_user_message
-from chat_bot.config import get_logger, settings
-from chat_bot.crud import create_user
-from chat_bot.database import check_database_connection
+from chat_bot.ai_chat_service import handle_user_message, stream_user_message
+from chat_bot.app import app
+from chat_bot.compaction import cancel_compactions
+from chat_bot.config import configure_logging, get_logger, settings
 from chat_bot.enums import ChatMode
-from chat_bot.redis_client import check_redis_connection, redis_client
+from chat_bot.message_editor import (
+    ThrottledMessageEditor,
+    answer_in_parts,
+    keep_typing,
+    split_text,
+)
+from chat_bot.metrics import start_metrics_server
+from chat_bot.rate_limit import AdmissionMiddleware
+from chat_bot.redis_client import check_redis_connection
 from chat_bot.redis_crud import delete_messages
-from chat_bot.utils import get_chat_mode, set_chat_mode
+from chat_bot.response_cache import response_cache_stats
+from chat_bot.static_responses import ModeCallback, StaticResponses
+from chat_bot.supervisor import WorkerSupervisor, get_worker_count
+from chat_bot.turns import (
+    TurnCancelledError,
+    cancel_turns,
+    listen_turn_cancellations,
+    turn_tracker,
+)
+from chat_bot.update_stream import UpdatePublisher, run_stream_worker
+from chat_bot.utils import (
+    get_chat_mode,
+    listen_chat_mode_invalidations,
+    set_chat_mode,
+)
+from chat_bot.webhook import run_webhook
 
 # Get configured logger
 log = get_logger(__name__)
 
-BOT_TOKEN = settings.BOT_TOKEN
-
-# Initialize Bot instance with default bot properties which will be passed to all
-# API calls
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-
 # All handlers should be attached to the Router (or Dispatcher)
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
 
+# Reject messages above the rate limits before they are handled
+dp.message.outer_middleware(AdmissionMiddleware())
+
+# Reply shown when the model returned no text
+EMPTY_RESPONSE_TEXT = "Something went wrong, please try again later."
+
+# Replies replacing the response of a cancelled turn, by reason
+CANCELLED_TURN_TEXTS = {
+    "reset": "Cancelled.",
+    "superseded": "Cancelled, answering your new message.",
+    "shutdown": "The bot is restarting, please send your message again.",
+}
+
 bot_commands = [
     BotCommand(command="start", description="start using the bot"),
     BotCommand(command="help", description="list of available commands"),
@@ -45,21 +74,16 @@ bot_commands = [
     ),
 ]
 
-
-class ModeCallback(CallbackData, BaseModel, prefix="mode"):
-    """Callback data for mode options.
-
-    Attributes:
-        mode (str): The selected mode of communication with the bot.
-
-    """
-
-    mode: str
+# Replies to the commands that are the same for every user, built once
+static_responses = StaticResponses(bot_commands)
 
 
 @dp.message(CommandStart())
 async def command_start_handler(message: Message) -> None:
     """Handle `/start` command."""
+    # Loaded on first use, so importing the bot doesn't load SQLAlchemy
+    from chat_bot.crud import create_user  # noqa: PLC0415
+
     username = markdown.hbold(message.from_user.full_name)
     await message.answer(
         text=f"Hello, {username}!\nWait a moment, I'm registering you.",
@@ -82,63 +106,40 @@ async def command_start_handler(message: Message) -> None:
 @dp.message(Command("help"))
 async def command_help_handler(message: Message) -> None:
     """Handle `/help` command."""
-    commands: list[BotCommand] = await bot.get_my_commands()
-    if commands:
-        text = "Here are the available commands\n\n"
-        for command in commands:
-            text += f"/{command.command} - {command.description}\n"
-        await message.answer(text)
-
-    else:
-        await message.answer("No commands available.")
+    await message.answer(static_responses.help_text)
 
 
 @dp.message(Command("reset"))
 async def command_reset_handler(message: Message) -> None:
     """Handle `/reset` command."""
     wait_message: Message = await message.answer("Resetting your chat history...")
+    # Stop the turns in progress, so their responses aren't written to the new history
+    await cancel_turns(message.chat.id, "reset")
     if not await delete_messages(message.chat.id):
         await wait_message.edit_text(
             text="Failed to reset your chat history. Please try again later.",
         )
         return
+    app.message_archive.add_reset(message.chat.id)
     await wait_message.edit_text("Your chat history has been reset.")
 
 
 @dp.message(Command("about"))
 async def command_about_handler(message: Message) -> None:
     """Handle `/about` command."""
-    await message.answer(
-        text=(
-            "About this bot\n\n"
-            "This bot helps make your conversations easier, faster, and more "
-            "personalized.\n"
-            "Choose your communication style: Casual, Neutral, or Strict.\n"
-            "Use /reset to clear history, /mode to switch style, and /help to see all "
-            "commands.\n"
-            "The bot adapts to your needs and makes chatting simple!"
-        ),
-    )
+    await message.answer(text=static_responses.about_text)
 
 
 @dp.message(Command("mode"))
 async def command_mode_handler(message: Message) -> None:
     """Handle `/mode` command."""
     user_mode: ChatMode = await get_chat_mode(message.chat.id)
-
-    # Build inline keyboard with available modes
-    builder = InlineKeyboardBuilder()
-    for mode in ChatMode:
-        builder.button(text=mode.value, callback_data=ModeCallback(mode=mode.name))
-    builder.adjust(1)
-    markup: InlineKeyboardMarkup = builder.as_markup()
-
     await message.answer(
         text=(
             f"Your current mode is: '{markdown.hbold(user_mode.value)}'\n"
             "Select a new mode of communication with the bot:"
         ),
-        reply_markup=markup,
+        reply_markup=static_responses.mode_keyboard,
     )
 
 
@@ -154,18 +155,117 @@ async def message_handler(message: Message) -> None:
         )
         return
 
+    if settings.CANCEL_SUPERSEDED_TURNS:
+        await cancel_turns(message.chat.id, "superseded")
+
+    # Messages sent in a burst are answered with a single reply
+    async with app.coalescer.turn(message.chat.id, message.text) as message_text:
+        if message_text is None:
+            return
+        await answer_with_ai(message, message_text)
+
+
+async def answer_with_ai(message: Message, message_text: str) -> None:
+    """Reply to the user with the response generated by the AI chat.
+
+    The response is generated as a turn of `turn_tracker`, so it can be cancelled
+    when it becomes stale, e.g. on `/reset`.
+
+    Args:
+        message (Message): The user message to reply to.
+        message_text (str): The text to generate the response for.
+
+    """
+    if settings.TYPING_REPLIES:
+        await answer_while_typing(message, message_text)
+        return
+
     wait_message: Message = await message.answer("Thinking 🤔")
-    current_chat_mode: ChatMode = await get_chat_mode(message.chat.id)
-    response = await handle_user_message(
-        tg_id=message.chat.id,
-        message_text=message.text,
-        mode=current_chat_mode,
+    try:
+        await turn_tracker.run(
+            message.chat.id,
+            generate_reply(message, wait_message, message_text),
+        )
+    except TurnCancelledError as e:
+        if text := CANCELLED_TURN_TEXTS.get(e.reason):
+            await wait_message.edit_text(text)
+
+
+async def answer_while_typing(message: Message, message_text: str) -> None:
+    """Reply with the response in a new message, showing the typing action meanwhile.
+
+    Saves the wait message and its edits, the response is not streamed.
+
+    Args:
+        message (Message): The user message to reply to.
+        message_text (str): The text to generate the response for.
+
+    """
+    typing_task = asyncio.create_task(
+        keep_typing(message.bot, message.chat.id, settings.TYPING_INTERVAL_SECONDS),
     )
+    try:
+        response = await turn_tracker.run(
+            message.chat.id,
+            handle_user_message(tg_id=message.chat.id, message_text=message_text),
+        )
+    except TurnCancelledError as e:
+        response = CANCELLED_TURN_TEXTS.get(e.reason)
+    else:
+        response = response or EMPTY_RESPONSE_TEXT
+    finally:
+        typing_task.cancel()
+    if response:
+        await answer_in_parts(message, response)
+
+
+async def generate_reply(
+    message: Message,
+    wait_message: Message,
+    message_text: str,
+) -> None:
+    """Generate the response and show it in place of the wait message.
+
+    Args:
+        message (Message): The user message to reply to.
+        wait_message (Message): The message to replace with the response.
+        message_text (str): The text to generate the response for.
+
+    """
+    if not settings.STREAM_RESPONSES:
+        response = await handle_user_message(
+            tg_id=message.chat.id,
+            message_text=message_text,
+        )
+        first, *rest = split_text(response or EMPTY_RESPONSE_TEXT)
+        await wait_message.edit_text(
+            text=first,
+            parse_mode=None,
+        )
+        for part in rest:
+            await message.answer(text=part, parse_mode=None)
+        return
 
-    await wait_message.edit_text(
-        text=response,
-        parse_mode=None,
+    # Show the response progressively while it is being generated
+    editor = ThrottledMessageEditor(
+        message=wait_message,
+        interval=settings.STREAM_EDIT_INTERVAL_SECONDS,
     )
+    response = ""
+    async for chunk in stream_user_message(
+        tg_id=message.chat.id,
+        message_text=message_text,
+    ):
+        response += chunk
+        await editor.update(response)
+    # The placeholder must not stay as the answer
+    await editor.finish(response or EMPTY_RESPONSE_TEXT)
+
+
+@dp.my_chat_member(ChatMemberUpdatedFilter(member_status_changed=KICKED))
+async def bot_blocked_handler(event: ChatMemberUpdated) -> None:
+    """Stop answering a user who blocked the bot."""
+    await cancel_turns(event.chat.id, "blocked")
 
 
 @router.callback_query(ModeCallback.filter())
@@ -200,32 +300,98 @@ async def async_main() -> None:
     This function performs the following steps:
     1. Checks the connection to the database to ensure it is operational.
     2. Updates the bot's command list to provide users with available commands.
-    3. Starts polling to listen for and handle incoming updates from Telegram.
+    3. Starts polling, or the webhook server if `WEBHOOK_ENABLED` is set, to listen
+       for and handle incoming updates from Telegram. With `PROCESS_ROLE` set to
+       `ingest` the updates are published to Redis Streams instead of handled,
+       and `worker` handles the updates from the streams. `supervisor` publishes
+       the updates and runs the workers handling them on this host.
     """
+    from chat_bot.database import check_database_connection  # noqa: PLC0415
+
+    bot = app.bot
+
     # Check the connection to the database before starting the bot
     await check_database_connection()
     await check_redis_connection()
     try:
         # Update Bot commands list
         await bot.set_my_commands(bot_commands)
+        static_responses.refresh(bot_commands)
         log.info("Bot commands have been updated")
     except Exception:
         log.exception("Bot commands have not been updated")
 
+    # Keep the local chat mode cache in sync with other bot instances
+    invalidation_task = asyncio.create_task(listen_chat_mode_invalidations())
+
+    # Cancel the turns made stale by the updates handled by other bot instances
+    cancellation_task = asyncio.create_task(listen_turn_cancellations())
+
+    # Load the clients deferred for a fast startup while updates are handled
+    warm_up_task = asyncio.create_task(app.warm_up())
+
+    # Archive the chat history in the database
+    if settings.ARCHIVE_ENABLED:
+        app.message_archive.start()
+
+    # Serve Prometheus metrics
+    metrics_server = None
+    if settings.METRICS_ENABLED:
+        metrics_server = await start_metrics_server(
+            host=settings.METRICS_HOST,
+            port=settings.METRICS_PORT,
+        )
+
+    # Hand the received updates over to the stream workers
+    if settings.PROCESS_ROLE in {"ingest", "supervisor"}:
+        dp.update.outer_middleware(UpdatePublisher())
+
+    # Run the stream workers on this host
+    supervisor = None
+    if settings.PROCESS_ROLE == "supervisor":
+        supervisor = WorkerSupervisor(
+            workers=get_worker_count(),
+            restart_delay=settings.SUPERVISOR_RESTART_DELAY_SECONDS,
+        )
+        supervisor.start()
+
     # And the run events dispatching
     try:
-        await dp.start_polling(bot)
+        if settings.PROCESS_ROLE == "worker":
+            await run_stream_worker(dp, bot)
+        elif settings.WEBHOOK_ENABLED:
+            await run_webhook(dp, bot)
+        else:
+            await dp.start_polling(bot)
     finally:
-        await redis_client.aclose()
-        log.info("Redis client session closed")
+        if supervisor is not None:
+            await supervisor.stop(settings.STREAM_SHUTDOWN_TIMEOUT_SECONDS)
+        await asyncio.gather(turn_tracker.cancel_all("shutdown"), cancel_compactions())
+        invalidation_task.cancel()
+        cancellation_task.cancel()
+        warm_up_task.cancel()
+        await app.message_archive.close()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        log.info("Chat mode cache stats: %s", app.chat_mode_cache.stats())
+        log.info("LLM scheduler stats: %s", app.llm_scheduler.stats())
+        log.info("LLM backend stats: %s", app.llm_backends.stats())
+        log.info("Response cache stats: %s", response_cache_stats.stats())
+        log.info("Telegram scheduler stats: %s", app.telegram_scheduler.stats())
+        await app.telegram_scheduler.close()
+        await app.close()
 
 
 def main() -> None:
     """Run the main entry point for the bot.
 
-    Call the asynchronous main logic via asyncio.
+    Configure logging and call the asynchronous main logic via asyncio.
     """
-    asyncio.run(async_main())
+    log_listener = configure_logging()
+    try:
+        asyncio.run(async_main())
+    finally:
+        log_listener.stop()
 
 
 if __name__ == "__main__":
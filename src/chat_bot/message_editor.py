@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.enums import ChatAction
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from chat_bot.config import get_logger
+from chat_bot.telegram_scheduler import progress_requests
+
+log = get_logger(__name__)
+
+# Maximum length of a Telegram text message
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Separators long texts are split at, from the preferred one
+SPLIT_SEPARATORS = ("\n\n", "\n", " ")
+
+
+def split_text(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
+    """Split a text into parts short enough to be sent as Telegram messages.
+
+    Parts end at a paragraph, a line or a word if one ends in the second half of
+    the limit, so the text is cut mid-word only when it has no such break.
+
+    Args:
+        text (str): The text to split.
+        limit (int): Maximum length of a part.
+
+    Returns:
+        list[str]: The parts, a single one if the text is short enough.
+
+    """
+    parts = []
+    while len(text) > limit:
+        end = limit
+        for separator in SPLIT_SEPARATORS:
+            index = text.rfind(separator, limit // 2, limit)
+            if index != -1:
+                end = index
+                break
+        parts.append(text[:end].rstrip())
+        text = text[end:].lstrip()
+    parts.append(text)
+    return parts
+
+
+async def answer_in_parts(message: Message, text: str) -> None:
+    """Reply with a text, split into several messages if it's too long.
+
+    Args:
+        message (Message): The message to reply to.
+        text (str): The text, sent without parsing.
+
+    """
+    for part in split_text(text):
+        await message.answer(text=part, parse_mode=None)
+
+
+async def keep_typing(bot: Bot, chat_id: int, interval: float) -> None:
+    """Show that the bot is typing in a chat until cancelled.
+
+    Telegram shows the action for 5 seconds or until a message is sent, so it's
+    sent again every `interval` seconds.
+
+    Args:
+        bot (Bot): The bot.
+        chat_id (int): The chat ID.
+        interval (float): Delay between two actions in seconds.
+
+    """
+    # Sent as a reply: a progress request needs a token more than the chat has
+    # while the user keeps writing, so the action would be dropped with the turn
+    while True:
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except TelegramAPIError as e:
+            log.warning("Failed to send typing action: %s", e)
+        await asyncio.sleep(interval)
+
+
+class ThrottledMessageEditor:
+    """Progressively edit a Telegram message with a growing text.
+
+    Updates are coalesced: the message is edited at most once per `interval`
+    seconds, so a fast token stream never exceeds Telegram's per-chat edit limits.
+    The first update is pushed immediately to show the first tokens as soon as
+    possible.
+    """
+
+    def __init__(self, message: Message, interval: float) -> None:
+        """Initialize the editor.
+
+        Args:
+            message (Message): The placeholder message to edit.
+            interval (float): Minimum delay between two edits in seconds.
+
+        """
+        self._message = message
+        self._interval = interval
+        self._sent_text = message.text or ""
+        self._next_edit_at = 0.0
+        self._blocked_until = 0.0
+
+    async def update(self, text: str) -> None:
+        """Show the partial text if the edit interval has passed.
+
+        Args:
+            text (str): The text received so far.
+
+        """
+        if time.monotonic() < self._next_edit_at:
+            return
+        try:
+            with progress_requests():
+                await self._edit(text[:TELEGRAM_MESSAGE_LIMIT])
+        except TelegramRetryAfter as e:
+            log.warning("Edit rate limit hit, retry after %s s", e.retry_after)
+            self._blocked_until = time.monotonic() + e.retry_after
+            self._next_edit_at = self._blocked_until
+        except TelegramBadRequest:
+            log.exception("Failed to edit message with partial response")
+
+    async def finish(self, text: str) -> None:
+        """Show the final text, waiting out a pending rate limit if necessary.
+
+        A text longer than a message is continued in new messages.
+
+        Args:
+            text (str): The complete text.
+
+        """
+        first, *rest = split_text(text)
+        delay = self._blocked_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            await self._edit(first)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            await self._edit(first)
+        # The rest of a text longer than a message is sent in new messages
+        for part in rest:
+            await self._message.answer(text=part, parse_mode=None)
+
+    async def _edit(self, text: str) -> None:
+        # Telegram rejects edits that don't change the message text
+        if not text or text == self._sent_text:
+            return
+        await self._message.edit_text(text=text, parse_mode=None)
+        self._sent_text = text
+        self._next_edit_at = time.monotonic() + self._interval
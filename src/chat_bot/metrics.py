@@ -0,0 +1,310 @@
+import functools
+import inspect
+import logging
+import time
+from collections.abc import AsyncIterator, Callable, Iterator
+from typing import TYPE_CHECKING, Any
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.registry import Collector
+
+from chat_bot.config import get_logger
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+log = get_logger(__name__)
+
+# Histogram buckets in seconds, from a Redis round trip to a long LLM response
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+class FunctionCounter(Collector):
+    """Counter whose values are read from functions when the metrics are collected.
+
+    Used to export counters that are already kept elsewhere, e.g. by the caches,
+    so the hot path doesn't count twice. `prometheus_client` only supports it for
+    gauges.
+
+    Attributes:
+        name (str): The metric name.
+        documentation (str): The help text of the metric.
+        labelnames (tuple[str, ...]): Names of the labels of the metric.
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+    ) -> None:
+        """Initialize the counter and add it to the default registry.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text of the metric.
+            labelnames (tuple[str, ...]): Names of the labels of the metric.
+
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._functions: dict[tuple[str, ...], Callable[[], float]] = {}
+        REGISTRY.register(self)
+
+    def set_function(self, function: Callable[[], float], *labelvalues: str) -> None:
+        """Read the value with the given labels from a function.
+
+        Args:
+            function (Callable[[], float]): Gets the current value.
+            *labelvalues (str): Values of the labels, in the order of `labelnames`.
+
+        """
+        if len(labelvalues) != len(self.labelnames):
+            msg = f"{self.name} expects labels {self.labelnames}"
+            raise ValueError(msg)
+        self._functions[labelvalues] = function
+
+    def collect(self) -> Iterator[CounterMetricFamily]:
+        """Get the current values of the counter."""
+        family = CounterMetricFamily(
+            self.name,
+            self.documentation,
+            labels=self.labelnames,
+        )
+        for labelvalues, function in list(self._functions.items()):
+            family.add_metric(labelvalues, function())
+        yield family
+
+
+stage_duration = Histogram(
+    "chat_bot_stage_duration_seconds",
+    "Duration of the stages of handling a message",
+    ("stage",),
+    buckets=DEFAULT_BUCKETS,
+)
+stage_errors = Counter(
+    "chat_bot_stage_errors_total",
+    "Exceptions raised by the stages of handling a message",
+    ("stage",),
+)
+log_errors = Counter(
+    "chat_bot_log_errors_total",
+    "Errors logged, including the ones handled by falling back",
+    ("logger",),
+)
+telegram_request_duration = Histogram(
+    "chat_bot_telegram_request_duration_seconds",
+    "Duration of the Telegram Bot API requests",
+    ("method",),
+    buckets=DEFAULT_BUCKETS,
+)
+telegram_request_errors = Counter(
+    "chat_bot_telegram_request_errors_total",
+    "Failed Telegram Bot API requests",
+    ("method", "error"),
+)
+telegram_outbound_queue_depth = Gauge(
+    "chat_bot_telegram_outbound_queue_depth",
+    "Telegram requests waiting for the flood limits",
+)
+telegram_outbound_requests = Counter(
+    "chat_bot_telegram_outbound_requests_total",
+    "Telegram requests to chats by outcome in the outbound scheduler",
+    ("result",),
+)
+llm_first_token = Histogram(
+    "chat_bot_llm_first_token_seconds",
+    "Time to the first token of the streamed LLM responses",
+    ("backend",),
+    buckets=DEFAULT_BUCKETS,
+)
+llm_tokens = Counter(
+    "chat_bot_llm_tokens_total",
+    "Tokens used by the LLM requests",
+    ("type",),
+)
+cache_requests = FunctionCounter(
+    "chat_bot_cache_requests_total",
+    "Cache lookups",
+    ("cache", "result"),
+)
+archived_messages = Counter(
+    "chat_bot_archived_messages_total",
+    "Messages written to the archive or dropped",
+    ("result",),
+)
+llm_queue_depth = Gauge(
+    "chat_bot_llm_queue_depth",
+    "LLM requests waiting for a slot",
+)
+llm_queue_wait = Histogram(
+    "chat_bot_llm_queue_wait_seconds",
+    "Time the LLM requests waited for a slot",
+    buckets=DEFAULT_BUCKETS,
+)
+llm_active_requests = Gauge(
+    "chat_bot_llm_active_requests",
+    "LLM requests holding a slot",
+)
+llm_rate_limited = FunctionCounter(
+    "chat_bot_llm_rate_limited_total",
+    "LLM requests rejected by the rate limit of the API",
+)
+llm_backend_requests = Counter(
+    "chat_bot_llm_backend_requests_total",
+    "LLM requests sent to each backend, by outcome",
+    ("backend", "result"),
+)
+llm_backend_latency = Gauge(
+    "chat_bot_llm_backend_latency_seconds",
+    "Moving average of the latency of each LLM backend, used to rank them",
+    ("backend", "kind"),
+)
+llm_hedged_requests = Counter(
+    "chat_bot_llm_hedged_requests_total",
+    "LLM requests sent to a second backend because the first one was slow",
+)
+model_routes = Counter(
+    "chat_bot_model_routes_total",
+    "Messages routed to each model",
+    ("model",),
+)
+admission_decisions = Counter(
+    "chat_bot_admission_decisions_total",
+    "Incoming messages admitted or rejected by the rate limits",
+    ("result",),
+)
+cancelled_turns = Counter(
+    "chat_bot_cancelled_turns_total",
+    "AI turns cancelled because their response became stale",
+    ("reason",),
+)
+stream_updates = Counter(
+    "chat_bot_stream_updates_total",
+    "Updates published to or consumed from the update streams",
+    ("result",),
+)
+stream_partitions = Gauge(
+    "chat_bot_stream_partitions",
+    "Update stream partitions leased by this worker",
+)
+
+supervisor_workers = Gauge(
+    "chat_bot_supervisor_workers",
+    "Stream worker processes running under the supervisor",
+)
+supervisor_worker_restarts = Counter(
+    "chat_bot_supervisor_worker_restarts_total",
+    "Stream worker processes restarted by the supervisor",
+    ("reason",),
+)
+
+
+def timed[F: Callable[..., Any]](function: F) -> F:
+    """Record the duration and the exceptions of a stage of handling a message.
+
+    The stage is named after the function. Async generators are timed until
+    they are exhausted or closed.
+
+    Args:
+        function (F): The coroutine or async generator function to time.
+
+    Returns:
+        F: The wrapped function.
+
+    """
+    stage = function.__name__
+    durations = stage_duration.labels(stage)
+    errors = stage_errors.labels(stage)
+
+    if inspect.isasyncgenfunction(function):
+
+        @functools.wraps(function)
+        async def generator_wrapper(*args: Any, **kwargs: Any) -> AsyncIterator[Any]:  # noqa: ANN401
+            started_at = time.perf_counter()
+            try:
+                async for item in function(*args, **kwargs):
+                    yield item
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                durations.observe(time.perf_counter() - started_at)
+
+        return generator_wrapper  # type: ignore[return-value]
+
+    @functools.wraps(function)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+        started_at = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            durations.observe(time.perf_counter() - started_at)
+
+    return wrapper  # type: ignore[return-value]
+
+
+def record_llm_usage(usage: Any) -> None:  # noqa: ANN401
+    """Count the tokens used by an LLM request.
+
+    Args:
+        usage (Any): The usage of the completion, may be None.
+
+    """
+    if usage is None:
+        return
+    llm_tokens.labels("prompt").inc(usage.prompt_tokens)
+    llm_tokens.labels("completion").inc(usage.completion_tokens)
+
+
+class ErrorCountingHandler(logging.Handler):
+    """Logging handler counting the logged errors by logger."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        """Count the record."""
+        log_errors.labels(record.name).inc()
+
+
+async def start_metrics_server(host: str, port: int) -> "web.AppRunner":
+    """Start the HTTP server serving the metrics on `/metrics`.
+
+    Args:
+        host (str): Host to listen on.
+        port (int): Port to listen on.
+
+    Returns:
+        web.AppRunner: The runner of the server, to clean it up on shutdown.
+
+    """
+    from aiohttp import web  # noqa: PLC0415
+    from prometheus_client.aiohttp import make_aiohttp_handler  # noqa: PLC0415
+
+    app = web.Application()
+    app.router.add_get("/metrics", make_aiohttp_handler())
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("Metrics are served on http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,155 @@
+import re
+from dataclasses import dataclass
+
+from chat_bot.config import ModelTierSettings, get_logger, settings
+from chat_bot.enums import ChatMode
+from chat_bot.metrics import model_routes
+
+log = get_logger(__name__)
+
+
+@dataclass
+class ModelTier:
+    """A model messages are routed to when they meet its conditions.
+
+    Attributes:
+        model (str): The model name.
+        max_message_tokens (int | None): Maximum tokens of the message.
+        max_history_tokens (int | None): Maximum tokens of the chat history,
+            including the summary and the message.
+        modes (set[ChatMode] | None): Chat modes routed to the model.
+        pattern (re.Pattern | None): Pattern the message must match.
+        exclude_pattern (re.Pattern | None): Pattern the message must not match.
+
+    """
+
+    model: str
+    max_message_tokens: int | None = None
+    max_history_tokens: int | None = None
+    modes: set[ChatMode] | None = None
+    pattern: re.Pattern | None = None
+    exclude_pattern: re.Pattern | None = None
+
+    @classmethod
+    def from_settings(cls, tier: ModelTierSettings) -> "ModelTier":
+        """Create a tier from its settings, compiling the patterns.
+
+        Args:
+            tier (ModelTierSettings): An item of `MODEL_TIERS`.
+
+        Returns:
+            ModelTier: The tier.
+
+        """
+        return cls(
+            model=tier.model,
+            max_message_tokens=tier.max_message_tokens,
+            max_history_tokens=tier.max_history_tokens,
+            modes=(
+                None if tier.modes is None else {ChatMode[mode] for mode in tier.modes}
+            ),
+            pattern=None if tier.pattern is None else re.compile(tier.pattern),
+            exclude_pattern=(
+                None
+                if tier.exclude_pattern is None
+                else re.compile(tier.exclude_pattern)
+            ),
+        )
+
+    def matches(
+        self,
+        message_text: str,
+        message_tokens: int,
+        history_tokens: int,
+        mode: ChatMode,
+    ) -> bool:
+        """Check whether a message meets the conditions of the tier.
+
+        Args:
+            message_text (str): The message text from the user.
+            message_tokens (int): Tokens of the message.
+            history_tokens (int): Tokens of the chat history.
+            mode (ChatMode): The chat mode of the user.
+
+        Returns:
+            bool: True if the message should be routed to the model.
+
+        """
+        return (
+            (
+                self.max_message_tokens is None
+                or message_tokens <= self.max_message_tokens
+            )
+            and (
+                self.max_history_tokens is None
+                or history_tokens <= self.max_history_tokens
+            )
+            and (self.modes is None or mode in self.modes)
+            and (self.pattern is None or self.pattern.search(message_text) is not None)
+            and (
+                self.exclude_pattern is None
+                or self.exclude_pattern.search(message_text) is None
+            )
+        )
+
+
+class ModelRouter:
+    """Pick the model answering a message from cheap features of the turn.
+
+    The tiers are checked in order, usually from the fastest and cheapest model,
+    the message goes to the first one whose conditions it meets, or to `MODEL`.
+    """
+
+    def __init__(self, tiers: list[ModelTier]) -> None:
+        """Initialize the router.
+
+        Args:
+            tiers (list[ModelTier]): The tiers, in the order they are checked.
+
+        """
+        self.tiers = tiers
+
+    def route(
+        self,
+        tg_id: int,
+        message_text: str,
+        message_tokens: int,
+        history_tokens: int,
+        mode: ChatMode,
+    ) -> str | None:
+        """Pick the model for a message.
+
+        Args:
+            tg_id (int): The Telegram ID of the user.
+            message_text (str): The message text from the user.
+            message_tokens (int): Tokens of the message.
+            history_tokens (int): Tokens of the chat history, including the
+                summary and the message.
+            mode (ChatMode): The chat mode of the user.
+
+        Returns:
+            (str | None): The model, None for the default backends using `MODEL`
+                when no tier matches or no tier is configured.
+
+        """
+        if not self.tiers:
+            return None
+        model = next(
+            (
+                tier.model
+                for tier in self.tiers
+                if tier.matches(message_text, message_tokens, history_tokens, mode)
+            ),
+            None,
+        )
+        model_routes.labels(model or settings.MODEL).inc()
+        log.info(
+            "Model route: tg_id=%s, model=%s, message_tokens=%s, "
+            "history_tokens=%s, mode=%s",
+            tg_id,
+            model or settings.MODEL,
+            message_tokens,
+            history_tokens,
+            mode.name,
+        )
+        return model
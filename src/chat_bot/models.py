@@ -1,4 +1,4 @@
-from sqlalchemy import BigInteger
+from sqlalchemy import BigInteger, Index, Integer, Text
 from sqlalchemy import Enum as SqlEnum
 from sqlalchemy.orm import Mapped, mapped_column
 
@@ -28,3 +28,25 @@ class User(Base):
         """Initialize a User instance."""
         self.tg_id = tg_id
         self.first_name = first_name
+
+
+class Message(Base):
+    """Model for archiving the chat history.
+
+    Besides the messages, `/reset` commands are stored with the `reset` role, so
+    the history is rehydrated only from the messages sent after the last reset.
+    """
+
+    __table_args__ = (Index("ix_messages_tg_id_id", "tg_id", "id"),)
+
+    # A row per message of every chat overflows a 32-bit serial. SQLite only
+    # autoincrements INTEGER primary keys, which are 64-bit there anyway.
+    id: Mapped[int] = mapped_column(
+        BigInteger().with_variant(Integer, "sqlite"),
+        primary_key=True,
+        autoincrement=True,
+    )
+    tg_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    role: Mapped[str] = mapped_column(nullable=False)
+    content: Mapped[str] = mapped_column(Text, nullable=False)
+    tokens: Mapped[int] = mapped_column(nullable=False, default=0)
@@ -24,3 +24,15 @@ CASUAL: str = (
     "language and contractions like you're, it's, don't, etc. Always reply in the "
     "same language the user used in their message."
 )
+
+
+SUMMARY: str = (
+    "You summarize conversations between a user and an assistant. Write a concise "
+    "summary of the conversation below that keeps every fact, preference, decision "
+    "and open question needed to continue it. If a previous summary is given, merge "
+    "it with the new messages into a single summary. Do not add any comments, reply "
+    "only with the summary, in the language of the conversation."
+)
+
+
+SUMMARY_CONTEXT: str = "Summary of the earlier part of the conversation:\n"
@@ -0,0 +1,177 @@
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject
+
+from chat_bot.app import LazyScript, app
+from chat_bot.config import get_logger, settings
+from chat_bot.metrics import admission_decisions
+
+log = get_logger(__name__)
+
+GLOBAL_BUCKET_KEY = "rate_limit:global"
+
+RATE_LIMITED_TEXT = "You're sending messages too fast, please wait a few seconds."
+BUSY_TEXT = "I'm busy right now, please try again in a minute."
+
+# Admission results of the script
+ADMITTED = 0
+USER_LIMITED = 1
+GLOBAL_LIMITED = 2
+
+# Take a token from the user and the global buckets, only if both have one.
+# A bucket with a rate of 0 is unlimited. The notice key is set while the user
+# is limited, so they are told only once.
+# KEYS[1] - user bucket, KEYS[2] - global bucket, KEYS[3] - user notice
+# ARGV[1] - user rate per second, ARGV[2] - user burst,
+# ARGV[3] - global rate per second, ARGV[4] - global burst
+# Returns {result, 1 if the user must be told, milliseconds until admitted}
+RATE_LIMIT_SCRIPT = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local function refill(key, rate, burst)
+    if rate <= 0 then
+        return nil
+    end
+    local bucket = redis.call("HMGET", key, "tokens", "updated_at")
+    local tokens = tonumber(bucket[1]) or burst
+    local updated_at = tonumber(bucket[2]) or now
+    return math.min(burst, tokens + math.max(now - updated_at, 0) * rate)
+end
+local function save(key, tokens, rate, burst)
+    if tokens == nil then
+        return
+    end
+    redis.call("HSET", key, "tokens", tokens, "updated_at", now)
+    redis.call("PEXPIRE", key, math.ceil((burst - tokens) / rate * 1000) + 1000)
+end
+
+local buckets = {
+    {KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2])},
+    {KEYS[2], tonumber(ARGV[3]), tonumber(ARGV[4])},
+}
+local result, wait = 0, 0
+for i, bucket in ipairs(buckets) do
+    bucket[4] = refill(bucket[1], bucket[2], bucket[3])
+    if result == 0 and bucket[4] ~= nil and bucket[4] < 1 then
+        result = i
+        wait = math.ceil((1 - bucket[4]) / bucket[2] * 1000)
+    end
+end
+for _, bucket in ipairs(buckets) do
+    if result == 0 and bucket[4] ~= nil then
+        bucket[4] = bucket[4] - 1
+    end
+    save(bucket[1], bucket[4], bucket[2], bucket[3])
+end
+if result == 0 then
+    return {0, 0, 0}
+end
+local notify = redis.call("SET", KEYS[3], 1, "PX", math.max(wait, 1000), "NX")
+return {result, notify and 1 or 0, wait}
+"""
+
+rate_limit_script = LazyScript(RATE_LIMIT_SCRIPT)
+
+
+def user_bucket_key(user_id: int) -> str:
+    """Get the key of the token bucket of a user."""
+    return f"rate_limit:user:{user_id}"
+
+
+async def take_token(user_id: int) -> tuple[int, bool, int]:
+    """Take a token from the user and the global buckets.
+
+    Args:
+        user_id (int): The Telegram ID of the user.
+
+    Returns:
+        tuple[int, bool, int]: `ADMITTED`, `USER_LIMITED` or `GLOBAL_LIMITED`,
+            whether the user should be told they are limited, and the time until
+            a message is admitted in milliseconds.
+
+    """
+    key = user_bucket_key(user_id)
+    result, notify, wait_ms = await rate_limit_script(
+        keys=[key, GLOBAL_BUCKET_KEY, f"{key}:notice"],
+        args=[
+            settings.RATE_LIMIT_USER_PER_MINUTE / 60,
+            settings.RATE_LIMIT_USER_BURST,
+            settings.RATE_LIMIT_GLOBAL_PER_SECOND,
+            settings.RATE_LIMIT_GLOBAL_BURST,
+        ],
+    )
+    return int(result), bool(notify), int(wait_ms)
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    """Message middleware shedding load before any database or LLM work.
+
+    Messages are rejected while the LLM scheduler queue is longer than
+    `ADMISSION_MAX_LLM_QUEUE_DEPTH`, or above the per-user and global rates, which
+    are enforced in Redis so they hold across replicas. The sender gets a short
+    reply, once per period they are limited for. Messages are admitted if Redis
+    fails.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:  # noqa: ANN401
+        """Handle the message if it's admitted, reply that the bot is busy if not."""
+        if not isinstance(event, Message) or event.from_user is None:
+            return await handler(event, data)
+
+        rejection = await self.check(event.from_user.id)
+        if rejection is None:
+            admission_decisions.labels("admitted").inc()
+            return await handler(event, data)
+
+        result, reply = rejection
+        admission_decisions.labels(result).inc()
+        if reply is not None:
+            await event.answer(reply)
+        return None
+
+    async def check(self, user_id: int) -> tuple[str, str | None] | None:
+        """Check whether a message of a user is admitted.
+
+        Args:
+            user_id (int): The Telegram ID of the user.
+
+        Returns:
+            (tuple[str, str | None] | None): None if the message is admitted,
+                otherwise the reason it's rejected and the reply to send, None to
+                not reply.
+
+        """
+        max_queue_depth = settings.ADMISSION_MAX_LLM_QUEUE_DEPTH
+        if max_queue_depth and app.llm_scheduler.queue_depth >= max_queue_depth:
+            log.warning("Message rejected, LLM queue is full: tg_id=%s", user_id)
+            return "overloaded", BUSY_TEXT
+
+        if not (
+            settings.RATE_LIMIT_USER_PER_MINUTE or settings.RATE_LIMIT_GLOBAL_PER_SECOND
+        ):
+            return None
+        try:
+            result, notify, wait_ms = await take_token(user_id)
+        except Exception:
+            log.exception("Failed to check the rate limit, message admitted")
+            return None
+        if result == ADMITTED:
+            return None
+
+        reason = "user_limited" if result == USER_LIMITED else "global_limited"
+        log.info(
+            "Message rejected, %s for %s ms: tg_id=%s",
+            reason,
+            wait_ms,
+            user_id,
+        )
+        if not notify:
+            return reason, None
+        return reason, RATE_LIMITED_TEXT if result == USER_LIMITED else BUSY_TEXT
@@ -1,27 +1,33 @@
-from redis.asyncio import Redis
-from redis.exceptions import ConnectionError as RedisConnectionError
-from redis.exceptions import TimeoutError as RedisTimeoutError
-
+from chat_bot.app import app
 from chat_bot.config import get_logger, settings
 
 log = get_logger(__name__)
 
-# Initialize Redis client
-redis_client: Redis = Redis(
-    host=settings.REDIS_HOST,
-    port=settings.REDIS_PORT,
-    db=settings.REDIS_DB,
-    decode_responses=True,
-)
-
 
 async def check_redis_connection() -> None:
-    """Check the connection to the Redis server."""
+    """Check the connection to the Redis server and the chat history codec.
+
+    Raises:
+        RuntimeError: If Redis is unreachable, or the package of the configured
+            `HISTORY_FORMAT` or `HISTORY_COMPRESSION` is not installed.
+
+    """
+    from redis.exceptions import ConnectionError as RedisConnectionError  # noqa: PLC0415
+    from redis.exceptions import TimeoutError as RedisTimeoutError  # noqa: PLC0415
+
+    # Fail at startup instead of on the first message if a codec is missing
+    try:
+        _ = app.history_codec
+    except ValueError as e:
+        log.exception("❌ Chat history codec is not available, exiting...")
+        msg: str = "Chat history codec is not available"
+        raise RuntimeError(msg) from e
+
     log.info("Checking Redis server connection...")
     log.debug("Current Redis TTL hours: %s", settings.REDIS_TTL_HOURS)
     log.debug("Current Redis TTL seconds: %s", settings.REDIS_TTL_SECONDS)
     try:
-        response = await redis_client.ping()
+        response = await app.redis.ping()
         if response:
             log.info("✅ Successful connection to the Redis server")
         else:
@@ -1,28 +1,101 @@
 import json
+from dataclasses import dataclass, field
 
+from chat_bot.app import LazyScript, app
 from chat_bot.config import get_logger, settings
-from chat_bot.redis_client import redis_client
+from chat_bot.enums import ChatMode
+from chat_bot.metrics import timed
+from chat_bot.utils import cache_key_from_tg_id
 
 log = get_logger(__name__)
 
+# Append a message to the chat history, trim it, refresh its TTL and return the
+# cached chat mode, the history summary and the history, all in a single round trip.
+# KEYS[1] - chat history list, KEYS[2] - cached chat mode, KEYS[3] - history summary
+# ARGV[1] - message, ARGV[2] - max messages, ARGV[3] - TTL in seconds
+APPEND_AND_READ_SCRIPT = """
+redis.call("RPUSH", KEYS[1], ARGV[1])
+redis.call("LTRIM", KEYS[1], -tonumber(ARGV[2]), -1)
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+redis.call("EXPIRE", KEYS[3], ARGV[3])
+return {
+    redis.call("GET", KEYS[2]),
+    redis.call("GET", KEYS[3]),
+    redis.call("LRANGE", KEYS[1], 0, -1),
+}
+"""
+
+# Replace the oldest messages of the chat history with a summary, unless the
+# history has been changed at its head in the meantime.
+# KEYS[1] - chat history list, KEYS[2] - history summary
+# ARGV[1] - number of summarized messages, ARGV[2] - first summarized message,
+# ARGV[3] - last summarized message, ARGV[4] - summary, ARGV[5] - TTL in seconds
+COMPACT_SCRIPT = """
+local count = tonumber(ARGV[1])
+if redis.call("LINDEX", KEYS[1], 0) ~= ARGV[2]
+    or redis.call("LINDEX", KEYS[1], count - 1) ~= ARGV[3] then
+    return 0
+end
+redis.call("LTRIM", KEYS[1], count, -1)
+redis.call("SET", KEYS[2], ARGV[4], "EX", ARGV[5])
+return 1
+"""
+
+append_and_read_script = LazyScript(APPEND_AND_READ_SCRIPT, client="history_redis")
+compact_script = LazyScript(COMPACT_SCRIPT, client="history_redis")
+
+
+@dataclass
+class ChatSession:
+    """State of a user's conversation stored in Redis.
+
+    Attributes:
+        mode (ChatMode | None): Cached chat mode, None if it's not in the cache.
+        summary (dict | None): Summary of the compacted part of the chat history.
+        messages (list[dict]): Chat history, oldest message first.
 
-async def add_message(key: str, value: str) -> bool:
+    """
+
+    mode: ChatMode | None = None
+    summary: dict | None = None
+    messages: list[dict] = field(default_factory=list)
+
+
+def messages_key_from_tg_id(tg_id: int) -> str:
+    """Generate a chat history key based on the Telegram ID."""
+    return f"chat:{tg_id}:messages"
+
+
+def summary_key_from_tg_id(tg_id: int) -> str:
+    """Generate a chat history summary key based on the Telegram ID."""
+    return f"chat:{tg_id}:summary"
+
+
+def reset_key_from_tg_id(tg_id: int) -> str:
+    """Generate a key marking a recent reset of the chat history."""
+    return f"chat:{tg_id}:reset"
+
+
+@timed
+async def add_message(key: str, value: bytes) -> bool:
     """Add a message to a Redis list and set its expiration time.
 
+    All commands are sent in a single pipelined transaction.
+
     Args:
         key (str): The key to add or update in Redis.
-        value (str): The value to associate with the key.
+        value (bytes): The encoded message to associate with the key.
 
     """
     try:
-        # Add new value to the end of the list
-        await redis_client.rpush(key, value)
-
-        # Set the expiration time for the key
-        await redis_client.expire(key, settings.REDIS_TTL_SECONDS)
-
-        # Trim the list to keep only the last REDIS_MAX_MESSAGES items
-        await redis_client.ltrim(key, -settings.REDIS_MAX_MESSAGES, -1)
+        async with app.history_redis.pipeline(transaction=True) as pipe:
+            # Add new value to the end of the list
+            pipe.rpush(key, value)
+            # Set the expiration time for the key
+            pipe.expire(key, settings.REDIS_TTL_SECONDS)
+            # Trim the list to keep only the last REDIS_MAX_MESSAGES items
+            pipe.ltrim(key, -settings.REDIS_MAX_MESSAGES, -1)
+            await pipe.execute()
     except Exception:
         log.exception(
             "Error adding key/value to Redis: key=%s, value=%s",
@@ -34,28 +107,128 @@ async def add_message(key: str, value: str) -> bool:
         return True
 
 
-async def read_messages(key: str) -> list[dict]:
-    """Read messages from a Redis list.
+async def prepend_messages(tg_id: int, values: list[bytes]) -> bool:
+    """Add messages to the beginning of the user's chat history.
+
+    Args:
+        tg_id (int): The Telegram ID of the user.
+        values (list[bytes]): The encoded messages, oldest first.
+
+    Returns:
+        bool: True if the messages were added, False otherwise.
+
+    """
+    key = messages_key_from_tg_id(tg_id)
+    try:
+        async with app.history_redis.pipeline(transaction=True) as pipe:
+            pipe.lpush(key, *reversed(values))
+            pipe.ltrim(key, -settings.REDIS_MAX_MESSAGES, -1)
+            pipe.expire(key, settings.REDIS_TTL_SECONDS)
+            await pipe.execute()
+    except Exception:
+        log.exception("Error prepending messages to Redis: %s", key)
+        return False
+    else:
+        return True
+
+
+async def is_history_reset(tg_id: int) -> bool:
+    """Check whether the user's chat history has been reset recently."""
+    return bool(await app.redis.exists(reset_key_from_tg_id(tg_id)))
+
+
+@timed
+async def add_message_and_read_session(tg_id: int, value: bytes) -> ChatSession:
+    """Add a message to the user's chat history and read the session state.
+
+    Args:
+        tg_id (int): The Telegram ID of the user.
+        value (bytes): The encoded message to add to the chat history.
+
+    Returns:
+        ChatSession: The cached chat mode, the history summary and the trimmed
+            chat history including the new message. Empty session if an error
+            occurred.
+
+    """
+    key = messages_key_from_tg_id(tg_id)
+    try:
+        cached_mode, summary, values = await append_and_read_script(
+            keys=[key, cache_key_from_tg_id(tg_id), summary_key_from_tg_id(tg_id)],
+            args=[value, settings.REDIS_MAX_MESSAGES, settings.REDIS_TTL_SECONDS],
+        )
+        messages = [app.history_codec.decode(item) for item in values]
+    except Exception:
+        log.exception(
+            "Error updating chat session in Redis: key=%s, value=%s",
+            key,
+            value[:100],
+        )
+        return ChatSession()
+
+    mode: ChatMode | None = ChatMode.__members__.get((cached_mode or b"").decode())
+    return ChatSession(
+        mode=mode,
+        summary=json.loads(summary) if summary else None,
+        messages=messages,
+    )
+
+
+async def read_raw_messages(key: str) -> list[bytes]:
+    """Read messages from a Redis list without decoding them.
 
     Args:
         key (str): The key to read from Redis.
 
     Returns:
-        list[dict]: The list of values associated with the key.
+        list[bytes]: The encoded values associated with the key.
 
     """
     try:
-        values: list = await redis_client.lrange(key, 0, -1)
-        if not values:
-            log.info("Key found, but empty: %s", key)
-            return []
-        log.info("Key found: %s", key)
-        return [dict(json.loads(value)) for value in values]
+        return await app.history_redis.lrange(key, 0, -1)
     except Exception:
         log.exception("Error reading key from Redis: %s", key)
         return []
 
 
+async def replace_messages_with_summary(
+    tg_id: int,
+    summarized: list[bytes],
+    summary: str,
+) -> bool:
+    """Replace the oldest messages of the chat history with their summary.
+
+    Nothing is changed if the oldest messages are no longer `summarized`, e.g. the
+    history has been reset or trimmed while the summary was being generated.
+
+    Args:
+        tg_id (int): The Telegram ID of the user.
+        summarized (list[bytes]): The encoded oldest messages that were summarized.
+        summary (str): The encoded summary that replaces them.
+
+    Returns:
+        bool: True if the messages were replaced, False otherwise.
+
+    """
+    key = messages_key_from_tg_id(tg_id)
+    try:
+        replaced = await compact_script(
+            keys=[key, summary_key_from_tg_id(tg_id)],
+            args=[
+                len(summarized),
+                summarized[0],
+                summarized[-1],
+                summary,
+                settings.REDIS_TTL_SECONDS,
+            ],
+        )
+    except Exception:
+        log.exception("Error compacting chat history in Redis: %s", key)
+        return False
+    else:
+        return bool(replaced)
+
+
 async def delete_messages(tg_id: int) -> bool:
     """Delete user messages from a Redis list.
 
@@ -63,9 +236,14 @@ async def delete_messages(tg_id: int) -> bool:
         tg_id (int): The Telegram ID of the user.
 
     """
+    key = messages_key_from_tg_id(tg_id)
     try:
-        key = f"chat:{tg_id}:messages"
-        await redis_client.delete(key)
+        async with app.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(key, summary_key_from_tg_id(tg_id))
+            # Don't rehydrate the history from the archive until the reset is
+            # archived as well
+            pipe.set(reset_key_from_tg_id(tg_id), 1, ex=settings.REDIS_TTL_SECONDS)
+            await pipe.execute()
     except Exception:
         log.exception("Error deleting key from Redis: %s", key)
         return False
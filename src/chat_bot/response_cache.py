@@ -0,0 +1,155 @@
+import hashlib
+import json
+import time
+
+from chat_bot.app import LazyScript, app
+from chat_bot.config import get_logger, settings
+from chat_bot.metrics import cache_requests
+
+log = get_logger(__name__)
+
+RESPONSE_CACHE_PREFIX = "response_cache:"
+RESPONSE_CACHE_INDEX_KEY = "response_cache_index"
+
+# Store a response and evict the oldest ones above the size limit.
+# KEYS[1] - cache entry, KEYS[2] - index of entries by creation time
+# ARGV[1] - response, ARGV[2] - TTL in seconds, ARGV[3] - creation time,
+# ARGV[4] - maximum number of entries
+CACHE_RESPONSE_SCRIPT = """
+redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2])
+redis.call("ZADD", KEYS[2], ARGV[3], KEYS[1])
+redis.call("ZREMRANGEBYSCORE", KEYS[2], "-inf", ARGV[3] - ARGV[2])
+local excess = redis.call("ZCARD", KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local evicted = redis.call("ZPOPMIN", KEYS[2], excess)
+    for i = 1, #evicted, 2 do
+        redis.call("DEL", evicted[i])
+    end
+end
+return 1
+"""
+
+cache_response_script = LazyScript(CACHE_RESPONSE_SCRIPT)
+
+
+class ResponseCacheStats:
+    """Counters of the response cache lookups.
+
+    Attributes:
+        hits (int): Number of lookups that found a cached response.
+        misses (int): Number of lookups that found nothing.
+
+    """
+
+    def __init__(self) -> None:
+        """Initialize the counters."""
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Get the share of lookups that found a cached response."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict[str, float]:
+        """Get the counters and the hit rate."""
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate}
+
+
+response_cache_stats = ResponseCacheStats()
+cache_requests.set_function(lambda: response_cache_stats.hits, "response", "hit")
+cache_requests.set_function(lambda: response_cache_stats.misses, "response", "miss")
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a message so trivially different messages share a cache entry.
+
+    Args:
+        text (str): The message text.
+
+    Returns:
+        str: Case-folded text with collapsed whitespace and no final punctuation.
+
+    """
+    return " ".join(text.casefold().split()).rstrip(".!?")
+
+
+def get_cache_key(messages: list[dict], model: str) -> str | None:
+    """Get the response cache key of the prompt.
+
+    Only prompts with no summary and a short history are cached, as their
+    responses don't depend on a particular conversation.
+
+    Args:
+        messages (list[dict]): The system prompt followed by the chat history.
+        model (str): The OpenAI model name.
+
+    Returns:
+        (str | None): The cache key, None if the prompt must not be cached.
+
+    """
+    if not settings.RESPONSE_CACHE_ENABLED:
+        return None
+    history = [message for message in messages if message["role"] != "system"]
+    if (
+        len(messages) - len(history) > 1
+        or len(history) > settings.RESPONSE_CACHE_MAX_HISTORY + 1
+    ):
+        return None
+    prompt = [model] + [
+        [message["role"], normalize_text(message["content"])] for message in messages
+    ]
+    digest = hashlib.sha256(json.dumps(prompt).encode()).hexdigest()
+    return RESPONSE_CACHE_PREFIX + digest
+
+
+async def get_cached_response(key: str) -> str | None:
+    """Get a cached response.
+
+    Args:
+        key (str): The cache key of the prompt.
+
+    Returns:
+        (str | None): The cached response, None if it's not cached.
+
+    """
+    try:
+        response: str | None = await app.redis.get(key)
+    except Exception:
+        log.exception("Failed to read response cache: %s", key)
+        return None
+    if response is None:
+        response_cache_stats.misses += 1
+        return None
+    response_cache_stats.hits += 1
+    log.info("Response cache hit, hit rate: %.2f", response_cache_stats.hit_rate)
+    return response
+
+
+async def cache_response(key: str, response: str) -> bool:
+    """Add a response to the cache.
+
+    Args:
+        key (str): The cache key of the prompt.
+        response (str): The response to cache.
+
+    Returns:
+        bool: True if the response was cached, False otherwise.
+
+    """
+    try:
+        await cache_response_script(
+            keys=[key, RESPONSE_CACHE_INDEX_KEY],
+            args=[
+                response,
+                settings.RESPONSE_CACHE_TTL_SECONDS,
+                int(time.time()),
+                settings.RESPONSE_CACHE_MAX_ENTRIES,
+            ],
+        )
+    except Exception:
+        log.exception("Failed to write response cache: %s", key)
+        return False
+    else:
+        return True
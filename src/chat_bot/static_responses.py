@@ -0,0 +1,94 @@
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.types.bot_command import BotCommand
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from pydantic import BaseModel
+
+from chat_bot.config import get_logger
+from chat_bot.enums import ChatMode
+
+log = get_logger(__name__)
+
+ABOUT_TEXT = (
+    "About this bot\n\n"
+    "This bot helps make your conversations easier, faster, and more "
+    "personalized.\n"
+    "Choose your communication style: Casual, Neutral, or Strict.\n"
+    "Use /reset to clear history, /mode to switch style, and /help to see all "
+    "commands.\n"
+    "The bot adapts to your needs and makes chatting simple!"
+)
+NO_COMMANDS_TEXT = "No commands available."
+
+
+class ModeCallback(CallbackData, BaseModel, prefix="mode"):
+    """Callback data for mode options.
+
+    Attributes:
+        mode (str): The selected mode of communication with the bot.
+
+    """
+
+    mode: str
+
+
+def build_help_text(commands: list[BotCommand]) -> str:
+    """Build the reply to `/help`.
+
+    Args:
+        commands (list[BotCommand]): The commands of the bot.
+
+    Returns:
+        str: The list of the commands.
+
+    """
+    if not commands:
+        return NO_COMMANDS_TEXT
+    text = "Here are the available commands\n\n"
+    for command in commands:
+        text += f"/{command.command} - {command.description}\n"
+    return text
+
+
+def build_mode_keyboard() -> InlineKeyboardMarkup:
+    """Build the inline keyboard of `/mode` with a button per chat mode."""
+    builder = InlineKeyboardBuilder()
+    for mode in ChatMode:
+        builder.button(text=mode.value, callback_data=ModeCallback(mode=mode.name))
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+class StaticResponses:
+    """Replies to the commands that are the same for every user.
+
+    They are built once, so the commands are answered without any request but
+    the reply itself.
+
+    Attributes:
+        help_text (str): The reply to `/help`.
+        about_text (str): The reply to `/about`.
+        mode_keyboard (InlineKeyboardMarkup): The keyboard of `/mode`.
+
+    """
+
+    def __init__(self, commands: list[BotCommand]) -> None:
+        """Build the replies.
+
+        Args:
+            commands (list[BotCommand]): The commands of the bot.
+
+        """
+        self.help_text = build_help_text(commands)
+        self.about_text = ABOUT_TEXT
+        self.mode_keyboard = build_mode_keyboard()
+
+    def refresh(self, commands: list[BotCommand]) -> None:
+        """Rebuild the replies listing the commands, after they are set.
+
+        Args:
+            commands (list[BotCommand]): The commands set with `set_my_commands`.
+
+        """
+        self.help_text = build_help_text(commands)
+        log.debug("Static responses refreshed")
@@ -0,0 +1,242 @@
+import asyncio
+import os
+import socket
+import sys
+import time
+from dataclasses import dataclass
+
+from chat_bot.app import app
+from chat_bot.config import get_logger, settings
+from chat_bot.metrics import supervisor_worker_restarts, supervisor_workers
+from chat_bot.update_stream import WORKERS_KEY
+
+log = get_logger(__name__)
+
+# Restart delay doubles for a worker that keeps failing, up to this limit
+MAX_RESTART_DELAY_SECONDS = 60
+
+# A worker running for this long is healthy, its restart delay is reset
+STABLE_SECONDS = 60
+
+# Time given to the workers to exit after the time they have to drain
+KILL_MARGIN_SECONDS = 5
+
+# Limits applied by each process, split between the workers so they hold per host
+SHARED_LIMITS = (
+    "TELEGRAM_GLOBAL_RATE_PER_SECOND",
+    "TELEGRAM_GLOBAL_BURST",
+    "LLM_MAX_CONCURRENCY",
+    "LLM_TOKENS_PER_MINUTE",
+    "ADMISSION_MAX_LLM_QUEUE_DEPTH",
+)
+
+
+@dataclass
+class WorkerProcess:
+    """A stream worker process run by the supervisor.
+
+    Attributes:
+        index (int): Position of the worker, its metrics are served on
+            `METRICS_PORT + 1 + index`.
+        name (str): The worker name in the consumer group.
+        process (asyncio.subprocess.Process | None): The running process.
+        started_at (float): Monotonic time the process was started at.
+        restart_delay (float): Delay before the next restart in seconds.
+        killed (bool): Whether the process was killed for being unresponsive.
+
+    """
+
+    index: int
+    name: str
+    process: asyncio.subprocess.Process | None = None
+    started_at: float = 0.0
+    restart_delay: float = 0.0
+    killed: bool = False
+
+    @property
+    def running(self) -> bool:
+        """Whether the process is running."""
+        return self.process is not None and self.process.returncode is None
+
+
+class WorkerSupervisor:
+    """Run stream worker processes on this host and restart the failed ones.
+
+    The supervisor publishes the updates to the streams partitioned by chat, each
+    partition is leased to a single worker, so the updates of a chat are handled
+    in order while the workers use all the CPU cores. Each worker is a separate
+    interpreter with its own clients of Telegram, OpenAI, Redis and the database,
+    and gets an even share of the Telegram and LLM limits. A worker that exits is
+    restarted, one that stops renewing its leases is killed first.
+    """
+
+    def __init__(self, workers: int, restart_delay: float) -> None:
+        """Initialize the supervisor.
+
+        Args:
+            workers (int): Number of worker processes.
+            restart_delay (float): Delay before restarting a worker that exited,
+                doubled while it keeps failing.
+
+        """
+        prefix = settings.STREAM_WORKER_NAME or socket.gethostname()
+        # Stable names, so a restarted worker takes its partitions back right away
+        self.workers = [
+            WorkerProcess(index=index, name=f"{prefix}:{index}")
+            for index in range(workers)
+        ]
+        self.restart_delay = restart_delay
+        self.limits = get_worker_limits(workers)
+        self._stopping = False
+        self._tasks: list[asyncio.Task] = []
+        supervisor_workers.set_function(
+            lambda: sum(worker.running for worker in self.workers),
+        )
+
+    def start(self) -> None:
+        """Start the workers and keep them running until `stop`."""
+        log.info("Starting %s stream worker processes", len(self.workers))
+        self._tasks = [
+            *(asyncio.create_task(self._keep_running(w)) for w in self.workers),
+            asyncio.create_task(self._monitor()),
+        ]
+
+    async def stop(self, timeout: float) -> None:  # noqa: ASYNC109
+        """Ask the workers to stop and wait for them to exit.
+
+        Args:
+            timeout (float): Time given to the workers to finish the updates they
+                are handling, they are killed after it.
+
+        """
+        self._stopping = True
+        running = [worker.process for worker in self.workers if worker.running]
+        for process in running:
+            process.terminate()
+        if running:
+            _, pending = await asyncio.wait(
+                [asyncio.create_task(process.wait()) for process in running],
+                timeout=timeout + KILL_MARGIN_SECONDS,
+            )
+            if pending:
+                log.warning("Killing %s workers that did not stop", len(pending))
+                for process in running:
+                    if process.returncode is None:
+                        process.kill()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        log.info("Stream worker processes stopped")
+
+    async def _spawn(self, worker: WorkerProcess) -> None:
+        env = {
+            **os.environ,
+            "PROCESS_ROLE": "worker",
+            "STREAM_WORKER_NAME": worker.name,
+            "METRICS_PORT": str(settings.METRICS_PORT + 1 + worker.index),
+            **self.limits,
+        }
+        worker.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "chat_bot.main",
+            env=env,
+        )
+        worker.started_at = time.monotonic()
+        worker.killed = False
+        log.info("Worker %s started: pid=%s", worker.name, worker.process.pid)
+
+    async def _keep_running(self, worker: WorkerProcess) -> None:
+        while not self._stopping:
+            try:
+                await self._spawn(worker)
+            except OSError:
+                log.exception("Failed to start worker %s", worker.name)
+                reason = "start_failed"
+            else:
+                returncode = await worker.process.wait()
+                if self._stopping:
+                    return
+                log.error("Worker %s exited: code=%s", worker.name, returncode)
+                reason = "unresponsive" if worker.killed else "exited"
+            supervisor_worker_restarts.labels(reason).inc()
+
+            if time.monotonic() - worker.started_at >= STABLE_SECONDS:
+                worker.restart_delay = self.restart_delay
+            else:
+                worker.restart_delay = min(
+                    max(worker.restart_delay * 2, self.restart_delay),
+                    MAX_RESTART_DELAY_SECONDS,
+                )
+            log.info(
+                "Restarting worker %s in %s s",
+                worker.name,
+                worker.restart_delay,
+            )
+            await asyncio.sleep(worker.restart_delay)
+
+    async def _monitor(self) -> None:
+        """Kill the workers that stopped renewing their partition leases."""
+        lease_seconds = settings.STREAM_LEASE_SECONDS
+        while True:
+            await asyncio.sleep(lease_seconds / 3)
+            try:
+                seconds, microseconds = await app.redis.time()
+                heartbeats = await app.redis.zmscore(
+                    WORKERS_KEY,
+                    [worker.name for worker in self.workers],
+                )
+            except Exception:
+                log.exception("Failed to check the worker heartbeats")
+                continue
+            now_ms = seconds * 1000 + microseconds // 1000
+            for worker, heartbeat in zip(self.workers, heartbeats, strict=True):
+                # Give a new worker time to start before it's expected to renew
+                if (
+                    not worker.running
+                    or time.monotonic() - worker.started_at < lease_seconds
+                ):
+                    continue
+                if heartbeat is None or now_ms - heartbeat > lease_seconds * 1000:
+                    log.error("Worker %s is unresponsive, killing it", worker.name)
+                    worker.killed = True
+                    worker.process.kill()
+
+
+def get_worker_count() -> int:
+    """Get the number of worker processes, one per CPU core by default.
+
+    There are no more workers than stream partitions, the others would be idle.
+    """
+    workers = settings.SUPERVISOR_WORKERS or os.cpu_count() or 1
+    if workers > settings.STREAM_PARTITIONS:
+        log.warning(
+            "Running %s workers instead of %s, one per stream partition",
+            settings.STREAM_PARTITIONS,
+            workers,
+        )
+        return settings.STREAM_PARTITIONS
+    return workers
+
+
+def get_worker_limits(workers: int) -> dict[str, str]:
+    """Get the share of the limits of each worker, as environment variables.
+
+    The limits are applied by each process, so without it every worker would get
+    all of them. The unlimited ones (0) stay unlimited, the others are at least 1.
+
+    Args:
+        workers (int): Number of worker processes.
+
+    Returns:
+        dict[str, str]: Values of the `SHARED_LIMITS` settings by name.
+
+    """
+    limits = {}
+    for name in SHARED_LIMITS:
+        value: float = getattr(settings, name)
+        share = value / workers
+        if isinstance(value, int):
+            share = max(value // workers, 1) if value else 0
+        limits[name] = str(share)
+    return limits
@@ -0,0 +1,34 @@
+import time
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from chat_bot.metrics import telegram_request_duration, telegram_request_errors
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Bot session middleware recording the duration of Telegram API requests."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        """Time the request."""
+        method_name = type(method).__name__
+        started_at = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            telegram_request_errors.labels(method_name, type(e).__name__).inc()
+            raise
+        finally:
+            telegram_request_duration.labels(method_name).observe(
+                time.perf_counter() - started_at,
+            )
@@ -0,0 +1,395 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from contextlib import contextmanager, suppress
+from contextvars import Context, ContextVar, copy_context
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from chat_bot.app import app
+from chat_bot.config import get_logger
+from chat_bot.metrics import telegram_outbound_requests
+
+log = get_logger(__name__)
+
+# Requests are sent by priority, then in the order they were made
+PRIORITY_REPLY = 0
+PRIORITY_PROGRESS = 1
+
+# Tokens of a chat bucket progress requests leave to the replies, so a final
+# reply isn't delayed by the progress edits sent before it. The first edit of a
+# message doesn't leave any, it's the first text the user sees
+REPLY_RESERVE = 1
+
+# Retries of a reply rejected with a flood wait
+MAX_RETRIES = 3
+
+# Chats idle for longer than this are forgotten, their bucket is full anyway
+CHAT_IDLE_SECONDS = 60
+
+request_priority: ContextVar[int] = ContextVar(
+    "telegram_request_priority",
+    default=PRIORITY_REPLY,
+)
+
+
+@contextmanager
+def progress_requests() -> Iterator[None]:
+    """Send the Telegram requests made in the context after the pending replies.
+
+    Used for the requests showing progress, e.g. edits of a streamed response,
+    which are worthless once a newer one is sent.
+    """
+    token = request_priority.set(PRIORITY_PROGRESS)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+@dataclass(order=True)
+class OutboundRequest:
+    """A Telegram request waiting to be sent.
+
+    Attributes:
+        priority (int): `PRIORITY_REPLY` or `PRIORITY_PROGRESS`.
+        sequence (int): Order the request was made in.
+        send (Callable[[], Awaitable[Any]]): Sends the request.
+        futures (list[asyncio.Future]): Futures of the callers waiting for the
+            result, including the ones of the edits this request superseded.
+        context (Context): Context of the caller, the request is sent in.
+        edit_key (tuple[int | str, int] | None): The chat and the message the
+            request edits, None if it's not an edit.
+        superseded (bool): Whether a newer edit of the message replaced it.
+        retries (int): Number of flood waits the request got.
+
+    """
+
+    priority: int
+    sequence: int
+    send: Callable[[], Awaitable[Any]] = field(compare=False)
+    futures: list[asyncio.Future] = field(compare=False)
+    context: Context = field(compare=False, default_factory=copy_context)
+    edit_key: tuple[int | str, int] | None = field(compare=False, default=None)
+    superseded: bool = field(compare=False, default=False)
+    retries: int = field(compare=False, default=0)
+
+    @property
+    def abandoned(self) -> bool:
+        """Whether no caller waits for the request anymore."""
+        return self.superseded or all(future.done() for future in self.futures)
+
+
+@dataclass
+class ChatQueue:
+    """Requests to a chat and the token bucket of the chat."""
+
+    tokens: float
+    updated_at: float
+    paused_until: float = 0.0
+    busy: bool = False
+    requests: list[OutboundRequest] = field(default_factory=list)
+    # The last message an edit was sent for
+    edited_message_id: int | None = None
+
+
+class TelegramScheduler:
+    """Shape the requests sent to Telegram to its flood limits.
+
+    Requests to chats go through a global token bucket and a bucket per chat, and
+    a chat has a single request in flight at a time. Replies are sent before
+    progress edits, which leave a token of the chat bucket to them except for
+    the first edit of a message. An edit
+    waiting to be sent is replaced by a newer edit of the same message, and
+    replies rejected with a flood wait are retried after it, pausing the chat
+    meanwhile. The limits hold in this process only.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        chat_rate: float,
+        chat_burst: int,
+    ) -> None:
+        """Initialize the scheduler.
+
+        Args:
+            rate (float): Requests per second to all chats.
+            burst (int): Requests sent at once to all chats.
+            chat_rate (float): Requests per second to a chat.
+            chat_burst (int): Requests sent at once to a chat.
+
+        """
+        self._rate = rate
+        self._burst = burst
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._chats: dict[int | str, ChatQueue] = {}
+        self._edits: dict[tuple[int | str, int], OutboundRequest] = {}
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._runner: asyncio.Task | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self._pruned_at = time.monotonic()
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Get the number of requests waiting to be sent."""
+        return sum(
+            not request.abandoned
+            for chat in self._chats.values()
+            for request in chat.requests
+        )
+
+    async def submit(
+        self,
+        chat_id: int | str,
+        send: Callable[[], Awaitable[Any]],
+        edit_key: tuple[int | str, int] | None = None,
+        priority: int = PRIORITY_REPLY,
+    ) -> Any:  # noqa: ANN401
+        """Send a request to a chat when the limits allow it.
+
+        Args:
+            chat_id (int | str): The chat the request is sent to.
+            send (Callable[[], Awaitable[Any]]): Sends the request, may be called
+                again after a flood wait.
+            edit_key (tuple[int | str, int] | None): The chat and the message the
+                request edits, None if it's not an edit.
+            priority (int): `PRIORITY_REPLY` or `PRIORITY_PROGRESS`.
+
+        Returns:
+            Any: The result of the request, or of the newer edit of the same
+                message that replaced it.
+
+        """
+        future = asyncio.get_running_loop().create_future()
+        request = OutboundRequest(priority, next(self._sequence), send, [future])
+        if edit_key is not None:
+            request.edit_key = edit_key
+            previous = self._edits.get(edit_key)
+            if previous is not None:
+                # Take the place of the older edit, which gets this one's result
+                previous.superseded = True
+                request.priority = min(request.priority, previous.priority)
+                request.sequence = previous.sequence
+                request.futures[:0] = previous.futures
+                self.coalesced += 1
+                telegram_outbound_requests.labels("coalesced").inc()
+            self._edits[edit_key] = request
+
+        now = time.monotonic()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = ChatQueue(self._chat_burst, now)
+        heapq.heappush(chat.requests, request)
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return await future
+
+    async def close(self) -> None:
+        """Stop sending, the waiting requests are cancelled."""
+        if self._runner is not None:
+            self._runner.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._runner
+        for chat in self._chats.values():
+            for request in chat.requests:
+                for future in request.futures:
+                    future.cancel()
+        self._chats.clear()
+        self._edits.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Get the scheduler counters.
+
+        Returns:
+            dict[str, int]: Queue depth, sent, coalesced and retried requests.
+
+        """
+        return {
+            "queue_depth": self.queue_depth,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+        }
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            delay = self._dispatch()
+            with suppress(TimeoutError):
+                async with asyncio.timeout(delay):
+                    await self._wakeup.wait()
+
+    def _dispatch(self) -> float | None:
+        """Send the requests the limits allow.
+
+        Returns:
+            (float | None): Time until the next request can be sent, None if
+                there is none waiting.
+
+        """
+        now = time.monotonic()
+        self._tokens = min(
+            self._burst,
+            self._tokens + (now - self._refilled_at) * self._rate,
+        )
+        self._refilled_at = now
+        if now - self._pruned_at > CHAT_IDLE_SECONDS:
+            self._prune(now)
+
+        delay: float | None = None
+        ready: list[tuple[OutboundRequest, ChatQueue]] = []
+        for chat in self._chats.values():
+            while chat.requests and chat.requests[0].abandoned:
+                self._forget(heapq.heappop(chat.requests))
+            if not chat.requests or chat.busy:
+                continue
+            chat.tokens = min(
+                self._chat_burst,
+                chat.tokens + (now - chat.updated_at) * self._chat_rate,
+            )
+            chat.updated_at = now
+            needed = 1
+            request = chat.requests[0]
+            if request.priority != PRIORITY_REPLY and not (
+                request.edit_key and request.edit_key[1] != chat.edited_message_id
+            ):
+                needed = min(1 + REPLY_RESERVE, self._chat_burst)
+            wait = max(
+                chat.paused_until - now,
+                (needed - chat.tokens) / self._chat_rate,
+            )
+            if wait > 0:
+                delay = wait if delay is None else min(delay, wait)
+            else:
+                ready.append((chat.requests[0], chat))
+
+        ready.sort(key=lambda item: item[0])
+        for request, chat in ready:
+            if self._tokens < 1:
+                wait = (1 - self._tokens) / self._rate
+                return wait if delay is None else min(delay, wait)
+            self._tokens -= 1
+            chat.tokens -= 1
+            chat.busy = True
+            heapq.heappop(chat.requests)
+            self._forget(request)
+            if request.edit_key:
+                chat.edited_message_id = request.edit_key[1]
+            task = asyncio.create_task(
+                self._send(chat, request),
+                context=request.context,
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return delay
+
+    async def _send(self, chat: ChatQueue, request: OutboundRequest) -> None:
+        try:
+            result = await request.send()
+        except TelegramRetryAfter as e:
+            chat.paused_until = time.monotonic() + e.retry_after
+            # Progress is stale by then, the caller gets the error instead
+            if request.priority != PRIORITY_REPLY or request.retries >= MAX_RETRIES:
+                self._resolve(request, exception=e)
+                return
+            request.retries += 1
+            self.retried += 1
+            telegram_outbound_requests.labels("retried").inc()
+            log.warning("Telegram flood wait, retrying in %s s", e.retry_after)
+            newer = self._edits.get(request.edit_key) if request.edit_key else None
+            if newer is not None:
+                # A newer edit of the message is waiting, it's sent instead
+                newer.futures[:0] = request.futures
+            else:
+                if request.edit_key:
+                    self._edits[request.edit_key] = request
+                heapq.heappush(chat.requests, request)
+        except Exception as e:  # noqa: BLE001
+            self._resolve(request, exception=e)
+        else:
+            self._resolve(request, result=result)
+        finally:
+            chat.busy = False
+            self._wakeup.set()
+
+    def _resolve(
+        self,
+        request: OutboundRequest,
+        result: Any = None,  # noqa: ANN401
+        exception: BaseException | None = None,
+    ) -> None:
+        self.sent += 1
+        telegram_outbound_requests.labels(
+            "sent" if exception is None else "failed",
+        ).inc()
+        for future in request.futures:
+            if future.done():
+                continue
+            if exception is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exception)
+
+    def _forget(self, request: OutboundRequest) -> None:
+        if request.edit_key and self._edits.get(request.edit_key) is request:
+            del self._edits[request.edit_key]
+
+    def _prune(self, now: float) -> None:
+        self._pruned_at = now
+        idle = [
+            chat_id
+            for chat_id, chat in self._chats.items()
+            if not chat.requests
+            and not chat.busy
+            and now - chat.updated_at > CHAT_IDLE_SECONDS
+        ]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+
+class TelegramSchedulerMiddleware(BaseRequestMiddleware):
+    """Bot session middleware sending the requests to chats through the scheduler.
+
+    Requests without a chat, e.g. `getUpdates`, are sent right away.
+    """
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        """Send the request when the flood limits allow it."""
+        chat_id: int | str | None = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        edit_key = None
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            edit_key = (chat_id, method.message_id)
+        return await app.telegram_scheduler.submit(
+            chat_id,
+            lambda: make_request(bot, method),
+            edit_key,
+            request_priority.get(),
+        )
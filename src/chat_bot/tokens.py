@@ -0,0 +1,105 @@
+from functools import cache
+from typing import Any
+
+from chat_bot.config import get_logger, settings
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+log = get_logger(__name__)
+
+# Average number of characters per token, used when tiktoken is not available
+CHARS_PER_TOKEN = 4
+
+# Tokens added by the chat format to every message (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Encoding used for models unknown to tiktoken
+DEFAULT_ENCODING = "o200k_base"
+
+
+@cache
+def get_encoding(model: str) -> Any | None:  # noqa: ANN401
+    """Get the tiktoken encoding for the model.
+
+    Args:
+        model (str): The OpenAI model name.
+
+    Returns:
+        (Encoding | None): The encoding, None if tiktoken is not available.
+
+    """
+    if tiktoken is None:
+        log.info("tiktoken is not installed, token counts are estimated")
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception:
+        log.exception("Failed to load tiktoken encoding, token counts are estimated")
+        return None
+
+
+def count_tokens(text: str, model: str | None = None) -> int:
+    """Count the tokens a chat message with the given text takes.
+
+    Args:
+        text (str): The message content.
+        model (str | None): The OpenAI model name, defaults to `settings.MODEL`.
+
+    Returns:
+        int: Number of tokens including the per-message overhead.
+
+    """
+    encoding = get_encoding(model or settings.MODEL)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS
+    return len(encoding.encode(text)) + MESSAGE_OVERHEAD_TOKENS
+
+
+def get_history_token_budget(model: str | None = None) -> int:
+    """Get the token budget of the chat history for the model.
+
+    Args:
+        model (str | None): The OpenAI model name, defaults to `settings.MODEL`.
+
+    Returns:
+        int: Maximum number of tokens of the chat history sent to the model.
+
+    """
+    model = model or settings.MODEL
+    return settings.MODEL_HISTORY_TOKEN_BUDGETS.get(
+        model,
+        settings.HISTORY_TOKEN_BUDGET,
+    )
+
+
+def select_history(messages: list[dict], budget: int) -> list[dict]:
+    """Select the newest messages that fit into the token budget.
+
+    Token counts stored alongside the messages are used, so the history is not
+    re-tokenized on every turn. The newest message is always selected.
+
+    Args:
+        messages (list[dict]): Chat history with token counts, oldest first.
+        budget (int): Maximum number of tokens of the selected messages.
+
+    Returns:
+        list[dict]: Selected messages without token counts, oldest first.
+
+    """
+    selected: list[dict] = []
+    used_tokens = 0
+    for message in reversed(messages):
+        tokens: int = message.get("tokens") or count_tokens(message["content"])
+        if selected and used_tokens + tokens > budget:
+            break
+        used_tokens += tokens
+        selected.append({"role": message["role"], "content": message["content"]})
+    selected.reverse()
+    log.debug("Selected %s messages, %s tokens", len(selected), used_tokens)
+    return selected
@@ -0,0 +1,180 @@
+import asyncio
+import uuid
+from collections.abc import Coroutine
+from typing import Any
+
+from chat_bot.app import app
+from chat_bot.config import get_logger
+from chat_bot.metrics import cancelled_turns
+
+log = get_logger(__name__)
+
+TURN_CANCELLATION_CHANNEL = "turns:cancel"
+
+# Identifies the cancellations published by this process, which are already done
+INSTANCE_ID = uuid.uuid4().hex
+
+# Time given to the cancelled turns to finish
+CANCEL_TIMEOUT_SECONDS = 5
+
+
+class TurnCancelledError(Exception):
+    """The turn was cancelled because its response became stale.
+
+    Attributes:
+        reason (str): Why the turn was cancelled, e.g. `reset`.
+
+    """
+
+    def __init__(self, reason: str) -> None:
+        """Initialize the error.
+
+        Args:
+            reason (str): Why the turn was cancelled, e.g. `reset`.
+
+        """
+        super().__init__(f"Turn cancelled: {reason}")
+        self.reason = reason
+
+
+class TurnTracker:
+    """AI turns in progress by chat, so the stale ones can be cancelled.
+
+    A turn runs in its own task, so cancelling it stops the OpenAI request and
+    the writes of the response to the chat history, but not the handler of the
+    update that started it, which gets a `TurnCancelledError`.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the tracker."""
+        # Task of each turn and the task waiting for it, by chat
+        self._turns: dict[int, dict[asyncio.Task, asyncio.Task]] = {}
+        self._reasons: dict[asyncio.Task, str] = {}
+
+    @property
+    def active(self) -> int:
+        """Get the number of turns in progress."""
+        return sum(len(turns) for turns in self._turns.values())
+
+    async def run[T](self, chat_id: int, turn: Coroutine[Any, Any, T]) -> T:
+        """Run a turn of a chat until it's done or cancelled.
+
+        Args:
+            chat_id (int): The chat ID.
+            turn (Coroutine[Any, Any, T]): The turn.
+
+        Returns:
+            T: The result of the turn.
+
+        Raises:
+            TurnCancelledError: If the turn was cancelled by `cancel`.
+
+        """
+        task = asyncio.create_task(turn)
+        waiter = asyncio.current_task()
+        turns = self._turns.setdefault(chat_id, {})
+        turns[task] = waiter
+        try:
+            return await task
+        except asyncio.CancelledError:
+            reason = self._reasons.get(task)
+            # The waiter itself is cancelled, the turn is cancelled with it
+            if reason is None or (waiter is not None and waiter.cancelling()):
+                raise
+            raise TurnCancelledError(reason) from None
+        finally:
+            del turns[task]
+            if not turns:
+                self._turns.pop(chat_id, None)
+            self._reasons.pop(task, None)
+
+    async def cancel(self, chat_id: int, reason: str, *, wait: bool = True) -> int:
+        """Cancel the turns of a chat.
+
+        Args:
+            chat_id (int): The chat ID.
+            reason (str): Why the turns are cancelled, e.g. `reset`.
+            wait (bool): Wait for the turns and their handlers to finish, so the
+                writes they had started are done when it returns.
+
+        Returns:
+            int: Number of cancelled turns.
+
+        """
+        turns = dict(self._turns.get(chat_id, {}))
+        for task in turns:
+            self._reasons[task] = reason
+            task.cancel()
+        if not turns:
+            return 0
+        cancelled_turns.labels(reason).inc(len(turns))
+        log.info("Cancelled %s turns, %s: chat_id=%s", len(turns), reason, chat_id)
+        if not wait:
+            return len(turns)
+        current = asyncio.current_task()
+        tasks = {*turns, *turns.values()} - {current, None}
+        await asyncio.wait(tasks, timeout=CANCEL_TIMEOUT_SECONDS)
+        return len(turns)
+
+    async def cancel_all(self, reason: str) -> int:
+        """Cancel the turns of all chats, e.g. on shutdown.
+
+        Args:
+            reason (str): Why the turns are cancelled.
+
+        Returns:
+            int: Number of cancelled turns.
+
+        """
+        counts = await asyncio.gather(
+            *(self.cancel(chat_id, reason) for chat_id in list(self._turns)),
+        )
+        return sum(counts)
+
+
+turn_tracker = TurnTracker()
+
+
+async def cancel_turns(chat_id: int, reason: str) -> int:
+    """Cancel the turns of a chat in this process and in the other bot instances.
+
+    Args:
+        chat_id (int): The chat ID.
+        reason (str): Why the turns are cancelled, e.g. `reset`.
+
+    Returns:
+        int: Number of turns cancelled in this process.
+
+    """
+    try:
+        await app.redis.publish(
+            TURN_CANCELLATION_CHANNEL,
+            f"{INSTANCE_ID}:{chat_id}:{reason}",
+        )
+    except Exception:
+        log.exception("Failed to publish turn cancellation: %s", chat_id)
+    return await turn_tracker.cancel(chat_id, reason)
+
+
+async def listen_turn_cancellations() -> None:
+    """Cancel the turns cancelled by other bot instances.
+
+    Runs until cancelled. Cancellations published while disconnected are lost.
+    """
+    from redis.exceptions import ConnectionError as RedisConnectionError  # noqa: PLC0415
+    from redis.exceptions import TimeoutError as RedisTimeoutError  # noqa: PLC0415
+
+    while True:
+        try:
+            async with app.redis.pubsub() as pubsub:
+                await pubsub.subscribe(TURN_CANCELLATION_CHANNEL)
+                log.info("Subscribed to turn cancellations")
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    instance_id, chat_id, reason = message["data"].split(":", 2)
+                    if instance_id != INSTANCE_ID:
+                        await turn_tracker.cancel(int(chat_id), reason, wait=False)
+        except (RedisConnectionError, RedisTimeoutError, OSError):
+            log.exception("Turn cancellation subscription lost, reconnecting...")
+            await asyncio.sleep(1)
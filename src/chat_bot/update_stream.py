@@ -0,0 +1,385 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import Chat, TelegramObject, Update, User
+
+from chat_bot.app import LazyScript, app
+from chat_bot.config import get_logger, settings
+from chat_bot.metrics import stream_partitions, stream_updates
+from chat_bot.webhook import wait_for_stop_signal
+
+log = get_logger(__name__)
+
+CONSUMER_GROUP = "chat-bot"
+WORKERS_KEY = "updates:workers"
+
+# Maximum time a read waits for new updates, also bounds the time to stop a worker
+READ_BLOCK_MS = 1000
+
+# Register the worker as alive, renew the leases of the partitions it holds and
+# acquire free partitions up to its fair share among the live workers.
+# KEYS[1] - live workers sorted set, KEYS[2..] - partition leases
+# ARGV[1] - worker name, ARGV[2] - lease TTL in milliseconds
+# Returns the fair share and the indexes of the partitions held by the worker.
+LEASE_SCRIPT = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local ttl = tonumber(ARGV[2])
+redis.call("ZADD", KEYS[1], now, ARGV[1])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now - ttl)
+redis.call("PEXPIRE", KEYS[1], ttl)
+local share = math.ceil((#KEYS - 1) / redis.call("ZCARD", KEYS[1]))
+local held = {}
+for i = 2, #KEYS do
+    if redis.call("GET", KEYS[i]) == ARGV[1] then
+        redis.call("PEXPIRE", KEYS[i], ttl)
+        held[#held + 1] = i - 2
+    end
+end
+for i = 2, #KEYS do
+    if #held >= share then
+        break
+    end
+    if redis.call("SET", KEYS[i], ARGV[1], "NX", "PX", ttl) then
+        held[#held + 1] = i - 2
+    end
+end
+return {share, held}
+"""
+
+# Release the leases still held by the worker.
+# KEYS - partition leases, ARGV[1] - worker name
+RELEASE_SCRIPT = """
+for i = 1, #KEYS do
+    if redis.call("GET", KEYS[i]) == ARGV[1] then
+        redis.call("DEL", KEYS[i])
+    end
+end
+"""
+
+lease_script = LazyScript(LEASE_SCRIPT)
+release_script = LazyScript(RELEASE_SCRIPT)
+
+
+def stream_key(partition: int) -> str:
+    """Get the Redis key of the stream of a partition."""
+    return f"updates:{partition}"
+
+
+def lease_key(partition: int) -> str:
+    """Get the Redis key of the lease of a partition."""
+    return f"updates:{partition}:lease"
+
+
+def partition_for_chat(chat_id: int) -> int:
+    """Get the partition of the updates of a chat."""
+    return chat_id % settings.STREAM_PARTITIONS
+
+
+async def publish_update(update: Update, chat_id: int) -> None:
+    """Add an update to the stream of its chat's partition.
+
+    Args:
+        update (Update): The update to publish.
+        chat_id (int): The chat the update belongs to.
+
+    """
+    await app.redis.xadd(
+        stream_key(partition_for_chat(chat_id)),
+        {"update": update.model_dump_json(by_alias=True, exclude_none=True)},
+        maxlen=settings.STREAM_MAX_LENGTH,
+    )
+
+
+class UpdatePublisher(BaseMiddleware):
+    """Update middleware publishing the updates to the streams instead of handling.
+
+    Registered as the last outer middleware of the dispatcher of an ingestion
+    process, so polling and the webhook feed the streams unchanged.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],  # noqa: ARG002
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> None:
+        """Publish the update without calling the handlers."""
+        # Set by the dispatcher's own middleware from the update
+        chat: Chat | None = data.get("event_chat")
+        user: User | None = data.get("event_from_user")
+        chat_id = chat.id if chat else user.id if user else 0
+        try:
+            await publish_update(event, chat_id)
+        except Exception:
+            stream_updates.labels("publish_failed").inc()
+            log.exception("Failed to publish update: %s", event.update_id)
+        else:
+            stream_updates.labels("published").inc()
+
+
+class StreamWorker:
+    """Consume the updates from the streams and feed them to the dispatcher.
+
+    The streams are consumed through a consumer group. Each partition is leased to
+    a single live worker, so the updates of a chat are handled by one process, and
+    the partitions are spread evenly among the workers. Updates are read in the
+    order they were published but handled concurrently, as with polling, so a new
+    message can cancel the turn of the previous one; their order is best-effort.
+    The updates of a partition left pending for `lease_seconds` by a previous
+    owner, e.g. after a crash, are claimed by the worker holding it. Updates are
+    handled at least once.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        name: str,
+        lease_seconds: float,
+        max_tasks: int,
+    ) -> None:
+        """Initialize the worker.
+
+        Args:
+            dispatcher (Dispatcher): The dispatcher to feed the updates to.
+            bot (Bot): The bot the updates are for.
+            name (str): Unique name of the worker in the consumer group.
+            lease_seconds (float): Time a partition stays leased to a worker that
+                stopped renewing it.
+            max_tasks (int): Maximum number of updates handled concurrently.
+
+        """
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.name = name
+        self.lease_ms = int(lease_seconds * 1000)
+        self.max_tasks = max_tasks
+        self._partitions: set[int] = set()
+        self._renewed_at = 0.0
+        self._stopping = False
+        # Updates being handled by partition, and their entry IDs
+        self._tasks: dict[int, set[asyncio.Task]] = {}
+        self._entries: set[str] = set()
+
+    @property
+    def active(self) -> int:
+        """Number of updates being handled."""
+        return sum(map(len, self._tasks.values()))
+
+    async def run(self) -> None:
+        """Consume the updates until the worker is stopped."""
+        await self._create_groups()
+        log.info("Stream worker %s started", self.name)
+        while not self._stopping:
+            if time.monotonic() - self._renewed_at >= self.lease_ms / 3000:
+                await self._renew_leases()
+            await self._read()
+
+    def stop(self) -> None:
+        """Stop reading new updates."""
+        self._stopping = True
+
+    async def drain(self, timeout: float) -> None:  # noqa: ASYNC109
+        """Wait for the updates being handled and release the leases.
+
+        Args:
+            timeout (float): Maximum time to wait in seconds.
+
+        """
+        tasks = set().union(*self._tasks.values())
+        if tasks:
+            log.info("Waiting for %s updates to be handled", len(tasks))
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        await self._release(self._partitions)
+
+    async def _create_groups(self) -> None:
+        from redis.exceptions import ResponseError  # noqa: PLC0415
+
+        for partition in range(settings.STREAM_PARTITIONS):
+            try:
+                await app.redis.xgroup_create(
+                    stream_key(partition),
+                    CONSUMER_GROUP,
+                    id="0",
+                    mkstream=True,
+                )
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    async def _renew_leases(self) -> None:
+        try:
+            share, held = await lease_script(
+                keys=[
+                    WORKERS_KEY,
+                    *map(lease_key, range(settings.STREAM_PARTITIONS)),
+                ],
+                args=[self.name, self.lease_ms],
+            )
+        except Exception:
+            log.exception("Failed to renew the stream partition leases")
+            return
+        self._renewed_at = time.monotonic()
+        held = set(held)
+        if lost := self._partitions - held:
+            log.warning("Stream partitions taken over by another worker: %s", lost)
+        for partition in sorted(held - self._partitions):
+            log.info("Stream partition %s acquired", partition)
+        self._partitions = held
+        for partition in sorted(held):
+            await self._reclaim(partition)
+
+        # Give the partitions above the fair share to the workers that joined,
+        # once the updates of the partition being handled are done
+        idle = [p for p in sorted(held, reverse=True) if not self._tasks.get(p)]
+        if extra := idle[: max(len(held) - share, 0)]:
+            await self._release(extra)
+        stream_partitions.set(len(self._partitions))
+
+    async def _release(self, partitions: set[int] | list[int]) -> None:
+        if not partitions:
+            return
+        try:
+            await release_script(
+                keys=list(map(lease_key, partitions)),
+                args=[self.name],
+            )
+        except Exception:
+            log.exception("Failed to release stream partitions: %s", partitions)
+            return
+        log.info("Stream partitions released: %s", sorted(partitions))
+        self._partitions -= set(partitions)
+        stream_partitions.set(len(self._partitions))
+
+    async def _reclaim(self, partition: int) -> None:
+        # The partition is leased to this worker, an update pending for the lease
+        # TTL was left by a previous owner that stopped before acknowledging it.
+        # A younger one may still be handled by a previous owner whose lease has
+        # just expired, it's claimed by a later renewal if it's never acknowledged.
+        start_id = "0-0"
+        while True:
+            try:
+                start_id, entries, *_ = await app.redis.xautoclaim(
+                    stream_key(partition),
+                    CONSUMER_GROUP,
+                    self.name,
+                    min_idle_time=self.lease_ms,
+                    start_id=start_id,
+                    count=100,
+                )
+            except Exception:
+                log.exception("Failed to claim the updates of partition %s", partition)
+                return
+            # The updates this worker is still handling are claimed too
+            entries = [entry for entry in entries if entry[0] not in self._entries]
+            if entries:
+                log.info(
+                    "Reclaimed %s pending updates of stream partition %s",
+                    len(entries),
+                    partition,
+                )
+                stream_updates.labels("reclaimed").inc(len(entries))
+            for entry_id, fields in entries:
+                self._spawn(partition, entry_id, fields)
+            if start_id == "0-0":
+                return
+
+    async def _read(self) -> None:
+        count = self.max_tasks - self.active
+        if not self._partitions or count <= 0:
+            # Wait for a lease or a free slot
+            tasks = set().union(*self._tasks.values())
+            if tasks:
+                await asyncio.wait(
+                    tasks,
+                    timeout=READ_BLOCK_MS / 1000,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            else:
+                await asyncio.sleep(READ_BLOCK_MS / 1000)
+            return
+        try:
+            response = await app.redis.xreadgroup(
+                CONSUMER_GROUP,
+                self.name,
+                {stream_key(p): ">" for p in sorted(self._partitions)},
+                count=count,
+                block=READ_BLOCK_MS,
+            )
+        except Exception:
+            log.exception("Failed to read the update streams")
+            await asyncio.sleep(READ_BLOCK_MS / 1000)
+            return
+        for key, entries in response or []:
+            partition = int(key.split(":")[1])
+            for entry_id, fields in entries:
+                self._spawn(partition, entry_id, fields)
+
+    def _spawn(self, partition: int, entry_id: str, fields: dict | None) -> None:
+        task = asyncio.create_task(self._process(partition, entry_id, fields))
+        tasks = self._tasks.setdefault(partition, set())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        self._entries.add(entry_id)
+        task.add_done_callback(lambda _: self._entries.discard(entry_id))
+
+    async def _process(
+        self,
+        partition: int,
+        entry_id: str,
+        fields: dict | None,
+    ) -> None:
+        # Entries trimmed from the stream before being claimed have no fields
+        if fields:
+            try:
+                update = json.loads(fields["update"])
+                await self.dispatcher.feed_raw_update(self.bot, update)
+            except Exception:
+                stream_updates.labels("failed").inc()
+                log.exception("Failed to process stream entry: %s", entry_id)
+            else:
+                stream_updates.labels("processed").inc()
+        # Failed updates are acknowledged too, as with polling
+        try:
+            await app.redis.xack(stream_key(partition), CONSUMER_GROUP, entry_id)
+        except Exception:
+            log.exception("Failed to acknowledge stream entry: %s", entry_id)
+
+
+async def run_stream_worker(dispatcher: Dispatcher, bot: Bot) -> None:
+    """Handle the updates from the streams until the process is asked to stop.
+
+    Args:
+        dispatcher (Dispatcher): The dispatcher to feed the updates to.
+        bot (Bot): The bot the updates are for.
+
+    """
+    worker = StreamWorker(
+        dispatcher,
+        bot,
+        name=settings.STREAM_WORKER_NAME or f"{socket.gethostname()}:{os.getpid()}",
+        lease_seconds=settings.STREAM_LEASE_SECONDS,
+        max_tasks=settings.STREAM_WORKER_MAX_TASKS,
+    )
+    await dispatcher.emit_startup(bot=bot)
+    run_task = asyncio.create_task(worker.run())
+    stop_task = asyncio.create_task(wait_for_stop_signal())
+    try:
+        await asyncio.wait((run_task, stop_task), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stop_task.cancel()
+        worker.stop()
+        try:
+            await run_task
+        finally:
+            await worker.drain(settings.STREAM_SHUTDOWN_TIMEOUT_SECONDS)
+            await dispatcher.emit_shutdown(bot=bot)
@@ -1,10 +1,15 @@
+import asyncio
+
+from chat_bot.app import app
 from chat_bot.config import get_logger
-from chat_bot.crud import get_user_chat_mode, set_user_chat_mode
 from chat_bot.enums import ChatMode
-from chat_bot.redis_client import redis_client
+from chat_bot.metrics import timed
 
 log = get_logger(__name__)
 
+# Redis Pub/Sub channel used to notify all bot instances about chat mode changes
+CHAT_MODE_INVALIDATION_CHANNEL = "user_chat_mode:invalidate"
+
 
 def cache_key_from_tg_id(tg_id: int) -> str:
     """Generate a cache key based on the Telegram ID."""
@@ -13,8 +18,9 @@ def cache_key_from_tg_id(tg_id: int) -> str:
 
 async def add_mode_to_cache(tg_id: int, chat_mode: ChatMode) -> bool:
     """Add the chat mode of a user to the cache."""
+    app.chat_mode_cache.set(tg_id, chat_mode)
     try:
-        await redis_client.setex(
+        await app.redis.setex(
             name=cache_key_from_tg_id(tg_id),
             time=3600,  # Set expiration time to 1 hour
             value=chat_mode.name,
@@ -27,11 +33,13 @@ async def add_mode_to_cache(tg_id: int, chat_mode: ChatMode) -> bool:
         return True
 
 
+@timed
 async def get_chat_mode(tg_id: int) -> ChatMode:
     """Get the chat mode of a user by their Telegram ID.
 
-    This function first checks the cache for the user's chat mode.
-    If not found, it retrieves the chat mode from the database and updates the cache.
+    This function first checks the local and the Redis cache for the user's chat
+    mode. If not found, it retrieves the chat mode from the database and updates
+    the cache.
 
     Args:
         tg_id (int): Telegram user ID.
@@ -40,14 +48,23 @@ async def get_chat_mode(tg_id: int) -> ChatMode:
         ChatMode: The chat mode of the user.
 
     """
+    chat_mode: ChatMode | None = app.chat_mode_cache.get(tg_id)
+    if chat_mode:
+        log.debug("User=%s chat mode found in local cache", tg_id)
+        return chat_mode
+
     log.info("Try to get user chat mode from cache: %s", tg_id)
-    cache_value = await redis_client.get(cache_key_from_tg_id(tg_id))
+    cache_value = await app.redis.get(cache_key_from_tg_id(tg_id))
     if cache_value:
         log.info("User=%s chat mode found in cache", tg_id)
-        return ChatMode[cache_value]
+        chat_mode = ChatMode[cache_value]
+        app.chat_mode_cache.set(tg_id, chat_mode)
+        return chat_mode
 
     log.info("User tg_id=%s chat mode not found in cache, search the database", tg_id)
-    chat_mode: ChatMode = await get_user_chat_mode(tg_id)
+    from chat_bot.crud import get_user_chat_mode  # noqa: PLC0415
+
+    chat_mode = await get_user_chat_mode(tg_id)
 
     cache_updated = await add_mode_to_cache(tg_id, chat_mode)
     if not cache_updated:
@@ -60,6 +77,9 @@ async def get_chat_mode(tg_id: int) -> ChatMode:
 async def set_chat_mode(tg_id: int, chat_mode: ChatMode) -> bool:
     """Set the chat mode of a user by their Telegram ID.
 
+    Other bot instances are notified so they evict the old mode from their local
+    cache.
+
     Args:
         tg_id (int): Telegram user ID.
         chat_mode (ChatMode): Chat mode to set.
@@ -68,6 +88,8 @@ async def set_chat_mode(tg_id: int, chat_mode: ChatMode) -> bool:
         bool: True if the chat mode was successfully set, False otherwise.
 
     """
+    from chat_bot.crud import set_user_chat_mode  # noqa: PLC0415
+
     mode_updated = await set_user_chat_mode(tg_id, chat_mode)
     if not mode_updated:
         log.info("Failed to set user chat mode in database: %s", tg_id)
@@ -79,5 +101,33 @@ async def set_chat_mode(tg_id: int, chat_mode: ChatMode) -> bool:
         log.info("Failed to set user chat mode in cache: %s", tg_id)
         return False
 
+    try:
+        await app.redis.publish(CHAT_MODE_INVALIDATION_CHANNEL, tg_id)
+    except Exception:
+        log.exception("Failed to publish chat mode invalidation: %s", tg_id)
+
     log.info("User tg_id=%s new chat_mode=%s updated in cache", tg_id, chat_mode)
     return True
+
+
+async def listen_chat_mode_invalidations() -> None:
+    """Evict chat modes changed by other bot instances from the local cache.
+
+    Runs until cancelled. The local cache is cleared on every (re)subscription,
+    because invalidations published while disconnected are lost.
+    """
+    from redis.exceptions import ConnectionError as RedisConnectionError  # noqa: PLC0415
+    from redis.exceptions import TimeoutError as RedisTimeoutError  # noqa: PLC0415
+
+    while True:
+        try:
+            async with app.redis.pubsub() as pubsub:
+                await pubsub.subscribe(CHAT_MODE_INVALIDATION_CHANNEL)
+                app.chat_mode_cache.clear()
+                log.info("Subscribed to chat mode invalidations")
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        app.chat_mode_cache.invalidate(int(message["data"]))
+        except (RedisConnectionError, RedisTimeoutError, OSError):
+            log.exception("Chat mode invalidation subscription lost, reconnecting...")
+            await asyncio.sleep(1)
@@ -0,0 +1,142 @@
+import asyncio
+import contextlib
+import secrets
+import signal
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+
+from chat_bot.config import get_logger, settings
+
+log = get_logger(__name__)
+
+# Header with the secret token passed to `setWebhook`, sent by Telegram with every
+# update
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"  # noqa: S105
+
+
+class WebhookHandler:
+    """Receive updates from Telegram and handle them in background tasks.
+
+    Updates are acknowledged as soon as they are received, so a slow handler
+    doesn't hold the connection and make Telegram retry the update.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str) -> None:
+        """Initialize the handler.
+
+        Args:
+            dispatcher (Dispatcher): The dispatcher to feed the updates to.
+            bot (Bot): The bot the updates are for.
+            secret_token (str): The secret token Telegram must send.
+
+        """
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret_token = secret_token
+        self._tasks: set[asyncio.Task] = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Validate the secret token and start handling the update."""
+        secret_token = request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not secrets.compare_digest(secret_token, self.secret_token):
+            log.warning("Rejected webhook request with a wrong secret token")
+            raise web.HTTPUnauthorized
+        try:
+            update: dict[str, Any] = await request.json()
+        except ValueError as e:
+            raise web.HTTPBadRequest from e
+
+        task = asyncio.create_task(self.process_update(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def process_update(self, update: dict[str, Any]) -> None:
+        """Feed an update to the dispatcher."""
+        try:
+            await self.dispatcher.feed_raw_update(self.bot, update)
+        except Exception:
+            log.exception("Failed to process update: %s", update.get("update_id"))
+
+    async def drain(self, timeout: float) -> None:  # noqa: ASYNC109
+        """Wait for the updates being handled.
+
+        Args:
+            timeout (float): Maximum time to wait in seconds.
+
+        """
+        if not self._tasks:
+            return
+        log.info("Waiting for %s updates to be handled", len(self._tasks))
+        _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+
+async def wait_for_stop_signal() -> None:
+    """Wait until the process is asked to stop by SIGINT or SIGTERM."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        # Signal handlers are not supported on Windows, Ctrl+C still cancels
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(signal_number, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            with contextlib.suppress(NotImplementedError):
+                loop.remove_signal_handler(signal_number)
+
+
+async def run_webhook(dispatcher: Dispatcher, bot: Bot) -> None:
+    """Receive updates through a webhook until the process is asked to stop.
+
+    The webhook is registered on startup, and removed on shutdown if
+    `WEBHOOK_DELETE_ON_SHUTDOWN` is set, then the updates being handled are given
+    `WEBHOOK_SHUTDOWN_TIMEOUT_SECONDS` to finish. The bot session is closed by
+    `app.close()`.
+
+    Args:
+        dispatcher (Dispatcher): The dispatcher to feed the updates to.
+        bot (Bot): The bot to receive the updates for.
+
+    """
+    if not settings.WEBHOOK_URL or not settings.WEBHOOK_SECRET:
+        msg = "WEBHOOK_URL and WEBHOOK_SECRET are required in webhook mode"
+        raise ValueError(msg)
+
+    handler = WebhookHandler(dispatcher, bot, settings.WEBHOOK_SECRET)
+    app = web.Application()
+    app.router.add_post(settings.WEBHOOK_PATH, handler.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, settings.WEBHOOK_HOST, settings.WEBHOOK_PORT).start()
+    log.info(
+        "Webhook server listening on %s:%s%s",
+        settings.WEBHOOK_HOST,
+        settings.WEBHOOK_PORT,
+        settings.WEBHOOK_PATH,
+    )
+
+    await dispatcher.emit_startup(bot=bot)
+    try:
+        await bot.set_webhook(
+            url=settings.WEBHOOK_URL,
+            secret_token=settings.WEBHOOK_SECRET,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+        log.info("Webhook has been set: %s", settings.WEBHOOK_URL)
+        await wait_for_stop_signal()
+    finally:
+        if settings.WEBHOOK_DELETE_ON_SHUTDOWN:
+            try:
+                await bot.delete_webhook()
+                log.info("Webhook has been deleted")
+            except Exception:
+                log.exception("Webhook has not been deleted")
+        await runner.cleanup()
+        await handler.drain(settings.WEBHOOK_SHUTDOWN_TIMEOUT_SECONDS)
+        await dispatcher.emit_shutdown(bot=bot)